@@ -0,0 +1,1156 @@
+#!/usr/bin/env python3
+# Copyright (c) 2017 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-application-examples/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""fakeagent: In-process stand-in for IoticAgent's IOT.Client
+
+Things, points, subscriptions, tags, values and metadata live in an in-memory Space shared by every FakeClient in
+the process, so one client can follow (or attach to) another's points.  Every request completes after a configurable
+latency (plus jitter) and fails with a configurable probability.  IoticAgent itself must be installed (for Const,
+Exceptions, ThingRunner etc.), only the connection to Iotic Space is replaced.
+
+Run an example against it
+
+    python3 fakeagent.py --latency 0.005 --fail 0.01 ../mqtt_bridge/src/mqtt.py mqtt.ini
+    python3 fakeagent.py -m ExtMon2 extmon2.ini
+
+or from code
+
+    import fakeagent
+    fakeagent.install(latency=0.005)
+"""
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import runpy
+import sys
+from collections import OrderedDict, deque
+from datetime import datetime
+from functools import partial
+from heapq import heappush, heappop
+from itertools import count
+from math import radians, sin, cos, asin, sqrt
+from os.path import abspath, basename, dirname, splitext
+from random import random, uniform
+from threading import Thread, Lock, Condition, Event
+from uuid import uuid4
+
+from IoticAgent.Core.compat import PY3, monotonic
+from IoticAgent.Core.Const import (R_FEED, R_CONTROL, M_TYPE, M_PAYLOAD, E_COMPLETE, E_FAILED, E_CREATED,
+                                   E_DUPLICATED, E_RENAMED, E_DELETED, E_REASSIGNED)
+from IoticAgent.IOT.Exceptions import IOTException, IOTUnknown, LinkException
+
+if PY3:
+    from queue import Queue  # pylint: disable=import-error,wrong-import-order
+else:
+    from Queue import Queue  # pylint: disable=import-error,wrong-import-order
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Seconds a synchronous call (e.g. create_thing) waits for its request
+DEFAULT_SYNC_TIMEOUT = 30
+# Threads per client running callbacks (feeddata, controlreq, subscription etc.)
+DEFAULT_CALLBACK_THREADS = 4
+# Shares remembered per point for get_recent()
+RECENT = 100
+
+FOC_NAME = {R_FEED: 'Feed', R_CONTROL: 'Control'}
+
+
+def _guid():
+    return uuid4().hex
+
+
+class _Scheduler(object):
+    """Runs functions after a delay on one thread"""
+
+    def __init__(self):
+        self.__cond = Condition()
+        # (due, seq, func, args)
+        self.__heap = []
+        self.__seq = count()
+        self.__thread = None
+
+    def schedule(self, delay, func, *args):
+        with self.__cond:
+            heappush(self.__heap, (monotonic() + delay, next(self.__seq), func, args))
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name='fakeagent-scheduler')
+                self.__thread.daemon = True
+                self.__thread.start()
+            self.__cond.notify()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not self.__heap or self.__heap[0][0] > monotonic():
+                    self.__cond.wait(self.__heap[0][0] - monotonic() if self.__heap else None)
+                _, _, func, args = heappop(self.__heap)
+            try:
+                func(*args)
+            except:
+                logger.exception("Scheduled function failed")
+
+
+class _ThingRec(object):
+
+    def __init__(self, agent_id, lid):
+        self.guid = _guid()
+        self.agent_id = agent_id
+        self.lid = lid
+        self.public = False
+        self.meta = {'label': None, 'description': None, 'lat': None, 'long': None, 'raw': None}
+        # lang -> set of tags
+        self.tags = {}
+        # (predicate, object) tuples, see Thing.create_property()
+        self.properties = set()
+        # (foc, pid) -> _PointRec
+        self.points = OrderedDict()
+
+
+class _PointRec(object):
+
+    def __init__(self, thing, foc, pid):
+        self.guid = _guid()
+        self.thing = thing
+        self.foc = foc
+        self.pid = pid
+        self.meta = {'label': None, 'description': None}
+        self.tags = {}
+        # label -> dict of label, vtype, lang, comment, unit
+        self.values = OrderedDict()
+        self.recent = deque(maxlen=RECENT)
+        # subscription guids
+        self.subs = set()
+        # (client, callback, callback_parsed) for controls
+        self.handler = None
+
+
+class _SubRec(object):
+
+    def __init__(self, client, thing, point, callback=None, callback_parsed=None):
+        self.guid = _guid()
+        self.client = client
+        self.thing = thing
+        self.point = point
+        self.callback = callback
+        self.callback_parsed = callback_parsed
+
+
+class Space(object):
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0):
+        """In-memory registry shared by FakeClients.  See configure() for args"""
+        self.latency = self.jitter = self.failure_rate = 0.0
+        self.configure(latency, jitter, failure_rate)
+        self.scheduler = _Scheduler()
+        # guid -> record.  Only changed from the scheduler thread
+        self.things = {}
+        # (agent_id, lid) -> _ThingRec
+        self.lids = {}
+        self.points = {}
+        self.subs = {}
+        # requestId -> RequestEvent of tell() waiting for confirm_tell()
+        self.tells = {}
+        # agent_id -> FakeClient
+        self.clients = {}
+        self.__agents = count(1)
+
+    def configure(self, latency=0.0, jitter=0.0, failure_rate=0.0):
+        """`latency` (optional) (float) seconds each request (and delivery of shared data) takes
+
+        `jitter` (optional) (float) up to this many seconds are randomly added to or taken from latency
+
+        `failure_rate` (optional) (float) probability (0 to 1) of a request failing
+        """
+        self.latency = max(0.0, latency)
+        self.jitter = max(0.0, jitter)
+        self.failure_rate = max(0.0, min(1.0, failure_rate))
+
+    def delay(self):
+        return max(0.0, self.latency + uniform(-self.jitter, self.jitter)) if self.jitter else self.latency
+
+    def fails(self):
+        return self.failure_rate > 0 and random() < self.failure_rate
+
+    def add_client(self, client, config):
+        """`Returns` new agent id for client"""
+        agent_id = '%s-%d' % (splitext(basename(config))[0] if config else 'agent', next(self.__agents))
+        self.clients[agent_id] = client
+        return agent_id
+
+    def thing(self, agent_id, lid):
+        try:
+            return self.lids[(agent_id, lid)]
+        except KeyError:
+            raise IOTUnknown("Unknown thing: %s" % lid)
+
+    def add_thing(self, thing):
+        self.things[thing.guid] = thing
+        self.lids[(thing.agent_id, thing.lid)] = thing
+
+    def move_thing(self, thing, agent_id, lid):
+        """Rename or reassign"""
+        del self.lids[(thing.agent_id, thing.lid)]
+        thing.agent_id = agent_id
+        thing.lid = lid
+        self.lids[(agent_id, lid)] = thing
+
+    def point(self, agent_id, foc, lid, pid):
+        try:
+            return self.thing(agent_id, lid).points[(foc, pid)]
+        except KeyError:
+            raise IOTUnknown("Unknown point: %s/%s" % (lid, pid))
+
+    def resolve_point(self, agent_id, gpid):
+        """gpid is a point guid or (thing lid, point pid) of one of agent_id's things"""
+        if isinstance(gpid, (tuple, list)):
+            thing = self.thing(agent_id, gpid[0])
+            for (_, pid), point in thing.points.items():
+                if pid == gpid[1]:
+                    return point
+            raise IOTUnknown("Unknown point: %s/%s" % tuple(gpid))
+        try:
+            point = self.points[gpid]
+        except KeyError:
+            raise IOTUnknown("Unknown point: %s" % gpid)
+        if not point.thing.public and point.thing.agent_id != agent_id:
+            raise IOTUnknown("Unknown point: %s" % gpid)
+        return point
+
+    def sub(self, client, subid):
+        sub = self.subs.get(subid)
+        if sub is None or sub.client is not client:
+            raise IOTUnknown("Unknown subscription: %s" % subid)
+        return sub
+
+    def remove_thing(self, thing):
+        del self.things[thing.guid]
+        del self.lids[(thing.agent_id, thing.lid)]
+        for point in list(thing.points.values()):
+            self.remove_point(point)
+        for sub in [sub for sub in self.subs.values() if sub.thing is thing]:
+            self.remove_sub(sub)
+
+    def remove_point(self, point):
+        del point.thing.points[(point.foc, point.pid)]
+        del self.points[point.guid]
+        for subid in list(point.subs):
+            self.remove_sub(self.subs[subid])
+
+    def remove_sub(self, sub):
+        del self.subs[sub.guid]
+        sub.point.subs.discard(sub.guid)
+
+    def describe(self, guid):
+        """`Returns` metadata dict for a public thing or point, None if unknown"""
+        thing = self.things.get(guid)
+        if thing is not None and thing.public:
+            return {'meta': {'label': thing.meta['label'],
+                             'description': thing.meta['description'],
+                             'geo': {'lat': thing.meta['lat'], 'long': thing.meta['long']},
+                             'tags': sorted(tag for tags in thing.tags.values() for tag in tags),
+                             'points': [{'guid': point.guid, 'label': point.meta['label'],
+                                         'type': FOC_NAME[point.foc]} for point in thing.points.values()]}}
+        point = self.points.get(guid)
+        if point is not None and point.thing.public:
+            return {'meta': {'label': point.meta['label'],
+                             'description': point.meta['description'],
+                             'parent': point.thing.guid,
+                             'tags': sorted(tag for tags in point.tags.values() for tag in tags),
+                             'values': [dict(value) for value in point.values.values()]}}
+        return None
+
+    def search(self, text=None, location=None, unit=None, reduced=False):
+        """Public things matching any word of text (in label, description or tags), within location
+        {'lat', 'long', 'radius' (km)} and with a point value in unit (all optional)
+        """
+        words = set(text.lower().split()) if text else None
+        results = OrderedDict()
+        for thing in self.things.values():
+            if not thing.public:
+                continue
+            if words:
+                found = ' '.join([thing.meta['label'] or '', thing.meta['description'] or ''] +
+                                 [tag for tags in thing.tags.values() for tag in tags]).lower()
+                if not any(word in found for word in words):
+                    continue
+            if location and not _within(thing.meta, location):
+                continue
+            if unit and not any(value.get('unit') == unit for point in thing.points.values()
+                                for value in point.values.values()):
+                continue
+            if reduced:
+                results[thing.guid] = {point.guid: FOC_NAME[point.foc] for point in thing.points.values()}
+            else:
+                results[thing.guid] = {'label': thing.meta['label'],
+                                       'long': thing.meta['long'],
+                                       'lat': thing.meta['lat'],
+                                       'points': {point.guid: {'type': FOC_NAME[point.foc],
+                                                               'label': point.meta['label']}
+                                                  for point in thing.points.values()}}
+        return results
+
+
+def _within(meta, location):
+    if meta['lat'] is None or meta['long'] is None:
+        return False
+    lat1, lon1, lat2, lon2 = map(radians, (meta['lat'], meta['long'], location['lat'], location['long']))
+    hav = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * asin(sqrt(hav)) <= location['radius']
+
+
+# Shared by all clients unless one is passed to FakeClient
+SPACE = Space()
+
+
+class RequestEvent(object):
+    """As IoticAgent's RequestEvent: wait() for the request to complete then check success and payload"""
+
+    def __init__(self, is_crud=False):
+        self.id_ = _guid()
+        self.success = None
+        self.payload = None
+        self.is_crud = is_crud
+        self._messages = []
+        self.__event = Event()
+        self.__lock = Lock()
+        self.__complete_func = None
+
+    def wait(self, timeout=None):
+        return self.__event.wait(timeout)
+
+    def is_set(self):
+        return self.__event.is_set()
+
+    def _run_on_completion(self, func, *args, **kwargs):
+        """As IoticAgent: call func(self, *args, **kwargs) once set (straight away, on this thread, if already set).
+        Only one completion function can be set, ValueError is raised for another
+        """
+        with self.__lock:
+            if self.__complete_func is not None:
+                raise ValueError('Completion function already set for %s: %s' % (self.id_, self.__complete_func))
+            if not self.__event.is_set():
+                self.__complete_func = partial(func, self, *args, **kwargs)
+                return
+        func(self, *args, **kwargs)
+
+    def _set(self, success, mtype, payload):
+        self.success = success
+        self.payload = payload
+        self._messages.append({M_TYPE: mtype, M_PAYLOAD: payload})
+        with self.__lock:
+            self.__event.set()
+            complete_func = self.__complete_func
+        if complete_func is not None:
+            try:
+                complete_func()
+            except:  # pylint: disable=bare-except
+                logger.exception("RequestEvent completion callback failed")
+
+
+class _Value(object):
+
+    def __init__(self, label, vtype=None, lang=None, description=None, unit=None, value=None):
+        self.label = label
+        self.type_ = vtype
+        self.lang = lang
+        self.description = description
+        self.unit = unit
+        self.value = value
+
+
+class _Values(object):
+
+    def __init__(self, values):
+        object.__setattr__(self, '_values', values)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name].value
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        try:
+            self._values[name].value = value
+        except KeyError:
+            raise AttributeError(name)
+
+
+class PointDataObject(object):
+    """Stands in for IoticAgent's PointDataObject: get_template() and 'parsed' in callbacks"""
+
+    def __init__(self, values, data=None):
+        self.__values = OrderedDict((value['label'], _Value(value['label'], value['vtype'], value['lang'],
+                                                            value['comment'], value['unit']))
+                                    for value in values)
+        if isinstance(data, dict):
+            for label, value in data.items():
+                if label in self.__values:
+                    self.__values[label].value = value
+        self.values = _Values(self.__values)
+
+    def filter_by(self, text=(), types=(), units=(), include_unset=False):
+        """`Returns` list of values matching all of the given types, units and (any word of) text in description"""
+        found = []
+        for value in self.__values.values():
+            if value.value is None and not include_unset:
+                continue
+            if types and value.type_ not in types:
+                continue
+            if units and value.unit not in units:
+                continue
+            if text and not any(word.lower() in (value.description or '').lower() for word in text):
+                continue
+            found.append(value)
+        return found
+
+    def to_dict(self):
+        return {label: value.value for label, value in self.__values.items() if value.value is not None}
+
+
+def _data(data):
+    return data.to_dict() if isinstance(data, PointDataObject) else data
+
+
+class _Meta(object):
+    """Context manager from get_meta().  Changes are saved on exit"""
+
+    def __init__(self, client, lid, pid=None, foc=None):
+        self.__client = client
+        self.__target = (lid, pid, foc)
+        self.__changes = {}
+
+    def set_label(self, label, lang=None):  # pylint: disable=unused-argument
+        self.__changes['label'] = label
+
+    def set_description(self, description, lang=None):  # pylint: disable=unused-argument
+        self.__changes['description'] = description
+
+    def set_location(self, lat, lon):
+        self.__changes['lat'] = lat
+        self.__changes['long'] = lon
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.__client._wait(self.__client._request_meta_update(self.__target, self.__changes))
+
+
+class Thing(object):
+
+    def __init__(self, client, lid, guid):
+        self.__client = client
+        self.lid = lid
+        self.guid = guid
+
+    def create_feed(self, pid, save_recent=0):  # pylint: disable=unused-argument
+        return self.__create_point(R_FEED, pid)
+
+    def create_control(self, pid, callback, callback_parsed=None):
+        return self.__create_point(R_CONTROL, pid, callback, callback_parsed)
+
+    def __create_point(self, foc, pid, callback=None, callback_parsed=None):
+        payload = self.__client._wait(self.__client._request_point_create(foc, self.lid, pid, callback,
+                                                                          callback_parsed))
+        return Point(self.__client, foc, self.lid, pid, payload['id'])
+
+    def delete_feed(self, pid):
+        self.__client._wait(self.__client._request_point_delete(R_FEED, self.lid, pid))
+
+    def delete_control(self, pid):
+        self.__client._wait(self.__client._request_point_delete(R_CONTROL, self.lid, pid))
+
+    def follow(self, gpid, callback=None, callback_parsed=None):
+        """gpid is a feed guid or (thing lid, feed pid) of your own"""
+        payload = self.__client._wait(self.__client._request_sub_create(self.lid, R_FEED, gpid, callback,
+                                                                        callback_parsed))
+        return RemoteFeed(self.__client, payload['id'], payload['pointId'])
+
+    def attach(self, gpid, callback=None):  # pylint: disable=unused-argument
+        payload = self.__client._wait(self.__client._request_sub_create(self.lid, R_CONTROL, gpid))
+        return RemoteControl(self.__client, payload['id'], payload['pointId'])
+
+    def unfollow(self, subid):
+        self.__client._wait(self.__client._request_sub_delete(subid))
+
+    unattach = unfollow
+
+    def list_connections(self, limit=500, offset=0):
+        return self.__client._wait(self.__client._request_sub_list(self.lid, limit, offset))['subs']
+
+    def set_public(self, public=True):
+        self.__client._wait(self.__client._request_entity_meta_setpublic(self.lid, public))
+
+    def get_meta(self):
+        return _Meta(self.__client, self.lid)
+
+    def create_tag(self, tags, lang=None):
+        self.__client._wait(self.__client._request_entity_tag_create(self.lid, tags, lang))
+
+    def delete_tag(self, tags, lang=None):
+        self.__client._wait(self.__client._request_entity_tag_delete(self.lid, tags, lang))
+
+    def list_tag(self, limit=100, offset=0):
+        return self.__client._wait(self.__client._request_entity_tag_list(self.lid, limit, offset))['tags']
+
+    def create_property(self, prop):
+        """prop is a (predicate, object) tuple.  Kept but not searchable, see README"""
+        self.__client._wait(self.__client._request_entity_property_create(self.lid, prop))
+
+    def rename(self, new_lid):
+        self.__client._wait(self.__client._request_entity_rename(self.lid, new_lid))
+        self.lid = new_lid
+
+
+class Point(object):
+
+    def __init__(self, client, foc, lid, pid, guid):
+        self.__client = client
+        self.foc = foc
+        self.lid = lid
+        self.pid = pid
+        self.guid = guid
+
+    def share(self, data, mime=None, time=None):
+        self.__client._wait(self.share_async(data, mime, time))
+
+    def share_async(self, data, mime=None, time=None):
+        return self.__client._request_point_share(self.lid, self.pid, _data(data), mime, time)
+
+    def get_meta(self):
+        return _Meta(self.__client, self.lid, self.pid, self.foc)
+
+    def create_value(self, label, vtype, lang=None, description=None, unit=None):
+        self.__client._wait(self.__client._request_point_value_create(self.lid, self.pid, self.foc, label, vtype,
+                                                                      lang, description, unit))
+
+    def delete_value(self, label=None):
+        self.__client._wait(self.__client._request_point_value_delete(self.lid, self.pid, self.foc, label))
+
+    def list(self, limit=500, offset=0):
+        return self.__client._wait(self.__client._request_point_value_list(self.lid, self.pid, self.foc, limit,
+                                                                           offset))['values']
+
+    def list_followers(self):
+        """`Returns` dict of subscription guid -> following thing guid"""
+        return self.__client._wait(self.__client._request_point_list_detailed(self.foc, self.lid,
+                                                                              self.pid))['subs']
+
+    def get_template(self):
+        return PointDataObject(self.list())
+
+    get_skeleton = get_template
+
+
+class _RemotePoint(object):
+
+    def __init__(self, client, subid, gpid):
+        self._client = client
+        self.subid = subid
+        self.guid = gpid
+
+    def get_template(self):
+        return PointDataObject(self._client._wait(self._client._request_sub_values(self.subid))['values'])
+
+
+class RemoteFeed(_RemotePoint):
+
+    def get_recent(self, count):  # pylint: disable=redefined-outer-name
+        """`Returns` list of up to count most recent shares, oldest first"""
+        return self._client._wait(self._client._request_sub_recent(self.subid, count))['samples']
+
+
+class RemoteControl(_RemotePoint):
+
+    def ask(self, data, mime=None):
+        self._client._wait(self.ask_async(data, mime))
+
+    def ask_async(self, data, mime=None):
+        return self._client._request_sub_ask(self.subid, _data(data), mime)
+
+    def tell(self, data, timeout=10, mime=None):
+        """`Returns` True if the control owner confirmed success, otherwise the reason"""
+        evt = self.tell_async(data, timeout, mime)
+        self._client._wait(evt, timeout + self._client.sync_timeout)
+        return True if evt.payload['success'] else evt.payload['reason']
+
+    def tell_async(self, data, timeout=10, mime=None):
+        return self._client._request_sub_tell(self.subid, _data(data), timeout, mime)
+
+
+class FakeClient(object):
+    # pylint: disable=too-many-public-methods
+
+    def __init__(self, config=None, space=None, callback_threads=DEFAULT_CALLBACK_THREADS):
+        """Stands in for IOT.Client.  config is only used to name the agent
+
+        `space` (optional) (Space) defaults to SPACE, shared by all clients
+        """
+        self.__space = space or SPACE
+        self.__agent_id = self.__space.add_client(self, config)
+        self.sync_timeout = DEFAULT_SYNC_TIMEOUT
+        self.__callbacks = Queue()
+        self.__threads = [Thread(target=self.__run_callbacks, name='fakeagent-cb-%d' % i)
+                          for i in range(max(1, callback_threads))]
+        for thread in self.__threads:
+            thread.daemon = True
+        self.__started = False
+        self.__connected = False
+        self.__link_down = False
+        # catchall_feeddata, catchall_controlreq, subscription, subscribed, created etc. -> list of functions
+        self.__registered = {}
+        self.__lock = Lock()
+        self.__counts = {'requests': 0, 'failed': 0, 'feeddata': 0, 'controlreq': 0}
+
+    @property
+    def agent_id(self):
+        return self.__agent_id
+
+    @property
+    def space(self):
+        return self.__space
+
+    def start(self):
+        if not self.__started:
+            self.__started = True
+            for thread in self.__threads:
+                thread.start()
+        self.__connected = True
+        return self
+
+    def stop(self):
+        self.__connected = False
+
+    def is_connected(self):
+        return self.__connected and not self.__link_down
+
+    def simulate_link_down(self, down=True):
+        """While down is_connected() is False and requests raise LinkException, as when the agent's link drops"""
+        self.__link_down = down
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def stats(self):
+        """`Returns` dict of counts of requests, failed (injected failures), feeddata and controlreq received"""
+        with self.__lock:
+            return dict(self.__counts)
+
+    def __count(self, name):
+        with self.__lock:
+            self.__counts[name] += 1
+
+    # Callbacks ------------------------------------------------------------------------------------------------------
+
+    def __run_callbacks(self):
+        while True:
+            func, args = self.__callbacks.get()
+            try:
+                func(*args)
+            except:
+                logger.exception("Callback %s failed", func)
+
+    def _callback(self, func, *args):
+        self.__callbacks.put((func, args))
+
+    def __register(self, name, func):
+        self.__registered.setdefault(name, []).append(func)
+
+    def __fire(self, name, *args):
+        for func in self.__registered.get(name, ()):
+            self._callback(func, *args)
+
+    def register_catchall_feeddata(self, callback, callback_parsed=None):
+        self.__register('catchall_feeddata', (callback, callback_parsed))
+
+    def register_catchall_controlreq(self, callback, callback_parsed=None):
+        self.__register('catchall_controlreq', (callback, callback_parsed))
+
+    def register_callback_subscription(self, func):
+        """func(data) called when someone follows or attaches to one of your points"""
+        self.__register('subscription', func)
+
+    def register_callback_subscribed(self, func):
+        """func(RemoteFeed or RemoteControl) called when you follow or attach"""
+        self.__register('subscribed', func)
+
+    def register_callback_created(self, func):
+        self.__register(E_CREATED, func)
+
+    def register_callback_duplicated(self, func):
+        self.__register(E_DUPLICATED, func)
+
+    def register_callback_renamed(self, func):
+        self.__register(E_RENAMED, func)
+
+    def register_callback_deleted(self, func):
+        self.__register(E_DELETED, func)
+
+    def register_callback_reassigned(self, func):
+        self.__register(E_REASSIGNED, func)
+
+    def _deliver(self, name, data, point, callback=None, callback_parsed=None):
+        """Called (on the scheduler thread) with feeddata or controlreq for this client"""
+        self.__count(name)
+        handlers = [(callback, callback_parsed)] if callback or callback_parsed else \
+            self.__registered.get('catchall_' + name, ())
+        for callback, callback_parsed in handlers:  # pylint: disable=redefined-argument-from-local
+            if callback_parsed is not None:
+                parsed = dict(data)
+                parsed['parsed'] = PointDataObject(point.values.values(), data['data'])
+                self._callback(callback_parsed, parsed)
+            elif callback is not None:
+                self._callback(callback, data)
+
+    def simulate_feeddata(self, pid, data, mime=None, time=None):
+        """Deliver feeddata for guid pid to the catchall as if from a followed feed, e.g. for benchmarks"""
+        self.__count('feeddata')
+        for callback, _ in self.__registered.get('catchall_feeddata', ()):
+            if callback is not None:
+                self._callback(callback, {'pid': pid, 'data': data, 'mime': mime, 'time': time or datetime.utcnow()})
+
+    def confirm_tell(self, data, success, delay_sec=None):  # pylint: disable=unused-argument
+        self.__space.scheduler.schedule(self.__space.delay(), self.__confirm, data['requestId'], success)
+
+    def _request_point_confirm_tell(self, foc, lid, pid, success, request_id):  # pylint: disable=unused-argument
+        def confirm():
+            self.__confirm(request_id, success)
+            return E_COMPLETE, {'lid': lid, 'pid': pid}
+        return self.__request(confirm)
+
+    def __confirm(self, request_id, success):
+        tell = self.__space.tells.pop(request_id, None)
+        if tell is not None:
+            tell._set(True, E_COMPLETE, {'success': bool(success), 'reason': None if success else 'not confirmed'})
+
+    # Requests -------------------------------------------------------------------------------------------------------
+
+    def __request(self, func, *args):
+        """Runs func(*args) on the scheduler thread after the space's latency.  func returns (mtype, payload) or raises
+        IOTException.  `Returns` RequestEvent
+        """
+        self.__check_link()
+        evt = RequestEvent(is_crud=True)
+        self.__count('requests')
+        self.__space.scheduler.schedule(self.__space.delay(), self.__complete, evt, func, args)
+        return evt
+
+    def __check_link(self):
+        if self.__link_down:
+            raise LinkException('Client not connected (simulated)')
+
+    def __complete(self, evt, func, args):
+        if self.__space.fails():
+            self.__count('failed')
+            evt._set(False, E_FAILED, {'reason': 'injected failure'})
+            return
+        try:
+            result = func(*args)
+        except IOTException as exc:
+            evt._set(False, E_FAILED, {'reason': str(exc)})
+            return
+        if result is None:
+            # completed later, e.g. tell
+            return
+        mtype, payload = result
+        evt._set(True, mtype, payload)
+        if mtype != E_COMPLETE:
+            self.__fire(mtype, payload)
+
+    def _wait(self, evt, timeout=None):
+        """Wait for evt as the synchronous IOT.Client methods do.  `Returns` its payload"""
+        if not evt.wait(timeout or self.sync_timeout):
+            raise IOTException("Sync request timed out")
+        if not evt.success:
+            reason = evt.payload['reason']
+            raise (IOTUnknown if reason.startswith('Unknown') else IOTException)(reason)
+        return evt.payload
+
+    def __thing(self, lid):
+        return self.__space.thing(self.__agent_id, lid)
+
+    def _request_entity_create(self, lid, epId=None):  # pylint: disable=invalid-name,unused-argument
+        def create():
+            try:
+                thing = self.__thing(lid)
+                mtype = E_DUPLICATED
+            except IOTUnknown:
+                thing = _ThingRec(self.__agent_id, lid)
+                self.__space.add_thing(thing)
+                mtype = E_CREATED
+            return mtype, {'lid': lid, 'id': thing.guid, 'epId': self.__agent_id}
+        return self.__request(create)
+
+    def _request_entity_rename(self, lid, new_lid):
+        def rename():
+            thing = self.__thing(lid)
+            self.__space.move_thing(thing, thing.agent_id, new_lid)
+            return E_RENAMED, {'lid': new_lid, 'oldLid': lid, 'id': thing.guid}
+        return self.__request(rename)
+
+    def _request_entity_reassign(self, lid, nepId=None):  # pylint: disable=invalid-name
+        def reassign():
+            thing = self.__thing(lid)
+            self.__space.move_thing(thing, nepId, lid)
+            return E_REASSIGNED, {'lid': lid, 'id': thing.guid, 'epId': nepId}
+        return self.__request(reassign)
+
+    def _request_entity_delete(self, lid):
+        def delete():
+            thing = self.__thing(lid)
+            self.__space.remove_thing(thing)
+            return E_DELETED, {'lid': lid, 'id': thing.guid}
+        return self.__request(delete)
+
+    def _request_entity_list(self, limit=500, offset=0, all_my_agents=False):  # pylint: disable=unused-argument
+        def list_():
+            things = [thing for thing in self.__space.things.values() if thing.agent_id == self.__agent_id]
+            return E_COMPLETE, {'entities': {thing.lid: {'id': thing.guid, 'epId': thing.agent_id,
+                                                         'public': thing.public}
+                                             for thing in things[offset:offset + limit]}}
+        return self.__request(list_)
+
+    def _request_entity_meta_get(self, lid, fmt='n3'):  # pylint: disable=unused-argument
+        def get():
+            thing = self.__thing(lid)
+            return E_COMPLETE, {'meta': thing.meta['raw'] or dict(thing.meta)}
+        return self.__request(get)
+
+    def _request_entity_meta_set(self, lid, meta, fmt='n3'):  # pylint: disable=unused-argument
+        def set_():
+            self.__thing(lid).meta['raw'] = meta
+            return E_COMPLETE, {'lid': lid}
+        return self.__request(set_)
+
+    def _request_meta_update(self, target, changes):
+        """Used by get_meta() (no IoticAgent equivalent, it sets RDF)"""
+        lid, pid, foc = target
+
+        def update():
+            rec = self.__thing(lid) if pid is None else self.__space.point(self.__agent_id, foc, lid, pid)
+            rec.meta.update(changes)
+            return E_COMPLETE, {'lid': lid}
+        return self.__request(update)
+
+    def _request_entity_meta_setpublic(self, lid, public=True):
+        def setpublic():
+            self.__thing(lid).public = bool(public)
+            return E_COMPLETE, {'lid': lid}
+        return self.__request(setpublic)
+
+    @staticmethod
+    def __tag_create(rec, tags, lang):
+        rec.tags.setdefault(lang or 'en', set()).update(tags)
+
+    @staticmethod
+    def __tag_delete(rec, tags, lang):
+        rec.tags.get(lang or 'en', set()).difference_update(tags)
+
+    @staticmethod
+    def __tag_list(rec, limit, offset):
+        tags = sorted((lang, tag) for lang, tags in rec.tags.items() for tag in tags)[offset:offset + limit]
+        result = {}
+        for lang, tag in tags:
+            result.setdefault(lang, []).append(tag)
+        return result
+
+    def _request_entity_tag_create(self, lid, tags, lang=None, delete=False):
+        def create():
+            (self.__tag_delete if delete else self.__tag_create)(self.__thing(lid), tags, lang)
+            return E_COMPLETE, {'lid': lid}
+        return self.__request(create)
+
+    def _request_entity_tag_delete(self, lid, tags, lang=None):
+        return self._request_entity_tag_create(lid, tags, lang, delete=True)
+
+    def _request_entity_tag_list(self, lid, limit=100, offset=0):
+        return self.__request(lambda: (E_COMPLETE, {'tags': self.__tag_list(self.__thing(lid), limit or 100,
+                                                                            offset or 0)}))
+
+    def _request_entity_property_create(self, lid, prop):
+        def create():
+            self.__thing(lid).properties.add(tuple(prop))
+            return E_COMPLETE, {'lid': lid}
+        return self.__request(create)
+
+    def _request_point_create(self, foc, lid, pid, control_cb=None, control_cb_parsed=None):
+        def create():
+            thing = self.__thing(lid)
+            point = thing.points.get((foc, pid))
+            mtype = E_DUPLICATED
+            if point is None:
+                point = thing.points[(foc, pid)] = _PointRec(thing, foc, pid)
+                self.__space.points[point.guid] = point
+                mtype = E_CREATED
+            if foc == R_CONTROL and (control_cb or control_cb_parsed):
+                point.handler = (self, control_cb, control_cb_parsed)
+            return mtype, {'lid': pid, 'entityLid': lid, 'id': point.guid, 'type': foc}
+        return self.__request(create)
+
+    def _request_point_delete(self, foc, lid, pid):
+        def delete():
+            point = self.__space.point(self.__agent_id, foc, lid, pid)
+            self.__space.remove_point(point)
+            return E_DELETED, {'lid': pid, 'entityLid': lid, 'id': point.guid, 'type': foc}
+        return self.__request(delete)
+
+    def _request_point_list_detailed(self, foc, lid, pid):
+        def list_():
+            point = self.__space.point(self.__agent_id, foc, lid, pid)
+            return E_COMPLETE, {'subs': {subid: self.__space.subs[subid].thing.guid for subid in point.subs}}
+        return self.__request(list_)
+
+    def _request_point_share(self, lid, pid, data, mime=None, time=None):
+        def share():
+            point = self.__space.point(self.__agent_id, R_FEED, lid, pid)
+            sample = {'data': data, 'mime': mime, 'time': time or datetime.utcnow()}
+            point.recent.append(sample)
+            for subid in point.subs:
+                sub = self.__space.subs[subid]
+                feeddata = dict(sample, pid=point.guid)
+                self.__space.scheduler.schedule(self.__space.delay(), sub.client._deliver, 'feeddata', feeddata,
+                                                point, sub.callback, sub.callback_parsed)
+            return E_COMPLETE, {'lid': pid, 'entityLid': lid}
+        return self.__request(share)
+
+    def _request_point_tag_create(self, foc, lid, pid, tags, lang=None, delete=False):
+        def create():
+            (self.__tag_delete if delete else self.__tag_create)(self.__space.point(self.__agent_id, foc, lid, pid),
+                                                                 tags, lang)
+            return E_COMPLETE, {'lid': pid, 'entityLid': lid}
+        return self.__request(create)
+
+    def _request_point_tag_delete(self, foc, lid, pid, tags, lang=None):
+        return self._request_point_tag_create(foc, lid, pid, tags, lang, delete=True)
+
+    def _request_point_tag_list(self, foc, lid, pid, limit=100, offset=0):
+        return self.__request(lambda: (E_COMPLETE, {'tags': self.__tag_list(
+            self.__space.point(self.__agent_id, foc, lid, pid), limit or 100, offset or 0)}))
+
+    def _request_point_value_create(self, lid, pid, foc, label, vtype, lang=None, comment=None, unit=None):
+        def create():
+            point = self.__space.point(self.__agent_id, foc, lid, pid)
+            point.values[label] = {'label': label, 'vtype': vtype, 'lang': lang, 'comment': comment, 'unit': unit}
+            return E_COMPLETE, {'lid': pid, 'entityLid': lid}
+        return self.__request(create)
+
+    def _request_point_value_delete(self, lid, pid, foc, label=None, lang=None):  # pylint: disable=unused-argument
+        def delete():
+            point = self.__space.point(self.__agent_id, foc, lid, pid)
+            if label is None:
+                point.values.clear()
+            else:
+                point.values.pop(label, None)
+            return E_COMPLETE, {'lid': pid, 'entityLid': lid}
+        return self.__request(delete)
+
+    def _request_point_value_list(self, lid, pid, foc, limit=500, offset=0):
+        def list_():
+            values = list(self.__space.point(self.__agent_id, foc, lid, pid).values.values())
+            return E_COMPLETE, {'values': [dict(value) for value in values[offset or 0:(offset or 0) + (limit or 500)]]}
+        return self.__request(list_)
+
+    def _request_sub_create(self, lid, foc, gpid, callback=None, callback_parsed=None):
+        def create():
+            thing = self.__thing(lid)
+            point = self.__space.resolve_point(self.__agent_id, gpid)
+            if point.foc != foc:
+                raise IOTUnknown("Unknown %s: %s" % (FOC_NAME[foc], gpid))
+            for subid in point.subs:
+                sub = self.__space.subs[subid]
+                if sub.thing is thing:
+                    sub.callback, sub.callback_parsed = callback, callback_parsed
+                    mtype = E_DUPLICATED
+                    break
+            else:
+                sub = _SubRec(self, thing, point, callback, callback_parsed)
+                self.__space.subs[sub.guid] = sub
+                point.subs.add(sub.guid)
+                mtype = E_CREATED
+                owner = self.__space.clients.get(point.thing.agent_id)
+                if owner is not None:
+                    owner._callback_subscription({'entityLid': point.thing.lid, 'lid': point.pid, 'subId': sub.guid,
+                                                  'type': foc})
+            remote = (RemoteFeed if foc == R_FEED else RemoteControl)(self, sub.guid, point.guid)
+            self.__fire('subscribed', remote)
+            return mtype, {'id': sub.guid, 'entityLid': lid, 'pointId': point.guid, 'type': foc}
+        return self.__request(create)
+
+    def _request_sub_create_local(self, slid, foc, lid, pid, callback=None, callback_parsed=None):
+        return self._request_sub_create(slid, foc, (lid, pid), callback, callback_parsed)
+
+    def _callback_subscription(self, data):
+        self.__fire('subscription', data)
+
+    def _request_sub_delete(self, subid):
+        def delete():
+            self.__space.remove_sub(self.__space.sub(self, subid))
+            return E_DELETED, {'id': subid}
+        return self.__request(delete)
+
+    def _request_sub_list(self, lid, limit=500, offset=0):
+        def list_():
+            thing = self.__thing(lid)
+            subs = [sub for sub in self.__space.subs.values() if sub.thing is thing]
+            return E_COMPLETE, {'subs': {sub.guid: {'type': sub.point.foc, 'id': sub.point.guid}
+                                         for sub in subs[offset or 0:(offset or 0) + (limit or 500)]}}
+        return self.__request(list_)
+
+    def _request_sub_values(self, subid):
+        return self.__request(lambda: (E_COMPLETE, {'values': [dict(value) for value in
+                                                               self.__space.sub(self, subid).point.values.values()]}))
+
+    def _request_sub_recent(self, subid, count=None):  # pylint: disable=redefined-outer-name
+        def recent():
+            samples = list(self.__space.sub(self, subid).point.recent)
+            return E_COMPLETE, {'samples': samples[-count:] if count else samples}
+        return self.__request(recent)
+
+    def _request_sub_ask(self, subid, data, mime=None):
+        return self.__request(self.__controlreq, subid, data, mime, False, None)
+
+    def _request_sub_tell(self, subid, data, timeout, mime=None):
+        self.__check_link()
+        evt = RequestEvent(is_crud=True)
+        self.__count('requests')
+        self.__space.scheduler.schedule(self.__space.delay(), self.__complete, evt, self.__controlreq,
+                                        (subid, data, mime, True, evt))
+        self.__space.scheduler.schedule(timeout, self.__tell_timeout, evt)
+        return evt
+
+    def __controlreq(self, subid, data, mime, confirm, evt):
+        sub = self.__space.sub(self, subid)
+        point = sub.point
+        request_id = _guid()
+        handler = point.handler
+        if handler is None or handler[0].agent_id != point.thing.agent_id:
+            # no callback (or reassigned): owner's catchall
+            handler = (self.__space.clients[point.thing.agent_id], None, None)
+        if confirm:
+            self.__space.tells[request_id] = evt
+        controlreq = {'data': data, 'mime': mime, 'confirm': confirm, 'requestId': request_id, 'subId': subid,
+                      'entityLid': point.thing.lid, 'lid': point.pid}
+        self.__space.scheduler.schedule(self.__space.delay(), handler[0]._deliver, 'controlreq', controlreq, point,
+                                        handler[1], handler[2])
+        # tell completes when confirmed (or timed out)
+        return None if confirm else (E_COMPLETE, {'id': subid})
+
+    def __tell_timeout(self, evt):
+        for request_id, tell in list(self.__space.tells.items()):
+            if tell is evt:
+                del self.__space.tells[request_id]
+                evt._set(True, E_COMPLETE, {'success': False, 'reason': 'timeout'})
+
+    def _request_search(self, text=None, lang=None, location=None, unit=None, limit=100, offset=0,
+                        type_='full', local=None, scope=None):  # pylint: disable=unused-argument
+        def search():
+            results = self.__space.search(text, location, unit, reduced=type_ == 'reduced')
+            keys = list(results)[offset or 0:(offset or 0) + (limit or 100)]
+            return E_COMPLETE, {'result': OrderedDict((key, results[key]) for key in keys)}
+        return self.__request(search)
+
+    def _request_describe(self, guid, lang=None, local=None, scope=None):  # pylint: disable=unused-argument
+        def describe():
+            desc = self.__space.describe(guid)
+            if desc is None:
+                raise IOTUnknown("Unknown guid: %s" % guid)
+            return E_COMPLETE, desc
+        return self.__request(describe)
+
+    # Synchronous API ------------------------------------------------------------------------------------------------
+
+    def create_thing(self, lid):
+        payload = self._wait(self._request_entity_create(lid))
+        return Thing(self, lid, payload['id'])
+
+    def delete_thing(self, lid):
+        self._wait(self._request_entity_delete(lid))
+
+    def list(self, all_my_agents=False, limit=500, offset=0):
+        return self._wait(self._request_entity_list(limit, offset, all_my_agents))['entities']
+
+    def describe(self, guid_or_resource, lang=None, local=None, scope=None):
+        """`Returns` metadata dict or None if not found (or not public)"""
+        guid = getattr(guid_or_resource, 'guid', guid_or_resource)
+        try:
+            return self._wait(self._request_describe(guid, lang, local, scope))
+        except IOTUnknown:
+            return None
+
+    def search(self, text=None, lang=None, location=None, unit=None, limit=50, offset=0, reduced=False, local=None,
+               scope=None):
+        return self._wait(self._request_search(text, lang, location, unit, limit, offset,
+                                               'reduced' if reduced else 'full', local, scope))['result']
+
+    def search_reduced(self, text=None, lang=None, location=None, unit=None, limit=100, offset=0, local=None,
+                       scope=None):
+        return self.search(text, lang, location, unit, limit, offset, reduced=True, local=local, scope=scope)
+
+    def search_located(self, text=None, lang=None, location=None, unit=None, limit=100, offset=0, local=None,
+                       scope=None):
+        results = self.search(text, lang, location, unit, limit, offset, local=local, scope=scope)
+        return {guid: {'label': result['label'], 'long': result['long'], 'lat': result['lat']}
+                for guid, result in results.items()}
+
+
+def install(latency=0.0, jitter=0.0, failure_rate=0.0):
+    """Configure SPACE and replace IOT.Client with FakeClient, including where it has already been imported (e.g.
+    ThingRunner).  See Space.configure() for args.
+    """
+    SPACE.configure(latency, jitter, failure_rate)
+    from IoticAgent import IOT
+    original = IOT.Client
+    try:
+        import IoticAgent.ThingRunner  # noqa pylint: disable=unused-variable
+    except ImportError:
+        pass
+    for module in list(sys.modules.values()):
+        if getattr(module, 'Client', None) is original and module.__name__.startswith('IoticAgent'):
+            module.Client = FakeClient
+    IOT.Client = FakeClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a script (or module) with IOT.Client replaced by FakeClient")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds each request takes")
+    parser.add_argument('--jitter', type=float, default=0.0, help="seconds randomly added to or taken from latency")
+    parser.add_argument('--fail', type=float, default=0.0, help="probability of a request failing")
+    parser.add_argument('-m', dest='module', help="run module as __main__ instead of a script")
+    parser.add_argument('args', nargs=argparse.REMAINDER, help="script and its arguments")
+    args = parser.parse_args()
+    if args.module is None and not args.args:
+        parser.print_usage()
+        return 1
+    install(latency=args.latency, jitter=args.jitter, failure_rate=args.fail)
+    if args.module is not None:
+        sys.argv = [args.module] + args.args
+        runpy.run_module(args.module, run_name='__main__', alter_sys=True)
+    else:
+        sys.argv = args.args
+        sys.path.insert(0, dirname(abspath(args.args[0])))
+        runpy.run_path(args.args[0], run_name='__main__')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+# Copyright (c) 2017 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-application-examples/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Looks up the labels of Things and Points with client.describe() on a pool of worker threads, caching the results
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from threading import Thread
+
+import logging
+logger = logging.getLogger(__name__)
+
+from IoticAgent.Core.compat import PY3, Lock, monotonic
+
+if PY3:
+    from queue import Queue  # pylint: disable=import-error,wrong-import-order
+else:
+    from Queue import Queue  # pylint: disable=import-error,wrong-import-order
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_TTL = 3600
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_RETRIES = 2
+
+# Note: keys of the dict passed to lookup() callbacks
+LABEL = 'label'
+PARENT = 'parent'
+
+
+class Describer(object):
+
+    def __init__(self, client, workers=DEFAULT_WORKERS, ttl=DEFAULT_TTL, cache_size=DEFAULT_CACHE_SIZE,
+                 retries=DEFAULT_RETRIES):
+        """Describes GUIDs with client without blocking the caller.
+
+        `workers` (optional) (int) number of describe() calls made at once
+
+        `ttl` (optional) (float) seconds a GUID's description is cached for
+
+        `cache_size` (optional) (int) maximum number of descriptions cached, least recently used are dropped first
+
+        `retries` (optional) (int) times a GUID is described again (at the back of the queue) if describe() fails
+        """
+        self.__client = client
+        self.__workers = max(1, workers)
+        self.__ttl = ttl
+        self.__cache_size = max(1, cache_size)
+        self.__retries = max(0, retries)
+        self.__lock = Lock()
+        # guid -> (expiry, {'label', 'parent'} or None)
+        self.__cache = OrderedDict()
+        # guid -> list of callbacks waiting for its description
+        self.__inflight = {}
+        self.__queue = Queue()
+        self.__threads = []
+
+    @property
+    def pending(self):
+        """Number of GUIDs queued or being described"""
+        with self.__lock:
+            return len(self.__inflight)
+
+    def start(self):
+        for i in range(self.__workers):
+            thread = Thread(target=self.__worker, name='describe-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self, timeout=None):
+        for _ in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join(timeout=timeout)
+        self.__threads = []
+
+    def lookup(self, guid, callback):
+        """Call callback(guid, desc) with desc a dict of label and parent (the Thing's GUID, if guid is a Point) or
+        None if guid has no public metadata.  Called straight away (on this thread) if the description is cached,
+        otherwise from a worker thread once described.  If describe() fails (retries + 1 times) callback is not called.
+
+        Note: Do not call while holding a lock which callback takes.
+        """
+        with self.__lock:
+            entry = self.__cache.get(guid)
+            if entry is not None and entry[0] <= monotonic():
+                del self.__cache[guid]
+                entry = None
+            if entry is None:
+                callbacks = self.__inflight.get(guid)
+                if callbacks is None:
+                    self.__inflight[guid] = [callback]
+                    self.__queue.put((guid, 0))
+                else:
+                    callbacks.append(callback)
+                return
+            # Note: OrderedDict.move_to_end is PY3 only
+            self.__cache[guid] = self.__cache.pop(guid)
+        callback(guid, entry[1])
+
+    def __worker(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            guid, attempt = item
+            try:
+                desc = self.__client.describe(guid)
+            except Exception as exc:  # pylint: disable=broad-except
+                if attempt < self.__retries:
+                    logger.debug("Failed to describe('%s'), retrying: %s", guid, exc)
+                    self.__queue.put((guid, attempt + 1))
+                    continue
+                logger.warning("Failed to describe('%s'): %s", guid, exc)
+                with self.__lock:
+                    self.__inflight.pop(guid, None)
+                continue
+            if desc is not None:
+                desc = {LABEL: desc['meta']['label'], PARENT: desc['meta'].get('parent')}
+            with self.__lock:
+                self.__cache.pop(guid, None)
+                self.__cache[guid] = (monotonic() + self.__ttl, desc)
+                while len(self.__cache) > self.__cache_size:
+                    self.__cache.popitem(last=False)
+                callbacks = self.__inflight.pop(guid, ())
+            for callback in callbacks:
+                try:
+                    callback(guid, desc)
+                except:
+                    logger.exception("Describe callback for '%s' failed", guid)
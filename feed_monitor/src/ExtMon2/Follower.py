@@ -0,0 +1,95 @@
+# Copyright (c) 2017 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-application-examples/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Follows many feeds at once on (re)connect, retrying those which fail
+"""
+
+from __future__ import unicode_literals
+
+from threading import Thread
+
+import logging
+logger = logging.getLogger(__name__)
+
+from IoticAgent.Core.compat import PY3, Lock, monotonic
+
+if PY3:
+    from queue import Queue, Empty  # pylint: disable=import-error,wrong-import-order
+else:
+    from Queue import Queue, Empty  # pylint: disable=import-error,wrong-import-order
+
+
+DEFAULT_WINDOW = 16
+DEFAULT_RETRIES = 3
+# Seconds before a failed follow is retried, times the number of attempts so far
+RETRY_DELAY = 2
+# Seconds between progress log messages
+PROGRESS_INTERVAL = 10
+
+
+def follow_all(thing, guids, stop, window=DEFAULT_WINDOW, retries=DEFAULT_RETRIES):
+    """Call thing.follow() for every guid, window at once.  A guid whose follow fails is retried (after the others
+    queued so far) up to retries times.  Progress is logged every PROGRESS_INTERVAL seconds.  Returns early if stop
+    (Event) is set.
+
+    `Returns` list of guids which could not be followed
+    """
+    total = len(guids)
+    queue = Queue()
+    for guid in guids:
+        queue.put((guid, 0))
+    lock = Lock()
+    # followed, failed guids
+    followed = [0]
+    failed = []
+
+    def worker():
+        while not stop.is_set():
+            try:
+                guid, attempt = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                thing.follow(guid)
+            except Exception as exc:  # pylint: disable=broad-except
+                if attempt < retries:
+                    delay = RETRY_DELAY * (attempt + 1)
+                    logger.warning("Failed to follow('%s'), retrying in %ds: %s", guid, delay, exc)
+                    # Note: holding up only this worker, the others carry on
+                    stop.wait(delay)
+                    queue.put((guid, attempt + 1))
+                else:
+                    logger.error("Failed to follow('%s') after %d attempts: %s", guid, attempt + 1, exc)
+                    with lock:
+                        failed.append(guid)
+                continue
+            with lock:
+                followed[0] += 1
+
+    start = monotonic()
+    threads = []
+    for i in range(max(1, min(window, total))):
+        thread = Thread(target=worker, name='follow-%d' % i)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(timeout=PROGRESS_INTERVAL)
+            if thread.is_alive():
+                with lock:
+                    logger.info("Following feeds: %d of %d followed, %d failed", followed[0], total, len(failed))
+
+    logger.info("Followed %d of %d feeds in %.1fs, %d failed", followed[0], total, monotonic() - start, len(failed))
+    return failed
@@ -0,0 +1,116 @@
+# Copyright (c) 2017 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-application-examples/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Renders the ExtMon2 status page from a compiled template, re-rendering only the rows which changed
+"""
+
+from __future__ import unicode_literals
+
+from os import chmod, fdopen, remove
+from os.path import split
+from tempfile import mkstemp
+
+import logging
+logger = logging.getLogger(__name__)
+
+from jinja2 import Environment, FileSystemLoader
+
+from IoticAgent.Core.compat import PY3, monotonic
+
+if PY3:
+    from os import replace  # pylint: disable=no-name-in-module,ungrouped-imports
+else:
+    # Note: atomic on POSIX
+    from os import rename as replace  # pylint: disable=ungrouped-imports
+
+
+# Note: used in html template
+NAME = 'name'
+LASTSEEN = 'lastseen'
+CLASS = 'class'
+
+# Template macro rendering one feed's row
+ROW_MACRO = 'row'
+
+# Renders slower than this (seconds) are logged as warnings
+SLOW_RENDER = 1.0
+
+
+class Renderer(object):
+
+    def __init__(self, template, wwwfile):
+        """Renders feeds with the template file template to wwwfile.  Not thread safe.
+
+        The template is compiled once and only reloaded (by jinja2) when the file's modification time changes.  If it
+        defines a macro `row(guid, data)` each feed's row is rendered by it only when the feed's name, class or
+        lastseen has changed and the page gets the rendered rows in `rows` (guid -> html).  Otherwise the whole page
+        is rendered from `feeds` each time.
+        """
+        templatedir, self.__templatefile = split(template)
+        self.__wwwfile = wwwfile
+        self.__env = Environment(loader=FileSystemLoader(templatedir), trim_blocks=True, auto_reload=True)
+        self.__template = None
+        self.__row = None
+        # guid -> ((name, class, lastseen), html)
+        self.__rows = {}
+
+    def __get_template(self):
+        # Note: jinja2 checks the file's mtime and returns the cached template if unchanged
+        template = self.__env.get_template(self.__templatefile)
+        if template is not self.__template:
+            logger.info("Template %s loaded", self.__templatefile)
+            self.__template = template
+            self.__row = getattr(template.make_module({'feeds': {}, 'rows': None}), ROW_MACRO, None)
+            self.__rows = {}
+        return template
+
+    def render(self, feeds):
+        """Render feeds (guid -> dict with at least name, class and lastseen) and write the page"""
+        start = monotonic()
+        template = self.__get_template()
+        rows = None
+        changed = len(feeds)
+        if self.__row is not None:
+            rows = {}
+            changed = 0
+            for guid, data in feeds.items():
+                key = (data[NAME], data[CLASS], data[LASTSEEN])
+                cached = self.__rows.get(guid)
+                if cached is None or cached[0] != key:
+                    cached = self.__rows[guid] = (key, self.__row(guid, data))
+                    changed += 1
+                rows[guid] = cached[1]
+            if len(self.__rows) > len(rows):
+                self.__rows = {guid: self.__rows[guid] for guid in rows}
+        rows_done = monotonic()
+        page = template.render(feeds=feeds, rows=rows)
+        page_done = monotonic()
+        self.__write(page)
+        end = monotonic()
+        logger.log(logging.WARNING if end - start > SLOW_RENDER else logging.DEBUG,
+                   "Rendered %d of %d rows in %.1fms, page in %.1fms, written in %.1fms", changed, len(feeds),
+                   (rows_done - start) * 1000, (page_done - rows_done) * 1000, (end - page_done) * 1000)
+
+    def __write(self, page):
+        """Write page to a temporary file and rename it over wwwfile, so it is never seen half written"""
+        wwwdir, wwwname = split(self.__wwwfile)
+        fd, tmpfile = mkstemp(prefix='.%s.' % wwwname, suffix='.tmp', dir=wwwdir or '.')
+        try:
+            with fdopen(fd, 'w') as f:
+                f.write(page)
+            # Note: mkstemp creates the file readable by its owner only
+            chmod(tmpfile, 0o644)
+            replace(tmpfile, self.__wwwfile)
+        except:
+            remove(tmpfile)
+            raise
@@ -0,0 +1,151 @@
+# Copyright (c) 2017 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-application-examples/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tracks how stale each feed is with a heap of deadlines, so only feeds whose state or last seen text changes are
+looked at
+"""
+
+from __future__ import unicode_literals
+
+from heapq import heappush, heappop
+
+import logging
+logger = logging.getLogger(__name__)
+
+from humanize import naturaltime
+
+from IoticAgent.Core.compat import monotonic
+
+
+# Note: used in html template (as class)
+GREEN = 'green'
+YELLOW = 'yellow'
+RED = 'red'
+
+MINUTE = 60
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+
+def _next_text(age):
+    """`Returns` the age (seconds) at which naturaltime() of age next changes, at the latest.  Half a unit, since
+    newer versions of humanize round minutes and hours rather than truncating them
+    """
+    if age < MINUTE:
+        step = 1
+    elif age < HOUR:
+        step = MINUTE // 2
+    elif age < DAY:
+        step = HOUR // 2
+    else:
+        step = DAY
+    return (age // step + 1) * step
+
+
+class _Feed(object):
+    __slots__ = ('max_age', 'warn_age', 'error_age', 'last_seen', 'seen', 'klass', 'lastseen', 'errored', 'deadline')
+
+    def __init__(self, max_age, warn_age, error_age, now):
+        self.max_age = max_age
+        self.warn_age = warn_age
+        self.error_age = error_age
+        # monotonic time feeddata last arrived (or of add() if not seen)
+        self.last_seen = now
+        self.seen = False
+        self.klass = None
+        self.lastseen = None
+        # error_age has passed (and been logged)
+        self.errored = False
+        # monotonic time state is next updated
+        self.deadline = None
+
+
+class Staleness(object):
+
+    def __init__(self):
+        """Class (GREEN, YELLOW or RED) and last seen text of each feed.  A feed is green until max_age after it was
+        last seen, yellow until warn_age and then red.  A warning is logged once when error_age passes.  Feeds not seen
+        since add() are never green.  Not thread safe.
+
+        Each feed has one deadline, the soonest of its next change of class and of last seen text, held in a heap.  So
+        expire() only looks at feeds whose row changes.
+        """
+        self.__feeds = {}
+        # (deadline, guid), stale entries (deadline no longer the feed's) are skipped
+        self.__heap = []
+
+    def add(self, guid, max_age, warn_age, error_age):
+        """Start tracking guid, not seen yet"""
+        now = monotonic()
+        feed = self.__feeds[guid] = _Feed(max_age, warn_age, error_age, now)
+        self.__update(guid, feed, now)
+
+    def get(self, guid):
+        """`Returns` tuple of class and last seen text of guid"""
+        feed = self.__feeds[guid]
+        return feed.klass, feed.lastseen
+
+    def seen(self, guid):
+        """Feeddata arrived from guid (which must have been added).  `Returns` True if its class or text changed"""
+        now = monotonic()
+        feed = self.__feeds[guid]
+        feed.last_seen = now
+        feed.seen = True
+        feed.errored = False
+        return self.__update(guid, feed, now)
+
+    def expire(self):
+        """Update feeds whose deadline has passed.
+
+        `Returns` set of guids whose class or last seen text changed
+        """
+        now = monotonic()
+        changed = set()
+        heap = self.__heap
+        while heap and heap[0][0] <= now:
+            deadline, guid = heappop(heap)
+            feed = self.__feeds[guid]
+            if feed.deadline != deadline:
+                continue
+            if self.__update(guid, feed, now):
+                changed.add(guid)
+        return changed
+
+    def __update(self, guid, feed, now):
+        """Recompute feed's class and text and schedule its next deadline.  `Returns` True if either changed"""
+        age = now - feed.last_seen
+        if age < feed.max_age and feed.seen:
+            klass, next_class = GREEN, feed.max_age
+        elif age < feed.warn_age:
+            klass, next_class = YELLOW, feed.warn_age
+        else:
+            klass, next_class = RED, feed.error_age if age < feed.error_age else None
+
+        if age >= feed.error_age and not feed.errored:
+            feed.errored = True
+            logger.warning("Feed %s not seen for over %ds", guid, feed.error_age)
+
+        lastseen = naturaltime(age)
+        if not feed.seen:
+            lastseen = "Not seen since restart: " + lastseen
+
+        next_age = _next_text(age)
+        if next_class is not None:
+            next_age = min(next_age, next_class)
+        feed.deadline = feed.last_seen + next_age
+        heappush(self.__heap, (feed.deadline, guid))
+
+        changed = klass != feed.klass or lastseen != feed.lastseen
+        feed.klass = klass
+        feed.lastseen = lastseen
+        return changed
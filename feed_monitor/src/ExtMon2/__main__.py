@@ -25,19 +25,19 @@ logger = logging.getLogger(__name__)
 
 from sys import argv, exit  # pylint: disable=redefined-builtin
 from os import environ, mkdir
-from os.path import exists, isdir, abspath, join, split
+from os.path import exists, isdir, abspath, join
 from threading import Thread
 from functools import partial
-from datetime import datetime
-
-from humanize import naturaltime
-
-from jinja2 import Environment, FileSystemLoader
 
 from IoticAgent import IOT
 from IoticAgent.Core.compat import Event, Lock, monotonic
 
 from .Config import Config
+from .Renderer import Renderer, NAME, LASTSEEN, CLASS
+from .Describer import Describer, LABEL, PARENT, DEFAULT_WORKERS as DEFAULT_DESCRIBE_WORKERS, \
+    DEFAULT_TTL as DEFAULT_DESCRIBE_TTL
+from .Staleness import Staleness
+from .Follower import follow_all, DEFAULT_WINDOW as DEFAULT_FOLLOW_WINDOW, DEFAULT_RETRIES as DEFAULT_FOLLOW_RETRIES
 
 
 EXTMON2 = 'extmon2'
@@ -45,14 +45,14 @@ EXTMON2 = 'extmon2'
 FEEDS = 'FD'
 CHANGED = 'CH'
 LASTCHANGE = 'LC'
+STALENESS = 'ST'
+# guid -> template data, replaced (not modified) when a feed's row changes
+ROWS = 'RW'
 
-LAST_SEEN = 'L_S'
-SEEN = 'SE'
+# False while NAME is a placeholder, waiting for Describer
+NAMED = 'NA'
 
-# Note: used in html template or config
-NAME = 'name'
-LASTSEEN = 'lastseen'
-CLASS = 'class'
+# Note: used in config
 MAX_AGE = 'max_age'
 WARN_AGE = 'warn_age'
 ERROR_AGE = 'error_age'
@@ -61,47 +61,101 @@ ERROR_AGE = 'error_age'
 MINCHANGE = 30
 
 
-def __feeddata(client, stash, stashlock, data):
+def __feeddata(describer, stash, stashlock, data):
+    pid = data['pid']
     with stashlock:
-        if data['pid'] in stash[FEEDS]:
-            logger.debug("Received FEEDATA from %s", data['pid'])
-        else:
-            logger.warning("Got feeddata for unknown GUID: %s", data['pid'])
-            name = "<i>Feed: %s" % data['pid']
-            point_desc = client.describe(data['pid'])
-            if point_desc is not None:
-                name += "<br/>" + point_desc['meta']['label']
-                thing_desc = client.describe(point_desc['meta']['parent'])
-                if thing_desc is not None:
-                    name += "<br/>" + thing_desc['meta']['label']
-            name += "</i>"
-            stash[FEEDS][data['pid']] = {
+        unknown = pid not in stash[FEEDS]
+        if unknown:
+            logger.warning("Got feeddata for unknown GUID: %s", pid)
+            stash[FEEDS][pid] = {
                 MAX_AGE: 600,
                 WARN_AGE: 1200,
                 ERROR_AGE: 2400,
-                NAME: name
+                NAME: __unknown_name(pid),
+                NAMED: False
             }
-        stash[FEEDS][data['pid']][LAST_SEEN] = datetime.utcnow()
-        stash[FEEDS][data['pid']][SEEN] = True
-        stash[CHANGED] = True
+            __add(stash, pid)
+        else:
+            logger.debug("Received FEEDATA from %s", pid)
+        if stash[STALENESS].seen(pid) or unknown:
+            __update_row(stash, pid)
+    if unknown:
+        describer.lookup(pid, partial(__described_unknown, describer, stash, stashlock))
+
+
+def __add(stash, guid):
+    feed = stash[FEEDS][guid]
+    stash[STALENESS].add(guid, feed[MAX_AGE], feed[WARN_AGE], feed[ERROR_AGE])
+    __update_row(stash, guid)
+
+
+def __update_row(stash, guid):
+    """Call with stashlock held"""
+    klass, lastseen = stash[STALENESS].get(guid)
+    stash[ROWS][guid] = {NAME: stash[FEEDS][guid][NAME], CLASS: klass, LASTSEEN: lastseen}
+    stash[CHANGED] = True
+
+
+def __unknown_name(pid, *labels):
+    return "<i>Feed: %s%s</i>" % (pid, ''.join("<br/>" + label for label in labels))
+
+
+def __set_name(stash, stashlock, guid, name):
+    with stashlock:
+        if guid in stash[FEEDS]:
+            stash[FEEDS][guid][NAME] = name
+            stash[FEEDS][guid][NAMED] = True
+            __update_row(stash, guid)
+
+
+def __described_unknown(describer, stash, stashlock, pid, point_desc):
+    """Describer callback naming a feed which was not configured: its GUID and (if public) label and its Thing's"""
+    if point_desc is None:
+        __set_name(stash, stashlock, pid, __unknown_name(pid))
+    elif point_desc[PARENT] is None:
+        __set_name(stash, stashlock, pid, __unknown_name(pid, point_desc[LABEL]))
+    else:
+        def described_parent(_, thing_desc):
+            labels = (point_desc[LABEL],) if thing_desc is None else (point_desc[LABEL], thing_desc[LABEL])
+            __set_name(stash, stashlock, pid, __unknown_name(pid, *labels))
+
+        describer.lookup(point_desc[PARENT], described_parent)
+
+
+def __described(stash, stashlock, guid, desc):
+    """Describer callback naming a configured feed"""
+    __set_name(stash, stashlock, guid, 'No Public Meta GUID: ' + guid if desc is None else desc[LABEL])
+
+
+def __snapshot(stash):
+    """Call with stashlock held.  `Returns` dict of guid -> template data (name, class and lastseen) for every feed
+    if the page needs updating, otherwise None
+    """
+    for guid in stash[STALENESS].expire():
+        __update_row(stash, guid)
+    if not stash[CHANGED] and monotonic() - stash[LASTCHANGE] < MINCHANGE:
+        return None
+    stash[CHANGED] = False
+    stash[LASTCHANGE] = monotonic()
+    return dict(stash[ROWS])
 
 
 def extmon(config, stop):
     stash = {FEEDS: {},
              CHANGED: True,
-             LASTCHANGE: 0}
+             LASTCHANGE: 0,
+             STALENESS: Staleness(),
+             ROWS: {}}
     stashlock = Lock()
 
-    templatedir = split(config.get(EXTMON2, 'template'))[0]
-    templatefile = split(config.get(EXTMON2, 'template'))[1]
-    wwwfile = join(config.get(EXTMON2, 'wwwpath'), 'index.html')
+    renderer = Renderer(config.get(EXTMON2, 'template'), join(config.get(EXTMON2, 'wwwpath'), 'index.html'))
 
     feeds_list = config.get(EXTMON2, 'feeds')
     for feed in feeds_list:
         guid = config.get(feed, 'guid')
         stash[FEEDS][guid] = config.get(feed)
-        stash[FEEDS][guid][SEEN] = False
-        stash[FEEDS][guid][LAST_SEEN] = datetime.utcnow()
+        stash[FEEDS][guid][NAMED] = NAME in stash[FEEDS][guid]
+        stash[FEEDS][guid].setdefault(NAME, 'GUID: ' + guid)
         max_age = stash[FEEDS][guid][MAX_AGE] = int(stash[FEEDS][guid][MAX_AGE])
         if WARN_AGE not in stash[FEEDS][guid]:
             stash[FEEDS][guid][WARN_AGE] = max_age * 2
@@ -111,10 +165,34 @@ def extmon(config, stop):
             stash[FEEDS][guid][ERROR_AGE] = max_age * 3
         else:
             stash[FEEDS][guid][ERROR_AGE] = int(stash[FEEDS][guid][ERROR_AGE])
+        __add(stash, guid)
 
     client = IOT.Client(config=config.get(EXTMON2, 'agent'))
-    client.register_catchall_feeddata(partial(__feeddata, client, stash, stashlock))
+    describer = Describer(client, workers=int(config.get(EXTMON2, 'describe_workers') or DEFAULT_DESCRIBE_WORKERS),
+                          ttl=float(config.get(EXTMON2, 'describe_ttl') or DEFAULT_DESCRIBE_TTL))
+    describer.start()
+    client.register_catchall_feeddata(partial(__feeddata, describer, stash, stashlock))
+
+    follow = partial(follow_all, window=int(config.get(EXTMON2, 'follow_window') or DEFAULT_FOLLOW_WINDOW),
+                     retries=int(config.get(EXTMON2, 'follow_retries') or DEFAULT_FOLLOW_RETRIES))
+
+    try:
+        __run(client, describer, follow, renderer, stash, stashlock, stop)
+    finally:
+        describer.stop()
+        # If this function ends prematurely ensure stop is set!
+        stop.set()
+
+
+def __follow(follow, thing, guids, describer, stop):
+    failed = follow(thing, guids, stop)
+    if failed:
+        logger.error("Could not follow %d of %d feeds, they will show as not seen", len(failed), len(guids))
+    if describer.pending:
+        logger.info("Still looking up %d names", describer.pending)
 
+
+def __run(client, describer, follow, renderer, stash, stashlock, stop):  # pylint: disable=too-many-arguments
     while not stop.is_set():
         with client:
             try:
@@ -125,50 +203,27 @@ def extmon(config, stop):
                 return
 
             with stashlock:
-                for guid in stash[FEEDS]:
-                    try:
-                        thing.follow(guid)
-                    except:
-                        logger.error("Failed to follow('%s').  Giving up.", guid)
-                        stop.set()
-                        return
-                    if NAME not in stash[FEEDS][guid]:
-                        desc = client.describe(guid)
-                        if desc is None:
-                            stash[FEEDS][guid][NAME] = 'No Public Meta GUID: ' + guid
-                        else:
-                            stash[FEEDS][guid][NAME] = desc['meta']['label']
+                guids = list(stash[FEEDS])
+                unnamed = [guid for guid in guids if not stash[FEEDS][guid][NAMED]]
+            # Note: names are looked up while following
+            for guid in unnamed:
+                describer.lookup(guid, partial(__described, stash, stashlock))
+            # Note: the page is rendered (showing feeds as not seen) while following
+            follower = Thread(target=__follow, name='follow', args=(follow, thing, guids, describer, stop))
+            follower.daemon = True
+            follower.start()
 
             while not stop.is_set():
                 with stashlock:
-                    if stash[CHANGED] or monotonic() - stash[LASTCHANGE] >= MINCHANGE:
-                        logger.debug("Stash changed, updating HTML")
-                        nowtime = datetime.utcnow()
-                        stash[LASTCHANGE] = monotonic()
-
-                        for guid in stash[FEEDS]:
-                            delta = nowtime - stash[FEEDS][guid][LAST_SEEN]
-                            delta_secs = delta.total_seconds()
-                            stash[FEEDS][guid][LASTSEEN] = naturaltime(delta_secs)
-
-                            if delta_secs < stash[FEEDS][guid][MAX_AGE] and stash[FEEDS][guid][SEEN]:
-                                stash[FEEDS][guid][CLASS] = 'green'
-                            elif delta_secs < stash[FEEDS][guid][WARN_AGE]:
-                                stash[FEEDS][guid][CLASS] = 'yellow'
-                            else:
-                                stash[FEEDS][guid][CLASS] = 'red'
-
-                            if stash[FEEDS][guid][SEEN] is False:
-                                stash[FEEDS][guid][LASTSEEN] = "Not seen since restart: " + stash[FEEDS][guid][LASTSEEN]
-
-                        j2env = Environment(loader=FileSystemLoader(templatedir), trim_blocks=True)
-                        with open(wwwfile, 'w') as f:
-                            f.write(j2env.get_template(templatefile).render(feeds=stash[FEEDS]))
-
-                        stash[CHANGED] = False
+                    snapshot = __snapshot(stash)
+                if snapshot is not None:
+                    logger.debug("Stash changed, updating HTML")
+                    renderer.render(snapshot)
 
                 stop.wait(timeout=1)
 
+            follower.join()
+
     # If this function ends prematurely ensure stop is set!
     stop.set()
 
@@ -0,0 +1,258 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""aioengine: Runs the MQTT bridge on an asyncio event loop instead of worker threads (Python 3.5+ only)
+
+The paho client's socket is driven by the loop (using paho's socket callbacks, paho-mqtt 1.5+) and each request is a
+coroutine awaiting its IoticAgent RequestEvent, so thousands of requests can be in flight without a thread each.
+Handlers which wait on IoticAgent themselves (marked blocking, see mqtt._blocking()) run in a small thread pool.
+"""
+
+from __future__ import unicode_literals
+
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import socket
+
+import paho.mqtt.client as mqtt
+
+from dispatcher import DEFAULT_WORKERS, DEFAULT_DEVICE_CONCURRENCY, DEFAULT_MAX_PENDING, STATS_TOP
+from supervisor import Backoff
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Seconds between paho loop_misc() calls (keepalive pings, retries)
+MISC_INTERVAL = 1.0
+
+
+async def wait_event(loop, evt, timeout):
+    """Wait (without blocking loop) for IoticAgent RequestEvent evt to be set or timeout seconds.  The event's
+    completion callback is bridged to a future with call_soon_threadsafe.  Events without one are waited on in the
+    loop's default executor.
+    """
+    future = loop.create_future()
+
+    def done():
+        if not future.done():
+            future.set_result(None)
+
+    if hasattr(evt, '_run_on_completion'):
+        # Note: IoticAgent passes the event to its (one) completion function
+        evt._run_on_completion(lambda _evt: loop.call_soon_threadsafe(done))
+        waiter = future
+    elif hasattr(evt, 'wait'):
+        waiter = loop.run_in_executor(None, evt.wait, timeout)
+    else:
+        # Not an event, e.g. the result of IOT.Client.list(), see mqtt._qapi_result()
+        return
+    try:
+        await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        pass
+
+
+class AsyncioHelper(object):
+
+    def __init__(self, loop, mqttclient, backoff=None):
+        """Drives mqttclient's network I/O from loop's readers and writers in place of loop_forever().  Reconnects
+        with backoff (default supervisor.Backoff()) delays
+        """
+        self.__loop = loop
+        self.__client = mqttclient
+        self.__backoff = backoff or Backoff()
+        self.__misc = None
+        mqttclient.on_socket_open = self.__on_socket_open
+        mqttclient.on_socket_close = self.__on_socket_close
+        mqttclient.on_socket_register_write = self.__on_socket_register_write
+        mqttclient.on_socket_unregister_write = self.__on_socket_unregister_write
+
+    def start(self):
+        self.__misc = self.__loop.create_task(self.__misc_loop())
+
+    def stop(self):
+        if self.__misc is not None:
+            self.__misc.cancel()
+            self.__misc = None
+
+    def __on_socket_open(self, client, userdata, sock):
+        # pylint: disable=unused-argument
+        self.__loop.add_reader(sock, client.loop_read)
+
+    def __on_socket_close(self, client, userdata, sock):
+        # pylint: disable=unused-argument
+        self.__loop.remove_reader(sock)
+
+    def __on_socket_register_write(self, client, userdata, sock):
+        # pylint: disable=unused-argument
+        # Note: called from any thread which publishes (e.g. the outbox)
+        self.__loop.call_soon_threadsafe(self.__loop.add_writer, sock, client.loop_write)
+
+    def __on_socket_unregister_write(self, client, userdata, sock):
+        # pylint: disable=unused-argument
+        self.__loop.remove_writer(sock)
+
+    async def __misc_loop(self):
+        while True:
+            delay = MISC_INTERVAL
+            if self.__client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+                # Note: paho private attribute, as in Client.loop_forever()
+                if self.__client._state == mqtt.mqtt_cs_disconnecting:  # pylint: disable=protected-access
+                    self.__loop.stop()
+                    return
+                try:
+                    self.__client.reconnect()
+                    self.__backoff.reset()
+                except (socket.error, OSError) as exc:
+                    delay = self.__backoff.next()
+                    logger.warning("MQTT reconnect failed (%s), retrying in %.1fs", exc, delay)
+            await asyncio.sleep(delay)
+
+
+class AsyncEngine(object):
+
+    def __init__(self, workers=DEFAULT_WORKERS, device_concurrency=DEFAULT_DEVICE_CONCURRENCY,
+                 max_pending=DEFAULT_MAX_PENDING, timeout=10):
+        """Drop-in for dispatcher.Dispatcher which runs requests as coroutines on an asyncio event loop.
+
+        `workers` (optional) (int) number of threads for blocking handlers
+
+        `device_concurrency` (optional) (int) maximum number of requests from one device_id being handled at the
+        same time. Further requests from that device wait (in arrival order) until one completes.
+
+        `max_pending` (optional) (int) maximum number of requests (running or waiting) across all devices.
+
+        `timeout` (optional) (float) seconds to wait on each IoticAgent request
+        """
+        self.__device_concurrency = max(1, device_concurrency)
+        self.__max_pending = max(1, max_pending)
+        self.__timeout = timeout
+        self.__executor = ThreadPoolExecutor(max(1, workers))
+        self.__loop = asyncio.new_event_loop()
+        self.__lock = Lock()
+        # device_id -> [running count, deque of waiting jobs]
+        self.__devices = {}
+        self.__pending = 0
+
+    @property
+    def pending(self):
+        """Number of requests accepted but not yet completed"""
+        with self.__lock:
+            return self.__pending
+
+    def stats(self):
+        """`Returns` dict of pending, devices (with requests pending) and busiest: running and waiting requests of the
+        devices with most waiting
+        """
+        with self.__lock:
+            busiest = sorted(self.__devices.items(), key=lambda item: len(item[1][1]), reverse=True)[:STATS_TOP]
+            return {'pending': self.__pending,
+                    'devices': len(self.__devices),
+                    'busiest': {device_id: {'running': state[0], 'waiting': len(state[1])}
+                                for device_id, state in busiest}}
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        self.__executor.shutdown(wait=timeout is not None)
+
+    def run(self, mqttclient, host, port, backoff=None):
+        """Connect mqttclient and run the event loop until interrupted or mqttclient.disconnect() (replaces connect()
+        and loop_forever()).  The connection is retried with backoff (see AsyncioHelper) if it fails or is lost.
+        """
+        helper = AsyncioHelper(self.__loop, mqttclient, backoff)
+        asyncio.set_event_loop(self.__loop)
+        try:
+            mqttclient.connect(host, port)
+            logger.info("MQTT connected (asyncio).  Press ctrl+c to quit.")
+        except (socket.error, OSError) as exc:
+            logger.warning("MQTT connect to %s:%s failed (%s), retrying", host, port, exc)
+        helper.start()
+        try:
+            self.__loop.run_forever()
+        finally:
+            helper.stop()
+            sock = mqttclient.socket()
+            if sock is not None:
+                self.__loop.remove_reader(sock)
+                self.__loop.remove_writer(sock)
+            # Without the loop paho writes from publish() again, e.g. for shard.disconnect()
+            mqttclient.on_socket_register_write = None
+            mqttclient.on_socket_unregister_write = None
+
+    def submit(self, device_id, job, cost=1):
+        """Schedule job for device_id.  Never blocks, may be called from any thread.
+
+        `job` (mqtt._Job) or any callable, which is run in the thread pool
+
+        `cost` (optional) ignored, as jobs are not queued fairly (see dispatcher.Dispatcher.submit())
+
+        `Returns` False if the request was rejected because too many are already pending
+        """
+        with self.__lock:
+            if self.__pending >= self.__max_pending:
+                return False
+            self.__pending += 1
+            state = self.__devices.get(device_id)
+            if state is None:
+                state = self.__devices[device_id] = [0, deque()]
+            if state[0] >= self.__device_concurrency:
+                state[1].append(job)
+                return True
+            state[0] += 1
+        self.__schedule(device_id, job)
+        return True
+
+    def __schedule(self, device_id, job):
+        self.__loop.call_soon_threadsafe(self.__loop.create_task, self.__run(device_id, job))
+
+    def __done(self, device_id):
+        with self.__lock:
+            self.__pending -= 1
+            state = self.__devices[device_id]
+            if state[1]:
+                job = state[1].popleft()
+            else:
+                job = None
+                state[0] -= 1
+                if state[0] == 0:
+                    del self.__devices[device_id]
+        if job is not None:
+            self.__schedule(device_id, job)
+
+    async def __run(self, device_id, job):
+        loop = self.__loop
+        try:
+            if not hasattr(job, 'start') or job.blocking:
+                await loop.run_in_executor(self.__executor, job)
+                return
+            try:
+                rsp = job.start()
+                if hasattr(rsp, 'evt') and hasattr(rsp, 'result'):
+                    # _Pending from mqtt._qapi_call
+                    await wait_event(loop, rsp.evt, self.__timeout)
+                    rsp = rsp.result()
+                elif callable(rsp):
+                    rsp = await loop.run_in_executor(self.__executor, rsp)
+            except:  # pylint: disable=bare-except
+                job.fail()
+                return
+            job.complete(rsp)
+        except:  # pylint: disable=bare-except
+            logger.exception("AsyncEngine request for %s failed", device_id)
+        finally:
+            self.__done(device_id)
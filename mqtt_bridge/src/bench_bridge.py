@@ -0,0 +1,545 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""bench_bridge: End to end throughput and latency of the bridge against the fake agent (../../fake_agent)
+
+Runs the bridge (mqtt._run) in this process with IOT.Client replaced by FakeClient and, unless --broker is given, paho
+replaced by an in-process broker stand-in.  Drives a mix of requests and inbound feeddata and prints results as JSON.
+EG
+
+    python3 bench_bridge.py --requests 20000 --mix create=1,share=4,list=1 --feeddata 20000 --latency 0.002
+    python3 bench_bridge.py --broker 127.0.0.1:1883 --set workers=16 --label v1.2 --output bench.json
+
+Latency is from the request being published to its rsp/ (or the feeddata being given to the agent's catchall to it
+arriving on feeddata/).  CPU is for the whole process (driver, bridge and fake agent) per message.
+"""
+
+from __future__ import unicode_literals, print_function
+
+import argparse
+import json
+import platform
+import sys
+from itertools import count
+from socket import socketpair
+from os import close, remove
+from os.path import abspath, dirname, join
+from tempfile import mkstemp
+from threading import Thread, Lock, Condition
+from time import process_time, sleep
+
+sys.path.insert(0, join(dirname(abspath(__file__)), '..', '..', 'fake_agent'))
+
+import fakeagent  # noqa pylint: disable=wrong-import-position
+from IoticAgent import IOT  # noqa pylint: disable=wrong-import-position
+from IoticAgent.Core.compat import PY3, monotonic  # noqa pylint: disable=wrong-import-position
+
+if PY3:
+    from queue import Queue, Empty  # pylint: disable=import-error,wrong-import-order
+else:
+    from Queue import Queue, Empty  # pylint: disable=import-error,wrong-import-order
+
+import mqtt  # noqa pylint: disable=wrong-import-position
+
+
+DEVICE = 'bench'
+LID = 'bench'
+PID = 'feed'
+
+# kind -> function(seq) returning (path, payload)
+KINDS = {
+    'create': lambda seq: ('create/entity', {'lid': 'bench%d' % seq}),
+    'share': lambda seq: ('update/point/%s/%s/share' % (LID, PID), {'data': {'seq': seq}}),
+    'list': lambda seq: ('list/entity', {'limit': 10}),
+}
+
+# Seconds to wait for a response during setup
+SETUP_TIMEOUT = 10
+
+
+def _matches(sub, topic):
+    sub_parts = sub.split('/')
+    parts = topic.split('/')
+    for i, part in enumerate(sub_parts):
+        if part == '#':
+            return True
+        if i >= len(parts) or (part != '+' and part != parts[i]):
+            return False
+    return len(sub_parts) == len(parts)
+
+
+class _Message(object):
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class _PublishInfo(object):
+    rc = 0
+
+    def wait_for_publish(self):
+        pass
+
+
+class Broker(object):
+    """In-process stand-in for an MQTT broker: subscriptions (with + and # and $share/group/), retained messages and a
+    delivery thread per client.  No QoS: every message is delivered once.
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        # (client, filter)
+        self.__subs = []
+        # (group, filter) -> list of clients, next index
+        self.__shared = {}
+        self.__retained = {}
+
+    def client(self, *args, **kwargs):  # pylint: disable=unused-argument
+        """Use in place of paho.mqtt.client.Client"""
+        return _LoopbackClient(self)
+
+    def subscribe(self, client, sub):
+        if sub.startswith('$share/'):
+            _, group, sub = sub.split('/', 2)
+            with self.__lock:
+                self.__shared.setdefault((group, sub), [[], 0])[0].append(client)
+        else:
+            with self.__lock:
+                self.__subs.append((client, sub))
+        with self.__lock:
+            retained = [(topic, msg) for topic, msg in self.__retained.items() if _matches(sub, topic)]
+        for _, msg in retained:
+            client.deliver(msg)
+
+    def unsubscribe_all(self, client):
+        with self.__lock:
+            self.__subs = [(other, sub) for other, sub in self.__subs if other is not client]
+            for shared in self.__shared.values():
+                if client in shared[0]:
+                    shared[0].remove(client)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if payload is None:
+            payload = b''
+        elif not isinstance(payload, bytes):
+            payload = payload.encode('utf8') if hasattr(payload, 'encode') else str(payload).encode('utf8')
+        msg = _Message(topic, payload, qos, retain)
+        targets = []
+        with self.__lock:
+            if retain:
+                if payload:
+                    self.__retained[topic] = msg
+                else:
+                    self.__retained.pop(topic, None)
+            for client, sub in self.__subs:
+                if _matches(sub, topic) and client not in targets:
+                    targets.append(client)
+            for (_, sub), shared in self.__shared.items():
+                if shared[0] and _matches(sub, topic):
+                    targets.append(shared[0][shared[1] % len(shared[0])])
+                    shared[1] += 1
+        for client in targets:
+            client.deliver(msg)
+        return _PublishInfo()
+
+
+# paho MQTT_ERR_NO_CONN and mqtt_cs_disconnecting, see aioengine and supervisor
+_ERR_NO_CONN = 4
+_CS_DISCONNECTING = 2
+
+
+class _LoopbackClient(object):
+    """The parts of paho.mqtt.client.Client used by the bridge, connected to a Broker.  With on_socket_open set (see
+    aioengine) messages are read by loop_read() when a socketpair signals them instead of by loop() or loop_forever()
+    """
+
+    def __init__(self, broker):
+        self.__broker = broker
+        self.__inbox = Queue()
+        self.__callbacks = []
+        self.__sockets = None
+        self._state = 0
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_socket_open = None
+        self.on_socket_close = None
+        self.on_socket_register_write = None
+        self.on_socket_unregister_write = None
+
+    def connect(self, *args, **kwargs):  # pylint: disable=unused-argument
+        if self.on_socket_open is not None:
+            self.__sockets = socketpair()
+            self.__sockets[0].setblocking(False)
+            self.on_socket_open(self, None, self.__sockets[0])
+        if self.on_connect is not None:
+            self.on_connect(self, None, {}, 0)
+
+    def socket(self):
+        return self.__sockets and self.__sockets[0]
+
+    def will_set(self, *args, **kwargs):
+        # Only published on unclean disconnects, which the stand-in does not have
+        pass
+
+    def message_callback_add(self, sub, callback):
+        self.__callbacks.append((sub, callback))
+
+    def subscribe(self, topic, qos=0):  # pylint: disable=unused-argument
+        self.__broker.subscribe(self, topic)
+        return 0, 1
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        return self.__broker.publish(topic, payload, qos, retain)
+
+    def deliver(self, msg):
+        self.__inbox.put(msg)
+        if self.__sockets is not None:
+            self.__sockets[1].send(b'm')
+
+    def disconnect(self):
+        self.__broker.unsubscribe_all(self)
+        self._state = _CS_DISCONNECTING
+        self.__inbox.put(None)
+        if self.__sockets is not None:
+            self.__sockets[1].send(b'm')
+
+    def loop(self, timeout=1.0):
+        try:
+            msg = self.__inbox.get(timeout=timeout)
+            while msg is not None:
+                self.__handle(msg)
+                msg = self.__inbox.get_nowait()
+        except Empty:
+            return 0
+        if self.on_disconnect is not None:
+            self.on_disconnect(self, None, 0)
+        return _ERR_NO_CONN
+
+    def loop_misc(self):
+        return _ERR_NO_CONN if self._state == _CS_DISCONNECTING else 0
+
+    def loop_read(self):
+        try:
+            self.__sockets[0].recv(4096)
+        except (IOError, OSError):
+            pass
+        while True:
+            try:
+                msg = self.__inbox.get_nowait()
+            except Empty:
+                return
+            if msg is None:
+                self.on_socket_close(self, None, self.__sockets[0])
+                return
+            self.__handle(msg)
+
+    def loop_write(self):
+        pass
+
+    def loop_forever(self):
+        while True:
+            msg = self.__inbox.get()
+            if msg is None:
+                return
+            self.__handle(msg)
+
+    def __handle(self, msg):
+        for sub, callback in self.__callbacks:
+            if _matches(sub, msg.topic):
+                callback(self, None, msg)
+                return
+        if self.on_message is not None:
+            self.on_message(self, None, msg)
+
+    def loop_start(self):
+        thread = Thread(target=self.loop_forever, name='loopback')
+        thread.daemon = True
+        thread.start()
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def _summary(latencies, errors, elapsed):
+    ordered = sorted(latencies)
+    return {'count': len(ordered),
+            'errors': errors,
+            'per_second': round(len(ordered) / elapsed, 1) if elapsed else None,
+            'latency_ms': {name: None if value is None else round(value * 1000, 3)
+                           for name, value in (('p50', _percentile(ordered, 0.5)),
+                                               ('p99', _percentile(ordered, 0.99)),
+                                               ('p999', _percentile(ordered, 0.999)),
+                                               ('max', ordered[-1] if ordered else None),
+                                               ('mean', sum(ordered) / len(ordered) if ordered else None))}}
+
+
+class Driver(object):
+    """Publishes requests and feeddata and records when their responses arrive"""
+
+    def __init__(self, mqttclient, devices=1):
+        self.__client = mqttclient
+        self.__devices = max(1, devices)
+        self.__cond = Condition()
+        self.__seq = count()
+        # request id -> (kind, sent time)
+        self.__pending = {}
+        # seq -> sent time
+        self.__feeddata = {}
+        self.__responses = {}
+        self.latencies = {}
+        self.errors = {}
+        self.feed_latencies = []
+        mqttclient.on_message = self.__on_message
+        mqttclient.subscribe('ioticlabs/rsp/#', qos=0)
+        mqttclient.subscribe('ioticlabs/feeddata/#', qos=0)
+
+    def __on_message(self, mqttclient, userdata, msg):  # pylint: disable=unused-argument
+        now = monotonic()
+        payload = json.loads(msg.payload.decode('utf8'))
+        if msg.topic.startswith('ioticlabs/feeddata/'):
+            sent = self.__feeddata.pop(payload.get('data', {}).get('seq'), None)
+            if sent is not None:
+                with self.__cond:
+                    self.feed_latencies.append(now - sent)
+            return
+        request_id = msg.topic.rpartition('/')[2]
+        with self.__cond:
+            entry = self.__pending.pop(request_id, None)
+            if entry is None:
+                self.__responses[request_id] = payload
+            else:
+                kind, sent = entry
+                self.latencies.setdefault(kind, []).append(now - sent)
+                if payload.get('code', 500) >= 400:
+                    self.errors[kind] = self.errors.get(kind, 0) + 1
+            self.__cond.notify_all()
+
+    @property
+    def in_flight(self):
+        with self.__cond:
+            return len(self.__pending)
+
+    def request(self, kind, path, payload):
+        seq = next(self.__seq)
+        request_id = 'r%d' % seq
+        with self.__cond:
+            self.__pending[request_id] = (kind, monotonic())
+        self.__client.publish('ioticlabs/req/%s%d/%s/%s' % (DEVICE, seq % self.__devices, request_id, path),
+                              json.dumps(payload))
+
+    def call(self, path, payload=None, timeout=SETUP_TIMEOUT):
+        """Send a request outside of the measurements.  `Returns` the response payload or None on timeout"""
+        request_id = 's%d' % next(self.__seq)
+        self.__client.publish('ioticlabs/req/%s0/%s/%s' % (DEVICE, request_id, path), json.dumps(payload or {}))
+        end = monotonic() + timeout
+        with self.__cond:
+            while request_id not in self.__responses:
+                remaining = end - monotonic()
+                if remaining <= 0:
+                    return None
+                self.__cond.wait(remaining)
+            return self.__responses.pop(request_id)
+
+    def wait(self, window, timeout=None):
+        """Wait until fewer than window requests are in flight.  `Returns` False on timeout"""
+        end = None if timeout is None else monotonic() + timeout
+        with self.__cond:
+            while len(self.__pending) >= window:
+                remaining = None if end is None else end - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.__cond.wait(remaining)
+        return True
+
+    def feeddata(self, agent, pid, seq):
+        self.__feeddata[seq] = monotonic()
+        agent.simulate_feeddata(pid, {'seq': seq})
+
+    def feeddata_outstanding(self):
+        return len(self.__feeddata)
+
+
+def _parse_mix(mix):
+    weights = []
+    for item in mix.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in KINDS:
+            raise ValueError("Unknown request kind %s, choose from %s" % (kind, ', '.join(sorted(KINDS))))
+        weights.extend([kind] * int(weight or 1))
+    return weights
+
+
+def _pace(start, done, rate):
+    """Sleep until done messages are due at rate per second (0 for no limit)"""
+    if rate > 0:
+        delay = start + done / rate - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+
+def _write_config(args):
+    """`Returns` path of a temporary ini for the bridge"""
+    handle, path = mkstemp(suffix='.ini', prefix='bench_bridge')
+    close(handle)
+    host, _, port = (args.broker or '127.0.0.1:1883').partition(':')
+    with open(path, 'w') as f:
+        f.write('[mqtt]\nhost = %s\nport = %s\nlog_level = %s\n' % (host, port or 1883, args.log_level))
+        for setting in args.set:
+            key, _, value = setting.partition('=')
+            f.write('%s = %s\n' % (key.strip(), value.strip()))
+        f.write('\n[agent]\n')
+    return path
+
+
+def run(args):
+    mix = _parse_mix(args.mix)
+    fakeagent.install(latency=args.latency, jitter=args.jitter, failure_rate=args.fail)
+    bridge_clients = []
+    if args.broker:
+        import paho.mqtt.client as paho  # pylint: disable=import-error
+        host, _, port = args.broker.partition(':')
+        new_client = paho.Client
+    else:
+        broker = Broker()
+        new_client = broker.client
+
+    def bridge_client(*a, **kw):
+        client = new_client(*a, **kw)
+        bridge_clients.append(client)
+        return client
+    mqtt.mqtt.Client = bridge_client
+
+    cfg = _write_config(args)
+    config = IOT.Config.Config(fn=cfg)
+    mqtt.setup_logging(level=getattr(mqtt.logging, args.log_level.upper()), queued=True)
+    bridge = Thread(target=mqtt._run, name='bridge', args=(cfg, config))
+    bridge.daemon = True
+    bridge.start()
+
+    driver_client = new_client()
+    if args.broker:
+        driver_client.connect(host, int(port or 1883))
+    else:
+        driver_client.connect()
+    driver = Driver(driver_client, args.devices)
+    driver_client.loop_start()
+
+    try:
+        # Wait for the bridge, then create the entity and feed shared to
+        end = monotonic() + SETUP_TIMEOUT
+        while driver.call('list/stats', timeout=0.5) is None:
+            if monotonic() > end or not bridge.is_alive():
+                raise RuntimeError("Bridge did not start")
+        for path, payload in (('create/entity', {'lid': LID}),
+                              ('create/point/feed', {'lid': LID, 'pid': PID})):
+            rsp = driver.call(path, payload)
+            if rsp is None or rsp['code'] >= 400:
+                raise RuntimeError("Setup request %s failed: %s" % (path, rsp))
+        agent = next(iter(fakeagent.SPACE.clients.values()))
+
+        feeder = None
+        if args.feeddata:
+            def feed():
+                start = monotonic()
+                for seq in range(args.feeddata):
+                    _pace(start, seq, args.feed_rate)
+                    driver.feeddata(agent, 'benchfeed', seq)
+            feeder = Thread(target=feed, name='feeder')
+
+        cpu_start = process_time()
+        start = monotonic()
+        if feeder is not None:
+            feeder.start()
+        for seq in range(args.requests):
+            _pace(start, seq, args.rate)
+            driver.wait(args.concurrency)
+            kind = mix[seq % len(mix)]
+            driver.request(kind, *KINDS[kind](seq))
+        if not driver.wait(1, timeout=args.timeout):
+            print("Timed out waiting for %d responses" % driver.in_flight, file=sys.stderr)
+        if feeder is not None:
+            feeder.join()
+            end = monotonic() + args.timeout
+            while driver.feeddata_outstanding() and monotonic() < end:
+                sleep(0.01)
+        elapsed = monotonic() - start
+        cpu = process_time() - cpu_start
+    finally:
+        for client in bridge_clients:
+            client.disconnect()
+        bridge.join(timeout=mqtt.TIMEOUT)
+        remove(cfg)
+
+    all_latencies = [value for values in driver.latencies.values() for value in values]
+    messages = len(all_latencies) + len(driver.feed_latencies)
+    return {'label': args.label,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'settings': {'requests': args.requests, 'mix': args.mix, 'devices': args.devices,
+                         'concurrency': args.concurrency,
+                         'rate': args.rate, 'feeddata': args.feeddata, 'feed_rate': args.feed_rate,
+                         'latency': args.latency, 'jitter': args.jitter, 'fail': args.fail,
+                         'broker': args.broker or 'loopback', 'set': args.set},
+            'elapsed_s': round(elapsed, 3),
+            'cpu_s': round(cpu, 3),
+            'cpu_us_per_message': round(cpu * 1e6 / messages, 1) if messages else None,
+            'requests': _summary(all_latencies, sum(driver.errors.values()), elapsed),
+            'by_kind': {kind: _summary(values, driver.errors.get(kind, 0), elapsed)
+                        for kind, values in driver.latencies.items()},
+            'feeddata': _summary(driver.feed_latencies, args.feeddata - len(driver.feed_latencies), elapsed),
+            'bridge': mqtt._stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=10000, help="number of requests")
+    parser.add_argument('--mix', default='create=1,share=4,list=1',
+                        help="weights of request kinds: %s" % ', '.join(sorted(KINDS)))
+    parser.add_argument('--devices', type=int, default=8, help="device ids requests are spread over")
+    parser.add_argument('--concurrency', type=int, default=64, help="maximum requests in flight")
+    parser.add_argument('--rate', type=float, default=0, help="requests per second, 0 for as fast as possible")
+    parser.add_argument('--feeddata', type=int, default=0, help="number of inbound feeddata messages")
+    parser.add_argument('--feed-rate', type=float, default=0, help="feeddata per second, 0 for as fast as possible")
+    parser.add_argument('--latency', type=float, default=0.0, help="fake agent seconds per request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="fake agent latency jitter in seconds")
+    parser.add_argument('--fail', type=float, default=0.0, help="fake agent request failure probability")
+    parser.add_argument('--broker', help="host:port of a real broker (needs paho) instead of the stand-in")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="bridge [mqtt] setting")
+    parser.add_argument('--timeout', type=float, default=30, help="seconds to wait for outstanding responses")
+    parser.add_argument('--log-level', default='warning', help="bridge log level")
+    parser.add_argument('--label', help="e.g. version, included in the results")
+    parser.add_argument('--output', help="write JSON results to file instead of stdout")
+    args = parser.parse_args()
+    try:
+        results = run(args)
+    except (ValueError, RuntimeError) as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""bench_router: Compare Router against the previous _get_arg chain for every request topic shape in the wiki
+
+Does not need IoticAgent or a broker.  EG python3 bench_router.py 100000
+"""
+
+from __future__ import unicode_literals, print_function
+
+from sys import argv, exit  # pylint: disable=redefined-builtin
+from timeit import timeit
+
+from router import Router
+
+
+# (verb, path, example topic) for every request in wiki/Home.md
+SHAPES = (
+    ('create', 'entity', 'ioticlabs/req/dev/1/create/entity'),
+    ('update', 'entity/<lid>/rename', 'ioticlabs/req/dev/1/update/entity/fish/rename'),
+    ('update', 'entity/<lid>/reassign', 'ioticlabs/req/dev/1/update/entity/fish/reassign'),
+    ('delete', 'entity/<lid>', 'ioticlabs/req/dev/1/delete/entity/fish'),
+    ('list', 'entity', 'ioticlabs/req/dev/1/list/entity'),
+    ('list', 'entity/all', 'ioticlabs/req/dev/1/list/entity/all'),
+    ('list', 'entity/<lid>/<fmt>/meta', 'ioticlabs/req/dev/1/list/entity/fish/xml/meta'),
+    ('update', 'entity/<lid>/<fmt>/meta', 'ioticlabs/req/dev/1/update/entity/fish/xml/meta'),
+    ('update', 'entity/<lid>/setpublic', 'ioticlabs/req/dev/1/update/entity/fish/setpublic'),
+    ('create', 'entity/<lid>/tag', 'ioticlabs/req/dev/1/create/entity/fish/tag'),
+    ('list', 'entity/<lid>/tag', 'ioticlabs/req/dev/1/list/entity/fish/tag'),
+    ('delete', 'entity/<lid>/tag', 'ioticlabs/req/dev/1/delete/entity/fish/tag'),
+    ('create', 'point/<foc>', 'ioticlabs/req/dev/1/create/point/feed'),
+    ('update', 'point/<lid>/<pid>/share', 'ioticlabs/req/dev/1/update/point/fish/data/share'),
+    ('create', 'point/<foc>/<lid>/<pid>/tag', 'ioticlabs/req/dev/1/create/point/feed/fish/data/tag'),
+    ('list', 'point/<foc>/<lid>/<pid>/tag', 'ioticlabs/req/dev/1/list/point/feed/fish/data/tag'),
+    ('delete', 'point/<foc>/<lid>/<pid>/tag', 'ioticlabs/req/dev/1/delete/point/feed/fish/data/tag'),
+    ('create', 'value/<foc>/<lid>/<pid>', 'ioticlabs/req/dev/1/create/value/feed/fish/data'),
+    ('list', 'value/<foc>/<lid>/<pid>', 'ioticlabs/req/dev/1/list/value/feed/fish/data'),
+    ('delete', 'value/<foc>/<lid>/<pid>/<label>/<lang>', 'ioticlabs/req/dev/1/delete/value/feed/fish/data/col1/en'),
+    ('create', 'sub/<foc>/<lid>', 'ioticlabs/req/dev/1/create/sub/feed/fish'),
+    ('create', 'sub/<foc>/<lid>/<pid>', 'ioticlabs/req/dev/1/create/sub/feed/fish/data'),
+    ('list', 'sub/<lid>', 'ioticlabs/req/dev/1/list/sub/fish'),
+    ('delete', 'sub/<subid>', 'ioticlabs/req/dev/1/delete/sub/0123456789abcdef'),
+    ('create', 'search', 'ioticlabs/req/dev/1/create/search'),
+    ('create', 'describe', 'ioticlabs/req/dev/1/create/describe'),
+)
+
+
+def _get_arg(line, arg):
+    try:
+        return line.split('/')[arg]
+    except:  # pylint: disable=bare-except
+        pass
+
+
+def legacy_route(topic):  # pylint: disable=too-many-branches,too-many-return-statements
+    """The topic checks on_message and the _do_* handlers made before Router, returning the args they extracted.
+    Shapes the old code did not handle still pay for the checks made before giving up.
+    """
+    if topic.startswith("ioticlabs/req/"):
+        device_id = _get_arg(topic, 2)
+        request_id = _get_arg(topic, 3)
+        if device_id is not None and request_id is not None:
+            if _get_arg(topic, 4) == "create":
+                if _get_arg(topic, 5) == "entity":
+                    if _get_arg(topic, 6) is None:
+                        return device_id, request_id
+                    elif _get_arg(topic, 7) == 'tag':
+                        return device_id, request_id, _get_arg(topic, 6)
+                elif _get_arg(topic, 5) == "point":
+                    return device_id, request_id, _get_arg(topic, 6) == "feed" or _get_arg(topic, 6) == "control"
+            elif _get_arg(topic, 4) == "list":
+                if _get_arg(topic, 5) == "entity":
+                    if _get_arg(topic, 6) is None:
+                        return device_id, request_id
+                    elif _get_arg(topic, 6) == 'all' and _get_arg(topic, 7) is None:
+                        return device_id, request_id
+                    elif _get_arg(topic, 8) is None and _get_arg(topic, 7) == 'tag':
+                        return device_id, request_id, _get_arg(topic, 6)
+                    elif _get_arg(topic, 8) == 'meta':
+                        return device_id, request_id, _get_arg(topic, 6), _get_arg(topic, 7)
+            elif _get_arg(topic, 4) == "update":
+                if _get_arg(topic, 5) == "entity":
+                    lid = _get_arg(topic, 6)
+                    if lid is not None:
+                        if _get_arg(topic, 8) == 'meta':
+                            return device_id, request_id, lid, _get_arg(topic, 7)
+                        elif _get_arg(topic, 7) in ('rename', 'reassign', 'setpublic'):
+                            return device_id, request_id, lid
+                elif _get_arg(topic, 5) == 'point':
+                    if _get_arg(topic, 8) == 'share':
+                        return device_id, request_id, _get_arg(topic, 6), _get_arg(topic, 7)
+            elif _get_arg(topic, 4) == "delete":
+                if _get_arg(topic, 5) == "entity":
+                    lid = _get_arg(topic, 6)
+                    if lid is not None:
+                        if _get_arg(topic, 8) is None and _get_arg(topic, 7) == 'tag':
+                            return device_id, request_id, lid
+                        return device_id, request_id, lid
+    return None
+
+
+def main():
+    number = int(argv[1]) if len(argv) > 1 else 20000
+
+    router = Router()
+    for verb, path, _ in SHAPES:
+        router.add(verb, path, path)
+
+    print("%-62s %12s %12s %8s" % ('topic', 'legacy/s', 'router/s', 'ratio'))
+    total_legacy = total_router = 0.0
+    for verb, path, topic in SHAPES:
+        if router.route(topic)[0] != path:
+            print("Router mismatch for %s %s" % (verb, path))
+            return 1
+        legacy = timeit(lambda: legacy_route(topic), number=number)  # pylint: disable=cell-var-from-loop
+        routed = timeit(lambda: router.route(topic), number=number)  # pylint: disable=cell-var-from-loop
+        total_legacy += legacy
+        total_router += routed
+        print("%-62s %12d %12d %7.1fx" % (topic[14:], number / legacy, number / routed, legacy / routed))
+    count = number * len(SHAPES)
+    print("%-62s %12d %12d %7.1fx" % ('all shapes', count / total_legacy, count / total_router,
+                                      total_legacy / total_router))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
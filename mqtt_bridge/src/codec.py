@@ -0,0 +1,159 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""codec: Payload serialisers for the MQTT bridge
+
+json is always available.  fastjson (orjson or ujson), msgpack and cbor (cbor2) are available if the module is
+installed.
+"""
+
+from __future__ import unicode_literals
+
+import json
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+    from datetime import timezone  # pylint: disable=ungrouped-imports
+except ImportError:
+    cbor2 = None
+
+
+def _default(obj):
+    """feeddata time is a datetime"""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("%r is not serialisable" % obj)
+
+
+class JsonCodec(object):
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj, default=_default)
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode('utf8') if isinstance(data, bytes) else data)
+
+
+class OrjsonCodec(object):
+    name = 'fastjson'
+
+    @staticmethod
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(object):
+    name = 'fastjson'
+
+    @staticmethod
+    def dumps(obj):
+        return ujson.dumps(obj, default=_default)
+
+    @staticmethod
+    def loads(data):
+        return ujson.loads(data.decode('utf8') if isinstance(data, bytes) else data)
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+
+    @staticmethod
+    def dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True, default=_default)
+
+    @staticmethod
+    def loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class CborCodec(object):
+    name = 'cbor'
+
+    @staticmethod
+    def dumps(obj):
+        # Note: cbor2 encodes datetimes itself (not via default), naive ones only given a timezone.  feeddata time is
+        # UTC
+        return cbor2.dumps(obj, timezone=timezone.utc)
+
+    @staticmethod
+    def loads(data):
+        return cbor2.loads(data)
+
+
+CODECS = {JsonCodec.name: JsonCodec}
+if orjson is not None:
+    CODECS[OrjsonCodec.name] = OrjsonCodec
+elif ujson is not None:
+    CODECS[UjsonCodec.name] = UjsonCodec
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec
+if cbor2 is not None:
+    CODECS[CborCodec.name] = CborCodec
+
+
+def get_codec(name):
+    """`Returns` the codec called name.  Raises ValueError if unknown or its module is not installed"""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("Codec not available: %s" % name)
+
+
+class CodecSelector(object):
+
+    def __init__(self):
+        """Chooses the codec for a device's requests and responses or for an unsolicited topic.  json unless set.
+        """
+        self.__default = JsonCodec
+        # (prefix, codec)
+        self.__prefixes = []
+        self.__devices = {}
+
+    def set_default(self, name):
+        self.__default = get_codec(name)
+
+    def set_prefix(self, prefix, name):
+        """Use codec name for topics starting with prefix, e.g. `"feeddata/"`"""
+        self.__prefixes.append((prefix, get_codec(name)))
+
+    def set_device(self, device_id, name):
+        self.__devices[device_id] = get_codec(name)
+
+    def for_topic(self, topic):
+        for prefix, codec in self.__prefixes:
+            if topic.startswith(prefix):
+                return codec
+        return self.__default
+
+    def for_device(self, device_id):
+        return self.__devices.get(device_id, self.__default)
@@ -0,0 +1,118 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""controls: Control requests (tells) waiting for a device to confirm them
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from threading import Lock
+
+from IoticAgent.Core.compat import monotonic
+
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_SIZE = 10000
+
+
+class PendingControls(object):
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        """Remembers controlreq callback data by requestId until the tell is confirmed or expires.
+
+        `ttl` (optional) (float) seconds a control request can be confirmed for.  Longer than tell() callers wait is
+        pointless (IoticAgent's default is 10)
+
+        `max_size` (optional) (int) maximum number of control requests remembered, oldest are forgotten first
+        """
+        self.__ttl = ttl
+        self.__max_size = max(1, max_size)
+        self.__lock = Lock()
+        # requestId -> (expiry, time added, data).  In order added, so also of expiry
+        self.__entries = OrderedDict()
+        self.__counts = {'added': 0, 'confirmed': 0, 'expired': 0, 'unknown': 0}
+
+    @property
+    def pending(self):
+        with self.__lock:
+            self.__expire(monotonic())
+            return len(self.__entries)
+
+    def stats(self):
+        """`Returns` dict of pending and counts of control requests added, confirmed, expired (or dropped as too many
+        were pending) and unknown (confirmations of requests not pending)
+        """
+        with self.__lock:
+            self.__expire(monotonic())
+            stats = dict(self.__counts)
+            stats['pending'] = len(self.__entries)
+        return stats
+
+    def holds(self, request_id):
+        """`Returns` True if the control request request_id is pending"""
+        with self.__lock:
+            entry = self.__entries.get(request_id)
+            return entry is not None and entry[0] > monotonic()
+
+    def add(self, data):
+        """Remember controlreq callback data (which needs confirming)"""
+        now = monotonic()
+        with self.__lock:
+            self.__expire(now)
+            self.__entries[data['requestId']] = (now + self.__ttl, now, data)
+            self.__counts['added'] += 1
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+                self.__counts['expired'] += 1
+
+    def take(self, request_id):
+        """Forget the control request request_id, being confirmed.
+
+        `Returns` tuple of (data, seconds since it was added), or None if it is not pending
+        """
+        now = monotonic()
+        with self.__lock:
+            self.__expire(now)
+            entry = self.__entries.pop(request_id, None)
+            if entry is not None and entry[0] <= now:
+                self.__counts['expired'] += 1
+                entry = None
+            if entry is None:
+                self.__counts['unknown'] += 1
+                return None
+            self.__counts['confirmed'] += 1
+        return entry[2], now - entry[1]
+
+    def restore(self, data, seconds):
+        """Put back a control request take() returned (with seconds), e.g. its confirmation could not be sent, so
+        it can be confirmed again until it would have expired
+        """
+        now = monotonic()
+        added = now - seconds
+        with self.__lock:
+            self.__counts['confirmed'] -= 1
+            if added + self.__ttl <= now:
+                self.__counts['expired'] += 1
+                return
+            # Note: out of expiry order, so take() checks expiry too
+            self.__entries[data['requestId']] = (added + self.__ttl, added, data)
+
+    def __expire(self, now):
+        # Note: called with the lock held
+        while self.__entries:
+            expiry = next(iter(self.__entries.values()))[0]
+            if expiry > now:
+                break
+            self.__entries.popitem(last=False)
+            self.__counts['expired'] += 1
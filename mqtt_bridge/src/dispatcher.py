@@ -0,0 +1,183 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""dispatcher: Bounded worker pool for MQTT bridge requests, shared fairly between devices
+"""
+
+from __future__ import unicode_literals
+
+from collections import deque
+from heapq import heappush, heappop
+from threading import Thread, Condition
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_WORKERS = 8
+DEFAULT_DEVICE_CONCURRENCY = 2
+DEFAULT_MAX_PENDING = 1000
+# Devices listed in stats(), most waiting first
+STATS_TOP = 20
+
+
+def parse_weights(value):
+    """`Returns` dict of device_id -> weight from e.g. 'bbq:4, fridge:0.5'.  Raises ValueError"""
+    weights = {}
+    for item in (value or '').replace(',', ' ').split():
+        device_id, _, weight = item.rpartition(':')
+        if not device_id or float(weight) <= 0:
+            raise ValueError('expected <device>:<weight> (weight > 0), got %s' % item)
+        weights[device_id] = float(weight)
+    return weights
+
+
+class _Device(object):
+    __slots__ = ('running', 'waiting', 'finish', 'weight')
+
+    def __init__(self, weight):
+        self.running = 0
+        self.waiting = deque()
+        # virtual finish time of the device's last request queued for a worker
+        self.finish = 0.0
+        self.weight = weight
+
+
+class Dispatcher(object):
+
+    def __init__(self, workers=DEFAULT_WORKERS, device_concurrency=DEFAULT_DEVICE_CONCURRENCY,
+                 max_pending=DEFAULT_MAX_PENDING, weights=None):
+        """Runs request handlers on a pool of worker threads so the paho network loop never waits on IoticAgent.
+
+        Requests ready to run are taken by workers in weighted fair queuing order (start time fair queuing) rather
+        than arrival order, so a device sending many requests gets no more than its share of the workers while other
+        devices have requests waiting.
+
+        `workers` (optional) (int) number of worker threads
+
+        `device_concurrency` (optional) (int) maximum number of requests from one device_id being handled at the
+        same time. Further requests from that device wait (in arrival order) until one completes.
+
+        `max_pending` (optional) (int) maximum number of requests (running or waiting) across all devices.
+
+        `weights` (optional) dict of device_id -> weight (default 1).  A device with weight 2 gets twice the share of
+        workers of one with weight 1 when they are all busy.
+        """
+        self.__workers = max(1, workers)
+        self.__device_concurrency = max(1, device_concurrency)
+        self.__max_pending = max(1, max_pending)
+        self.__weights = weights or {}
+        self.__cond = Condition()
+        # (start tag, sequence, device_id, func) ready for a worker
+        self.__ready = []
+        self.__seq = 0
+        # virtual time: start tag of the request most recently taken by a worker
+        self.__vtime = 0.0
+        # device_id -> _Device, for devices with requests pending
+        self.__devices = {}
+        self.__pending = 0
+        self.__stopping = False
+        self.__threads = []
+
+    @property
+    def pending(self):
+        """Number of requests accepted but not yet completed"""
+        with self.__cond:
+            return self.__pending
+
+    def stats(self):
+        """`Returns` dict of pending, devices (with requests pending) and busiest: running and waiting requests of the
+        devices with most waiting
+        """
+        with self.__cond:
+            busiest = sorted(self.__devices.items(), key=lambda item: len(item[1].waiting), reverse=True)[:STATS_TOP]
+            return {'pending': self.__pending,
+                    'devices': len(self.__devices),
+                    'busiest': {device_id: {'running': device.running, 'waiting': len(device.waiting)}
+                                for device_id, device in busiest}}
+
+    def start(self):
+        with self.__cond:
+            self.__stopping = False
+        for i in range(self.__workers):
+            thread = Thread(target=self.__worker, name='dispatch-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self, timeout=None):
+        with self.__cond:
+            self.__stopping = True
+            self.__cond.notify_all()
+        for thread in self.__threads:
+            thread.join(timeout=timeout)
+        self.__threads = []
+
+    def submit(self, device_id, func, cost=1):
+        """Queue func() to be run for device_id.  Never blocks.
+
+        `cost` (optional) (float) the request's share of work, e.g. the number of sub-requests of a batch.  A request
+        costing 2 uses as much of the device's fair share as two requests
+
+        `Returns` False if the request was rejected because too many are already pending
+        """
+        with self.__cond:
+            if self.__pending >= self.__max_pending:
+                return False
+            self.__pending += 1
+            device = self.__devices.get(device_id)
+            if device is None:
+                device = self.__devices[device_id] = _Device(self.__weights.get(device_id, 1.0))
+            if device.running < self.__device_concurrency:
+                device.running += 1
+                self.__make_ready(device_id, device, func, cost)
+            else:
+                device.waiting.append((func, cost))
+        return True
+
+    def __make_ready(self, device_id, device, func, cost):
+        # Note: called with the lock held.  A device idle for a while starts from the current virtual time so it
+        # cannot bank a share it did not use.
+        start = max(self.__vtime, device.finish)
+        device.finish = start + float(cost) / device.weight
+        self.__seq += 1
+        heappush(self.__ready, (start, self.__seq, device_id, func))
+        self.__cond.notify()
+
+    def __done(self, device_id):
+        with self.__cond:
+            self.__pending -= 1
+            device = self.__devices[device_id]
+            if device.waiting:
+                self.__make_ready(device_id, device, *device.waiting.popleft())
+            else:
+                device.running -= 1
+                if device.running == 0:
+                    del self.__devices[device_id]
+
+    def __worker(self):
+        while True:
+            with self.__cond:
+                while not self.__ready and not self.__stopping:
+                    self.__cond.wait()
+                # Note: requests already ready are still run when stopping
+                if not self.__ready:
+                    break
+                start, _, device_id, func = heappop(self.__ready)
+                self.__vtime = start
+            try:
+                func()
+            except:  # pylint: disable=bare-except
+                logger.exception("Dispatcher request for %s failed", device_id)
+            finally:
+                self.__done(device_id)
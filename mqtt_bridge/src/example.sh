@@ -105,6 +105,21 @@ ${PUB_CALL} -t ioticlabs/req/example/8/update/point/fish/data/share -m "{\"blah\
 ${SUB_CALL} -t ioticlabs/rsp/example/# -C 1
 ${WAIT}
 
+echo -e "\n\n# === ioticlabs/req/example/9/create/point/feed/fish/data/tag {\"tags\": [\"cats\"]}"
+${PUB_CALL} -t ioticlabs/req/example/9/create/point/feed/fish/data/tag -m "{\"tags\": [\"cats\"]}" &
+${SUB_CALL} -t ioticlabs/rsp/example/# -C 1
+${WAIT}
+
+echo -e "\n\n# === ioticlabs/req/example/9/create/value/feed/fish/data {\"label\": \"blah\", \"vtype\": \"integer\"}"
+${PUB_CALL} -t ioticlabs/req/example/9/create/value/feed/fish/data -m "{\"label\": \"blah\", \"vtype\": \"integer\"}" &
+${SUB_CALL} -t ioticlabs/rsp/example/# -C 1
+${WAIT}
+
+echo -e "\n\n# === ioticlabs/req/example/9/list/value/feed/fish/data"
+${PUB_CALL} -t ioticlabs/req/example/9/list/value/feed/fish/data -m " " &
+${SUB_CALL} -t ioticlabs/rsp/example/# -C 1
+${WAIT}
+
 echo -e "\n\n# === ioticlabs/req/example/9/delete/entity/fish"
 ${PUB_CALL} -t ioticlabs/req/example/9/delete/entity/fish -m " " &
 ${SUB_CALL} -t ioticlabs/rsp/example/# -C 1
@@ -0,0 +1,118 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""idempotency: Remembers requests by (device_id, request_id) so duplicates are not sent to IoticAgent again
+
+A request is only a duplicate if its topic and payload are also the same, so a request id can be reused (once the
+earlier request has completed) for a different request.
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+
+from IoticAgent.Core.compat import monotonic
+
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 300
+
+# begin() results
+NEW = 'new'
+PENDING = 'pending'
+DONE = 'done'
+
+
+def request_key(device_id, request_id, topic, payload):
+    """`Returns` the key of a request for RequestCache: its ids, topic and a digest of its (undecoded) payload"""
+    if payload is None:
+        payload = b''
+    elif not isinstance(payload, bytes):
+        payload = payload.encode('utf-8')
+    return device_id, request_id, topic, sha1(payload).digest()
+
+
+class RequestCache(object):
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        """LRU cache of requests in progress and their responses once complete
+
+        `max_size` (optional) (int) maximum number of requests remembered, least recently used are forgotten first
+
+        `ttl` (optional) (float) seconds a response is remembered after the request completes
+        """
+        self.__max_size = max(1, max_size)
+        self.__ttl = ttl
+        self.__lock = Lock()
+        # key -> [expiry time (None while pending), response, number of duplicates waiting]
+        self.__entries = OrderedDict()
+        self.__counts = {'hits': 0, 'attached': 0, 'misses': 0}
+
+    def stats(self):
+        """`Returns` dict of size and counts of hits (duplicates answered from cache), attached (duplicates which
+        waited for the original) and misses (new requests)
+        """
+        with self.__lock:
+            stats = dict(self.__counts)
+            stats['size'] = len(self.__entries)
+        return stats
+
+    def begin(self, key):
+        """Call for each incoming request.
+
+        `Returns` tuple of (NEW, None) if the request should be handled, (PENDING, None) if the same request is in
+        progress (the duplicate is counted by complete()) or (DONE, response) if the same request has completed
+        """
+        now = monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[0] is None:
+                    entry[2] += 1
+                    self.__counts['attached'] += 1
+                    return PENDING, None
+                if entry[0] > now:
+                    self.__entries.move_to_end(key)
+                    self.__counts['hits'] += 1
+                    return DONE, entry[1]
+            self.__counts['misses'] += 1
+            self.__entries[key] = [None, None, 0]
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_size:
+                self.__entries.popitem(last=False)
+        return NEW, None
+
+    def complete(self, key, response, remember=True):
+        """Call when a NEW request has completed.
+
+        `remember` (optional) (bool) False to forget the request, e.g. it failed and may be retried
+
+        `Returns` number of duplicates which arrived while it was in progress
+        """
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return 0
+            if remember:
+                entry[0] = monotonic() + self.__ttl
+                entry[1] = response
+            else:
+                del self.__entries[key]
+            return entry[2]
+
+    def discard(self, key):
+        """Forget a request, e.g. it was rejected without being handled"""
+        with self.__lock:
+            self.__entries.pop(key, None)
@@ -0,0 +1,161 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""journal: On-disk queue of MQTT bridge requests made while the agent link is down, replayed in order once it is up
+
+Requests are kept (as received, topic and payload) in a SQLite database in WAL mode so they survive a bridge restart.
+"""
+
+from __future__ import unicode_literals
+
+import sqlite3
+from threading import Thread, Event, Lock
+
+from IoticAgent.Core.compat import monotonic
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_ROWS = 100000
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+# Replayed requests per second
+DEFAULT_RATE = 50
+
+# Seconds between checks for the link coming back
+POLL_INTERVAL = 1.0
+# Rows read at a time when replaying
+_BATCH = 100
+
+
+class Journal(object):
+
+    def __init__(self, path, connected, replay, max_rows=DEFAULT_MAX_ROWS, max_bytes=DEFAULT_MAX_BYTES,
+                 rate=DEFAULT_RATE):
+        """Journal requests in the database at path (created if it does not exist).
+
+        `connected` (mandatory) function returning True if the agent link is up
+
+        `replay` (mandatory) function(topic, payload) handling a journaled request.  Returns False if it could not be
+        sent (link down again), in which case it is kept and replayed later.
+
+        `max_rows` (optional) (int) maximum requests journaled.  append() fails when full
+
+        `max_bytes` (optional) (int) maximum total payload size journaled
+
+        `rate` (optional) (float) maximum requests replayed per second, 0 for no limit
+        """
+        self.__connected = connected
+        self.__replay = replay
+        self.__max_rows = max(1, max_rows)
+        self.__max_bytes = max_bytes
+        self.__interval = 1.0 / rate if rate > 0 else 0
+        self.__lock = Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        self.__db.execute('CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, '
+                          'payload BLOB)')
+        self.__depth, self.__bytes = self.__db.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) '
+                                                       'FROM journal').fetchone()
+        self.__counts = {'appended': 0, 'replayed': 0, 'rejected': 0}
+        # replayed per second over the last POLL_INTERVAL (or batch)
+        self.__drain_rate = 0.0
+        self.__thread = None
+        self.__stop = Event()
+        if self.__depth:
+            logger.info("Journal has %d requests to replay", self.__depth)
+
+    @property
+    def depth(self):
+        with self.__lock:
+            return self.__depth
+
+    def engaged(self):
+        """`Returns` True if requests should be journaled: the link is down or earlier requests are still to be
+        replayed (so they stay in order)
+        """
+        return self.depth > 0 or not self.__connected()
+
+    def stats(self):
+        """`Returns` dict of depth (requests journaled), bytes, drain_rate (replayed per second recently) and counts
+        of requests appended, replayed and rejected (journal full)
+        """
+        with self.__lock:
+            stats = dict(self.__counts)
+            stats.update(depth=self.__depth, bytes=self.__bytes, drain_rate=round(self.__drain_rate, 1))
+        return stats
+
+    def append(self, topic, payload):
+        """`Returns` False if the journal is full"""
+        if payload is None:
+            payload = b''
+        with self.__lock:
+            if self.__depth >= self.__max_rows or self.__bytes + len(payload) > self.__max_bytes:
+                self.__counts['rejected'] += 1
+                return False
+            self.__db.execute('INSERT INTO journal (topic, payload) VALUES (?, ?)', (topic, memoryview(payload)))
+            self.__depth += 1
+            self.__bytes += len(payload)
+            self.__counts['appended'] += 1
+        return True
+
+    def start(self):
+        self.__stop.clear()
+        self.__thread = Thread(target=self.__run, name='journal')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=timeout)
+            self.__thread = None
+        with self.__lock:
+            self.__db.close()
+
+    def __run(self):
+        while not self.__stop.wait(POLL_INTERVAL):
+            if self.depth:
+                try:
+                    self.__drain()
+                except:  # pylint: disable=bare-except
+                    logger.exception("Journal replay failed")
+            with self.__lock:
+                self.__drain_rate = 0.0
+
+    def __drain(self):
+        """Replay journaled requests in order until none are left, the link is down or stop"""
+        while not self.__stop.is_set() and self.__connected():
+            with self.__lock:
+                rows = self.__db.execute('SELECT seq, topic, payload FROM journal ORDER BY seq LIMIT ?',
+                                         (_BATCH,)).fetchall()
+            if not rows:
+                return
+            logger.info("Replaying %d journaled requests", len(rows))
+            start = monotonic()
+            for i, (seq, topic, payload) in enumerate(rows):
+                if self.__interval:
+                    delay = start + i * self.__interval - monotonic()
+                    if delay > 0 and self.__stop.wait(delay):
+                        return
+                payload = bytes(payload)
+                if not self.__replay(topic, payload):
+                    logger.warning("Agent link down, journal replay paused")
+                    return
+                with self.__lock:
+                    self.__db.execute('DELETE FROM journal WHERE seq = ?', (seq,))
+                    self.__depth -= 1
+                    self.__bytes -= len(payload)
+                    self.__counts['replayed'] += 1
+                    self.__drain_rate = (i + 1) / max(monotonic() - start, 1e-6)
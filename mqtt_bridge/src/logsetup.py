@@ -0,0 +1,126 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""logsetup: Logging for the MQTT bridge
+
+Log records are put on a queue and formatted and written by a listener thread so that threads handling messages only
+pay for creating the record.  Per-message log lines should pass extra=SAMPLE so only one in every sample_rate of them
+is logged.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+from json import dumps
+from threading import Lock
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    # Python 2: log synchronously
+    QueueHandler = QueueListener = None
+
+from IoticAgent.Core.compat import PY3
+
+if PY3:
+    from queue import Queue  # pylint: disable=import-error,wrong-import-order
+else:
+    from Queue import Queue  # pylint: disable=import-error,wrong-import-order
+
+
+FORMAT = '%(asctime)s,%(msecs)03d %(levelname)s [%(name)s] {%(threadName)s} %(message)s'
+
+# extra for per-message log lines which may be sampled
+SAMPLE = {'sample': True}
+
+# LogRecord attributes which are not extras
+_RECORD_ATTRS = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, thread, message, any extras and exc (traceback) if set"""
+
+    def format(self, record):
+        out = {'time': self.formatTime(record),
+               'level': record.levelname,
+               'logger': record.name,
+               'thread': record.threadName,
+               'message': record.getMessage()}
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS:
+                out[key] = value
+        if record.exc_info:
+            out['exc'] = self.formatException(record.exc_info)
+        return dumps(out, default=str)
+
+
+class SampleFilter(logging.Filter):
+
+    def __init__(self, rate):
+        """Passes one in every rate records logged with extra=SAMPLE, per logger and message format.  All other
+        records pass.
+        """
+        super(SampleFilter, self).__init__()
+        self.__rate = max(1, rate)
+        self.__counts = {}
+        self.__lock = Lock()
+
+    def filter(self, record):
+        if self.__rate == 1 or not getattr(record, 'sample', False):
+            return True
+        key = (record.name, record.msg)
+        with self.__lock:
+            count = self.__counts.get(key, 0)
+            self.__counts[key] = count + 1
+        return count % self.__rate == 0
+
+
+if QueueHandler is not None:
+    class _QueueHandler(QueueHandler):
+
+        def prepare(self, record):
+            # Leave formatting (rendering of args) to the listener thread.  Note: args must not be changed after logging
+            return record
+
+
+def setup_logging(level=logging.INFO, structured=False, queued=True, sample_rate=1):
+    """Configure the root logger
+
+    `level` (optional) (int) log level
+
+    `structured` (optional) (bool) log JSON objects (see JsonFormatter) instead of text lines
+
+    `queued` (optional) (bool) format and write records on a listener thread (Python 3 only)
+
+    `sample_rate` (optional) (int) log one in every sample_rate records logged with extra=SAMPLE
+
+    `Returns` the QueueListener (call stop() to flush on exit) or None if not queued
+    """
+    handler = logging.StreamHandler()
+    if structured:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(FORMAT))
+    listener = None
+    if queued and QueueHandler is not None:
+        queue = Queue()
+        listener = QueueListener(queue, handler, respect_handler_level=True)
+        handler = _QueueHandler(queue)
+        listener.start()
+    handler.addFilter(SampleFilter(sample_rate))
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return listener
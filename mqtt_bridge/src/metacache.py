@@ -0,0 +1,104 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""metacache: Read-through cache of list/meta/tag query responses
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from threading import Lock
+
+from IoticAgent.Core.compat import monotonic
+
+
+DEFAULT_MAX_SIZE = 10000
+
+
+class QueryCache(object):
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        """Caches query responses by key for a time-to-live set per kind of query.  Entries belong to a lid (or None
+        for listings of all entities) and are removed by invalidate().
+
+        `max_size` (optional) (int) maximum number of responses cached, least recently used are removed first
+        """
+        self.__max_size = max(1, max_size)
+        self.__lock = Lock()
+        # kind -> seconds
+        self.__ttls = {}
+        # key -> (expiry, lid, response).  key[0] is kind
+        self.__entries = OrderedDict()
+        # lid -> set of keys
+        self.__lids = {}
+        # incremented by invalidate() so responses to queries made before then are not stored
+        self.__generation = 0
+        self.__counts = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def set_ttl(self, kind, ttl):
+        """Cache responses for queries of kind for ttl seconds.  0 (the default for all kinds) to not cache"""
+        self.__ttls[kind] = ttl
+
+    def stats(self):
+        """`Returns` dict of size and counts of hits, misses and invalidations"""
+        with self.__lock:
+            stats = dict(self.__counts)
+            stats['size'] = len(self.__entries)
+        return stats
+
+    def get(self, key):
+        """`Returns` tuple of (response, token).  response is None if not cached, in which case pass token to put()"""
+        if not self.__ttls.get(key[0]):
+            return None, None
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                if entry[0] > monotonic():
+                    self.__entries.move_to_end(key)
+                    self.__counts['hits'] += 1
+                    return entry[2], None
+                self.__remove(key)
+            self.__counts['misses'] += 1
+            return None, self.__generation
+
+    def put(self, key, lid, response, token):
+        """Cache response for key unless there has been an invalidate() since the get() which returned token"""
+        ttl = self.__ttls.get(key[0])
+        if not ttl or token is None:
+            return
+        with self.__lock:
+            if token != self.__generation:
+                return
+            self.__remove(key)
+            self.__entries[key] = (monotonic() + ttl, lid, response)
+            self.__lids.setdefault(lid, set()).add(key)
+            while len(self.__entries) > self.__max_size:
+                self.__remove(next(iter(self.__entries)))
+
+    def invalidate(self, lid):
+        """Remove responses for lid and all listings (lid None)"""
+        with self.__lock:
+            self.__generation += 1
+            self.__counts['invalidations'] += 1
+            for key in self.__lids.pop(lid, ()):
+                del self.__entries[key]
+            for key in self.__lids.pop(None, ()):
+                del self.__entries[key]
+
+    def __remove(self, key):
+        entry = self.__entries.pop(key, None)
+        if entry is not None:
+            keys = self.__lids[entry[1]]
+            keys.discard(key)
+            if not keys:
+                del self.__lids[entry[1]]
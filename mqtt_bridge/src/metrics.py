@@ -0,0 +1,210 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""metrics: Counters, gauges and histograms served in the Prometheus text format
+
+No dependencies.  EG
+
+    REGISTRY = Registry()
+    REQUESTS = REGISTRY.counter('requests_total', 'Requests handled', ('verb',))
+    REQUESTS.inc(('create',))
+    server = serve(REGISTRY, '127.0.0.1', 9100)
+"""
+
+from __future__ import unicode_literals
+
+from bisect import bisect_left
+from threading import Thread, Lock
+
+from IoticAgent.Core.compat import PY3
+
+if PY3:
+    from http.server import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error,wrong-import-order
+else:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # pylint: disable=import-error,wrong-import-order
+
+
+# Seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labels=(), func=None):
+        """func (optional) called when rendered, returns the value or dict of label values tuple -> value"""
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        # label values tuple -> value
+        self._values = {}
+        self.__func = func
+
+    def __collect(self):
+        if self.__func is not None:
+            value = self.__func()
+            with self._lock:
+                self._values = value if isinstance(value, dict) else {(): value}
+
+    def render(self):
+        self.__collect()
+        lines = ['# HELP %s %s' % (self.name, self.doc), '# TYPE %s %s' % (self.name, self.kind)]
+        with self._lock:
+            for values, value in sorted(self._values.items()):
+                lines.extend(self._render_one(values, value))
+        return lines
+
+    def snapshot(self):
+        """`Returns` dict of label values joined by '/' -> value, or the value if the metric has no labels"""
+        self.__collect()
+        with self._lock:
+            if not self.labels:
+                value = self._values.get(())
+                return None if value is None else self._snapshot_one(value)
+            return {'/'.join(str(value) for value in values): self._snapshot_one(value)
+                    for values, value in self._values.items()}
+
+    def _snapshot_one(self, value):  # pylint: disable=no-self-use
+        return value
+
+    def _render_one(self, values, value):
+        return ['%s%s %s' % (self.name, _labels(self.labels, values), repr(float(value)))]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, values=(), amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def get(self, values=()):
+        with self._lock:
+            return self._values.get(values, 0)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, values=()):
+        with self._lock:
+            self._values[values] = value
+
+    def inc(self, values=(), amount=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + amount
+
+    def dec(self, values=(), amount=1):
+        self.inc(values, -amount)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labels)
+        self.__buckets = tuple(sorted(buckets))
+
+    def observe(self, value, values=()):
+        with self._lock:
+            state = self._values.get(values)
+            if state is None:
+                # counts per bucket (last is +Inf), sum
+                state = self._values[values] = [[0] * (len(self.__buckets) + 1), 0.0]
+            state[0][bisect_left(self.__buckets, value)] += 1
+            state[1] += value
+
+    def _render_one(self, values, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.__buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket%s %d' % (self.name, _labels(self.labels, values, 'le="%s"' % le), cumulative))
+        lines.append('%s_sum%s %s' % (self.name, _labels(self.labels, values), repr(total)))
+        lines.append('%s_count%s %d' % (self.name, _labels(self.labels, values), cumulative))
+        return lines
+
+    def _snapshot_one(self, value):
+        return {'count': sum(value[0]), 'sum': value[1]}
+
+
+class Registry(object):
+
+    def __init__(self, prefix=''):
+        """Collection of metrics.  prefix is added to each metric name"""
+        self.__prefix = prefix
+        self.__metrics = []
+
+    def __add(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labels=(), func=None):
+        return self.__add(Counter(self.__prefix + name, doc, labels, func))
+
+    def gauge(self, name, doc, labels=(), func=None):
+        return self.__add(Gauge(self.__prefix + name, doc, labels, func))
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.__add(Histogram(self.__prefix + name, doc, labels, buckets))
+
+    def snapshot(self):
+        """`Returns` dict of metric name -> Metric.snapshot(), e.g. for publishing as JSON"""
+        return {metric.name: metric.snapshot() for metric in self.__metrics}
+
+    def render(self):
+        """`Returns` all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.__metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+def serve(registry, host, port):
+    """Serve registry.render() on http://host:port/metrics from a background thread.  `Returns` the HTTPServer, call
+    shutdown() to stop
+    """
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    thread = Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
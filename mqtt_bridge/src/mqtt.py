@@ -17,22 +17,39 @@
 
 from __future__ import unicode_literals, print_function
 
+from collections import deque
 from functools import partial
+from threading import Thread, Event
 from os import getcwd
 from os.path import exists, join
 from sys import exit
-from json import dumps, loads
 import argparse
-from socket import error as ConnectionRefusedError
 from IoticAgent import IOT
 from IoticAgent import Core as IoticAgentCore
 from IoticAgent.Core.Const import R_FEED, R_CONTROL
+from IoticAgent.Core.compat import monotonic
 from IoticAgent.IOT.Exceptions import LinkException
 import paho.mqtt.client as mqtt
 
+from router import Router
+from dispatcher import Dispatcher, DEFAULT_WORKERS, DEFAULT_DEVICE_CONCURRENCY, DEFAULT_MAX_PENDING, parse_weights
+from outbound import Outbox, DEFAULT_MAX_SIZE
+from codec import CodecSelector, get_codec
+from logsetup import setup_logging, SAMPLE
+from metacache import QueryCache
+from idempotency import RequestCache, request_key, PENDING, DONE, DEFAULT_TTL, \
+    DEFAULT_MAX_SIZE as DEFAULT_REQUEST_CACHE_SIZE
+from metrics import Registry, serve
+from shard import Shard
+from sharepipe import SharePipeline, DROPPED, BLOCK, DEFAULT_SIZE as DEFAULT_SHARE_BUFFER
+from supervisor import Supervisor, MQTT, DEFAULT_INITIAL as DEFAULT_RETRY_INITIAL, \
+    DEFAULT_MAXIMUM as DEFAULT_RETRY_MAX, DEFAULT_RESTART_AFTER
+from journal import Journal, DEFAULT_MAX_ROWS as DEFAULT_JOURNAL_ROWS, DEFAULT_MAX_BYTES as DEFAULT_JOURNAL_BYTES, \
+    DEFAULT_RATE as DEFAULT_JOURNAL_RATE
+from quota import Quotas, parse_limits
+from controls import PendingControls, DEFAULT_TTL as DEFAULT_CONTROL_TTL
+
 import logging
-logging.basicConfig(format='%(asctime)s,%(msecs)03d %(levelname)s [%(name)s] {%(threadName)s} %(message)s',
-                    level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
@@ -43,235 +60,846 @@ DEFAULT_PORT = 1883
 # How long to wait on IoticAgent Events
 TIMEOUT = 10
 
+# Default and maximum number of batch sub-requests in flight at once
+DEFAULT_BATCH_WINDOW = 16
+# Maximum number of sub-requests in one batch
+DEFAULT_BATCH_MAX = 10000
+
+# Chooses the payload codec for each device or unsolicited topic, see main()
+CODECS = CodecSelector()
+# Last topic segment choosing the codec for one request, e.g. /@msgpack
+CODEC_SUFFIX = '@'
+
+# Cached list/meta/tag query responses, see _cached() and _invalidates()
+QUERIES = QueryCache()
+
+# Responses which could not be published while MQTT was disconnected, (topic, payload, codec).  Sent on reconnect
+HELD = deque(maxlen=10000)
+
+# name -> function returning dict of bridge statistics, see list/stats
+STATS = {}
+
+# Served on http://metrics_host:metrics_port/metrics, see _run()
+METRICS = Registry('mqtt_bridge_')
+M_REQUESTS = METRICS.counter('responses_total', 'Responses sent by request verb, noun and code class',
+                             ('verb', 'noun', 'code'))
+M_REQUEST_SECONDS = METRICS.histogram('request_seconds', 'Time from request received to response published',
+                                      ('verb', 'noun'))
+M_WAIT_SECONDS = METRICS.histogram('qapi_wait_seconds', 'Time waiting on IoticAgent request Events', ('verb', 'noun'))
+M_PUBLISH_SECONDS = METRICS.histogram('publish_seconds', 'Time to encode and publish a message', ('topic',))
+M_TIMEOUTS = METRICS.counter('qapi_timeouts_total', 'IoticAgent requests which timed out', ('verb', 'noun'))
+M_RECOVER_SECONDS = METRICS.histogram('link_recover_seconds', 'Time agent and MQTT links were down for', ('link',),
+                                      buckets=(1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0))
+M_CONFIRM_SECONDS = METRICS.histogram('control_confirm_seconds',
+                                      'Time from a control request (tell) received to its device confirming it')
+M_UNSOLICITED = METRICS.counter('unsolicited_total', 'feeddata and controlreq messages received from IoticAgent',
+                                ('topic',))
+
+# Point type topic segment to IoticAgent resource type
+FOC = {'feed': R_FEED, 'control': R_CONTROL}
+
 
-def on_connect(mqttclient, userdata, flags, rcode):
+def on_connect(shard, supervisor, mqttclient, userdata, flags, rcode):
     logger.info("Connected with result code: " + str(rcode))
     logger.debug("%s,%s", str(userdata), str(flags))
-    mqttclient.subscribe("ioticlabs/req/#")
+    if rcode != 0:
+        return
+    mqttclient.subscribe(shard.request_topic)
+    shard.connected(mqttclient)
+    supervisor.up(MQTT)
+    if HELD:
+        logger.info("Sending %d responses held while disconnected", len(HELD))
+    while HELD:
+        try:
+            topic, payload, codec = HELD.popleft()
+        except IndexError:
+            break
+        _mqtt_pub(mqttclient, topic, payload, codec=codec)
 
 
-def _get_arg(line, arg):
-    try:
-        return line.split('/')[arg]
-    except:
-        pass
+def on_disconnect(supervisor, mqttclient, userdata, rcode):
+    # pylint: disable=unused-argument
+    # rcode 0 is a disconnect() call, i.e. shutting down
+    if rcode != 0:
+        supervisor.down(MQTT)
 
 
-def _get_payload(payload):
+def _get_payload(payload, codec):
     try:
-        return loads(payload.decode('utf8'))
+        return codec.loads(payload)
     except:
         pass
 
 
-def _get_limit_offset(payload):
-    limit = offset = None
-    if payload is not None:
-        if 'limit' in payload:
-            limit = payload['limit']
-            if 'offset' in payload:
-                offset = payload['offset']
-    return limit, offset
-
-
 def _get_payload_or_none(payload, key):
-    if payload is not None:
+    if isinstance(payload, dict):
         if key in payload:
             return payload[key]
     return None
 
 
-def _qapi_call(device_id, request_id, mqttclient, func, *args, **kwargs):
-    # pylint: disable=too-many-nested-blocks
+def _malformed(message):
+    return {'code': 400, 'error': 'malformed', 'message': message}
+
+
+def _qapi_call(request, func, *args, **kwargs):
+    """Start IoticAgent request func.  Returns the error response payload if it could not be started, otherwise a
+    _Pending which waits for it to complete and returns the response payload.  See _resolve()
+    """
     try:
         evt = func(*args, **kwargs)
-        try:
-            evt.wait(timeout=TIMEOUT)
-            if evt.is_set():
-                mtype = IoticAgentCore.Const.E_FAILED
-                if evt.success:
-                    mtype = IoticAgentCore.Const.E_COMPLETE
-                payload = evt.payload
-                if evt.is_crud:
-                    for msg in evt._messages:
-                        crud = [IoticAgentCore.Const.E_CREATED,
-                                IoticAgentCore.Const.E_DUPLICATED,
-                                IoticAgentCore.Const.E_RENAMED,
-                                IoticAgentCore.Const.E_DELETED,
-                                IoticAgentCore.Const.E_REASSIGNED]
-                        if msg[IoticAgentCore.Const.M_TYPE] in crud:
-                            mtype = msg[IoticAgentCore.Const.M_TYPE]
-                            payload = msg[IoticAgentCore.Const.M_PAYLOAD]
-                            break
-                code = 200  # sync' request OK
-                if mtype == IoticAgentCore.Const.E_CREATED:
-                    code = 201
-                elif mtype == IoticAgentCore.Const.E_DELETED:
-                    code = 204
-                return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                                 {'code': code,
-                                  IoticAgentCore.Const.M_PAYLOAD: payload,
-                                  IoticAgentCore.Const.M_TYPE: mtype})
-            else:
-                logger.warning("IoticAgent request timeout! %s/%s", device_id, request_id)
-                return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                                 {'code': 500,
-                                  'error': 'timeout',
-                                  'message': 'IoticAgent request timeout'})
-        except AttributeError:
-            # Note: work around for mixing IOT.Client functions with Core.Client functions !!
-            # e.g: IOT.Client_request_entity_list returned empty entities
-            return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                             {'code': 200,
-                              IoticAgentCore.Const.M_PAYLOAD: evt,
-                              IoticAgentCore.Const.M_TYPE: IoticAgentCore.Const.E_COMPLETE})
     except ValueError as exc:
-        return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                         {'code': 400, 'error': 'malformed', 'message': str(exc)})
+        return _malformed(str(exc))
     except LinkException as exc:
         logger.exception("IoticAgent linkerror")
-        return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                         {'code': 500, 'error': 'linkerror', 'message': str(exc)})
+        return {'code': 500, 'error': 'linkerror', 'message': str(exc)}
     except Exception as exc:  # pylint: disable=broad-except
         logger.exception("IoticAgent Exception")
-        return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                         {'code': 500, 'error': 'internal error', 'message': str(exc)})
+        return {'code': 500, 'error': 'internal error', 'message': str(exc)}
+    return _Pending(request, evt)
 
 
-def _mqtt_pub(mqttclient, topic, payload):
-    if payload is not None:
-        payload = dumps(payload)
-    logger.info("_mqtt_pub: %s / %s", 'ioticlabs/' + topic, str(payload))
-    return mqttclient.publish('ioticlabs/' + topic, payload)
+class _Pending(object):
 
+    def __init__(self, request, evt, then=(), get_result=None):
+        """An IoticAgent request in progress.  Call to wait for it and get the response payload.  Or (see aioengine)
+        wait for evt some other way and call result().  get_result(request, evt) makes the response payload
+        (default _qapi_result)
+        """
+        self.request = request
+        self.evt = evt
+        self.__then = then
+        self.__get_result = get_result or _qapi_result
+        self.__started = monotonic()
 
-def _do_create_entity(client, mqttclient, userdata, msg, device_id, request_id, payload):
-    # pylint: disable=unused-argument
-    lang = _get_payload_or_none(payload, 'lang')
-    if _get_arg(msg.topic, 6) is None:
-        if 'lid' in payload:
-            return _qapi_call(device_id, request_id, mqttclient, client._request_entity_create, payload['lid'])
-        else:
-            return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                             {'code': 400,
-                              'error': 'malformed',
-                              'message': 'lid required in payload'})
-    elif _get_arg(msg.topic, 7) == 'tag':
-        if 'tags' in payload:
-            lid = _get_arg(msg.topic, 6)
-            return _qapi_call(device_id, request_id, mqttclient, client._request_entity_tag_create,
-                              lid, payload['tags'], lang=lang)
+    def then(self, func):
+        """`Returns` a _Pending whose result is func(result)"""
+        pending = _Pending(self.request, self.evt, self.__then + (func,), self.__get_result)
+        pending.__started = self.__started
+        return pending
+
+    def __call__(self):
+        try:
+            self.evt.wait(timeout=TIMEOUT)
+        except AttributeError:
+            pass
+        return self.result()
+
+    def result(self):
+        M_WAIT_SECONDS.observe(monotonic() - self.__started, (self.request.verb, self.request.noun))
+        rsp = self.__get_result(self.request, self.evt)
+        for func in self.__then:
+            rsp = func(rsp)
+        return rsp
+
+
+def _qapi_result(request, evt):
+    # pylint: disable=too-many-nested-blocks
+    try:
+        if evt.is_set():
+            mtype = IoticAgentCore.Const.E_FAILED
+            if evt.success:
+                mtype = IoticAgentCore.Const.E_COMPLETE
+            payload = evt.payload
+            if evt.is_crud:
+                for msg in evt._messages:
+                    crud = [IoticAgentCore.Const.E_CREATED,
+                            IoticAgentCore.Const.E_DUPLICATED,
+                            IoticAgentCore.Const.E_RENAMED,
+                            IoticAgentCore.Const.E_DELETED,
+                            IoticAgentCore.Const.E_REASSIGNED]
+                    if msg[IoticAgentCore.Const.M_TYPE] in crud:
+                        mtype = msg[IoticAgentCore.Const.M_TYPE]
+                        payload = msg[IoticAgentCore.Const.M_PAYLOAD]
+                        break
+            code = 200  # sync' request OK
+            if mtype == IoticAgentCore.Const.E_CREATED:
+                code = 201
+            elif mtype == IoticAgentCore.Const.E_DELETED:
+                code = 204
+            return {'code': code,
+                    IoticAgentCore.Const.M_PAYLOAD: payload,
+                    IoticAgentCore.Const.M_TYPE: mtype}
         else:
-            return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                             {'code': 400,
-                              'error': 'malformed',
-                              'message': 'tags list required in payload'})
-    else:
-        return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                         {'code': 400, 'error': 'malformed', 'message': ' '})
+            logger.warning("IoticAgent request timeout! %s/%s", request.device_id, request.request_id)
+            M_TIMEOUTS.inc((request.verb, request.noun))
+            return {'code': 500,
+                    'error': 'timeout',
+                    'message': 'IoticAgent request timeout'}
+    except AttributeError:
+        # Note: work around for mixing IOT.Client functions with Core.Client functions !!
+        # e.g: IOT.Client_request_entity_list returned empty entities
+        return {'code': 200,
+                IoticAgentCore.Const.M_PAYLOAD: evt,
+                IoticAgentCore.Const.M_TYPE: IoticAgentCore.Const.E_COMPLETE}
 
 
-def _do_create_point(client, mqttclient, userdata, msg, device_id, request_id, payload):
-    # pylint: disable=unused-argument
-    foc = None
-    if _get_arg(msg.topic, 6) == "feed":
-        foc = R_FEED
-    elif _get_arg(msg.topic, 6) == "control":
-        foc = R_CONTROL
-    if foc is not None and 'lid' in payload and 'pid' in payload:
-        return _qapi_call(device_id, request_id, mqttclient, client._request_point_create,
-                          R_FEED, payload['lid'], payload['pid'])
+def _resolve(rsp):
+    """Handlers return a response payload or a callable (_Pending from _qapi_call) returning one"""
+    return rsp() if callable(rsp) else rsp
+
+
+def _mqtt_pub(mqttclient, topic, payload, qos=0, codec=None):
+    start = monotonic()
+    if payload is not None:
+        payload = (codec or CODECS.for_topic(topic)).dumps(payload)
+    kind = topic.partition('/')[0]
+    topic = 'ioticlabs/' + topic
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("_mqtt_pub: %s / %s", topic, payload)
     else:
-        return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                         {'code': 400,
-                          'error': 'malformed',
-                          'message': 'lid and pid required in payload'})
+        logger.info("_mqtt_pub: %s", topic, extra=SAMPLE)
+    result = mqttclient.publish(topic, payload, qos=qos)
+    M_PUBLISH_SECONDS.observe(monotonic() - start, (kind,))
+    return result
 
 
-def _do_list_entity(client, mqttclient, userdata, msg, device_id, request_id, payload):
-    # pylint: disable=unused-argument
-    limit, offset = _get_limit_offset(payload)
-    if _get_arg(msg.topic, 6) is None:
-        return _qapi_call(device_id, request_id, mqttclient, client.list)
-    elif _get_arg(msg.topic, 6) == 'all' and _get_arg(msg.topic, 7) is None:
-        return _qapi_call(device_id, request_id, mqttclient, client.list, all_my_agents=True)
-    elif _get_arg(msg.topic, 8) is None and _get_arg(msg.topic, 7) == 'tag':
-        lid = _get_arg(msg.topic, 6)
-        return _qapi_call(device_id, request_id, mqttclient, client._request_entity_tag_list,
-                          lid, limit, offset)
-    elif _get_arg(msg.topic, 8) == 'meta':
-        lid = _get_arg(msg.topic, 6)
-        fmt = _get_arg(msg.topic, 7)
-        return _qapi_call(device_id, request_id, mqttclient, client._request_entity_meta_get, lid, fmt)
-
-
-def _do_update_entity(client, mqttclient, userdata, msg, device_id, request_id, payload):
-    # pylint: disable=unused-argument
-    lid = _get_arg(msg.topic, 6)
-    if lid is not None:
-        if _get_arg(msg.topic, 8) == 'meta':
-            fmt = _get_arg(msg.topic, 7)
-            return _qapi_call(device_id, request_id, mqttclient, client._request_entity_meta_set,
-                              lid, payload['meta'], fmt)
-        elif _get_arg(msg.topic, 7) == 'rename':
-            return _qapi_call(device_id, request_id, mqttclient, client._request_entity_rename,
-                              lid, payload['newlid'])
-        elif _get_arg(msg.topic, 7) == 'reassign':
-            return _qapi_call(device_id, request_id, mqttclient, client._request_entity_reassign,
-                              lid, payload['epId'])
-        elif _get_arg(msg.topic, 7) == 'setpublic':
-            return _qapi_call(device_id, request_id, mqttclient, client._request_entity_meta_setpublic,
-                              lid, public=payload['public'])
+def _respond(mqttclient, request, payload, codec, seq=None):
+    """Publish a response (or page seq of a streamed one, see _Stream).  If MQTT is disconnected it is held (see
+    HELD) and sent on reconnect
+    """
+    topic = 'rsp/%s/%s' % (request.device_id, request.request_id)
+    if seq is None:
+        M_REQUESTS.inc((request.verb, request.noun, '%dxx' % (payload['code'] // 100)))
     else:
-        return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                         {'code': 400,
-                          'error': 'malformed',
-                          'message': 'lid required on topic'})
+        topic += '/%d' % seq
+    result = _mqtt_pub(mqttclient, topic, payload, codec=codec)
+    if getattr(result, 'rc', None) == mqtt.MQTT_ERR_NO_CONN:
+        HELD.append((topic, payload, codec))
+    return result
+
+
+class _Bridge(object):
+
+    def __init__(self, client, requests, quotas, controls, shares=None, share_wait=True, journal=None,
+                 batch_window=DEFAULT_BATCH_WINDOW, batch_max=DEFAULT_BATCH_MAX):
+        """What request handlers use besides the request itself, made by _run() and passed to each handler (see
+        _qapi_handler()) as its first argument.
+
+        `client` (IOT.Client) the IoticAgent client
+        `requests` (RequestCache) requests in progress or completed, by request_key()
+        `quotas` (Quotas) per device request rate limits
+        `controls` (PendingControls) control requests (tells) waiting for their device to confirm
+        `shares` (optional) (SharePipeline) per point share buffers if share_policy is set
+        `share_wait` (optional) (bool) whether share responses wait for IoticAgent by default (otherwise 202 once
+        queued)
+        `journal` (optional) (Journal) requests kept on disk while the agent link is down if journal_path is set
+        `batch_window` (optional) (int) default and maximum number of batch sub-requests in flight at once
+        `batch_max` (optional) (int) maximum number of sub-requests in one batch
+        """
+        self.client = client
+        self.requests = requests
+        self.quotas = quotas
+        self.controls = controls
+        self.shares = shares
+        self.share_wait = share_wait
+        self.journal = journal
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+
+
+def _arg_getter(arg):
+    """See _qapi_handler"""
+    if arg.startswith('<') and arg.endswith('>'):
+        name = arg[1:-1]
+        if name in ('lid', 'pid'):
+            return lambda request, payload: getattr(request, name)
+        elif name == 'foc':
+            return lambda request, payload: FOC.get(request.foc)
+        return lambda request, payload: request.params[name]
+    elif arg.endswith('?'):
+        name = arg[:-1]
+        return lambda request, payload: payload.get(name)
+    return lambda request, payload: payload[arg]
+
+
+def _qapi_handler(method, *args, **kwargs):
+    """Returns a request handler calling IoticAgent client method.  Each of args and kwargs says where that argument
+    comes from: '<lid>', '<pid>', '<foc>' or '<name>' for a topic segment, 'name' for a required payload value or
+    'name?' for an optional payload value.  Missing optional args are None, missing optional kwargs are left out.
+    """
+    required = [arg for arg in list(args) + list(kwargs.values()) if not arg.startswith('<') and not arg.endswith('?')]
+    topic_foc = '<foc>' in args or '<foc>' in kwargs.values()
+    getters = [_arg_getter(arg) for arg in args]
+    kwgetters = [(key, arg[:-1] if arg.endswith('?') else None, _arg_getter(arg))
+                 for key, arg in kwargs.items()]
+
+    def handler(bridge, request, payload):
+        if not isinstance(payload, dict):
+            payload = {}
+        for key in required:
+            if key not in payload:
+                return _malformed('%s required in payload' % key)
+        if topic_foc and request.foc not in FOC:
+            return _malformed('point type must be feed or control')
+        call_kwargs = {}
+        for key, optional, getter in kwgetters:
+            if optional is None or optional in payload:
+                call_kwargs[key] = getter(request, payload)
+        return _qapi_call(request, getattr(bridge.client, method), *[getter(request, payload) for getter in getters],
+                          **call_kwargs)
+
+    return handler
+
+
+def _list_kwargs(payload):
+    """limit and offset for client.list() if in payload"""
+    return {key: payload[key] for key in ('limit', 'offset') if isinstance(payload, dict) and key in payload}
+
+
+def _do_list_entity(bridge, request, payload):
+    return _qapi_call(request, bridge.client.list, **_list_kwargs(payload))
+
+
+def _do_list_entity_all(bridge, request, payload):
+    return _qapi_call(request, bridge.client.list, all_my_agents=True, **_list_kwargs(payload))
+
 
+def _count_entities(payload):
+    return len(payload) if isinstance(payload, dict) else 0
 
-def _do_update_point(client, mqttclient, userdata, msg, device_id, request_id, payload):
+
+def _count_tags(payload):
+    return sum(len(tags) for tags in payload.get('tags', {}).values()) if isinstance(payload, dict) else 0
+
+
+class _Stream(object):
+
+    def __init__(self, bridge, handler, request, payload, count, page, offset, limit):
+        """A list response streamed a page at a time.  bind() (see _Job.start()) and call to page through the listing
+        with handler.  Each page with items is published as it arrives on rsp/<device>/<reqid>/<seq> and the
+        returned response payload (the end marker) says how many pages and items there were.  So however long the
+        listing no more than a page or two of it is in memory.
+        """
+        self.__bridge = bridge
+        self.__handler = handler
+        self.__request = request
+        self.__payload = payload
+        self.__count = count
+        self.__page = page
+        self.__offset = offset
+        self.__limit = limit
+        self.__mqttclient = None
+        self.__codec = None
+
+    def bind(self, mqttclient, codec):
+        self.__mqttclient = mqttclient
+        self.__codec = codec
+
+    def __call__(self):
+        if self.__mqttclient is None:
+            # e.g. a batch sub-request
+            return _malformed('stream not supported here')
+        seq = total = 0
+        offset = self.__offset
+        published = None
+        while self.__limit is None or total < self.__limit:
+            size = self.__page if self.__limit is None else min(self.__page, self.__limit - total)
+            page_payload = dict(self.__payload, limit=size, offset=offset)
+            rsp = _resolve(self.__handler(self.__bridge, self.__request, page_payload))
+            if rsp['code'] != 200 or rsp.get(IoticAgentCore.Const.M_TYPE) != IoticAgentCore.Const.E_COMPLETE:
+                rsp = dict(rsp)
+                rsp['pages'] = seq
+                return rsp
+            items = self.__count(rsp[IoticAgentCore.Const.M_PAYLOAD])
+            if items:
+                # Wait for the previous page to be sent so pages do not pile up in paho
+                _wait_published(published)
+                published = _respond(self.__mqttclient, self.__request, rsp, self.__codec, seq=seq)
+                seq += 1
+                total += items
+                offset += items
+            if items < size:
+                break
+        return {'code': 200,
+                IoticAgentCore.Const.M_PAYLOAD: {'pages': seq, 'count': total},
+                IoticAgentCore.Const.M_TYPE: 'end'}
+
+
+def _wait_published(result):
+    """Wait up to TIMEOUT for paho to send the message of publish() result (if it is queued)"""
+    if result is None or getattr(result, 'rc', None) != mqtt.MQTT_ERR_SUCCESS:
+        return
+    try:
+        result.wait_for_publish(TIMEOUT)
+    except (AttributeError, TypeError, ValueError, RuntimeError):
+        # Not a paho MQTTMessageInfo, paho before 1.6 (no timeout) or the message was not queued
+        pass
+
+
+def _streamed(handler, count, page):
+    """Wrap a list handler (whose payload takes limit and offset) so that with {'stream': true} in the payload the
+    listing is streamed (see _Stream).  count(response payload) gives the number of items in a page.  Optional payload
+    page (default page) is the items per page, offset where to start and limit the most items to list in total.
+    """
+    def streamed(bridge, request, payload):
+        if not (isinstance(payload, dict) and payload.get('stream')):
+            return handler(bridge, request, payload)
+        args = {'page': page, 'offset': 0, 'limit': None}
+        for key in args:
+            value = payload.get(key)
+            if value is None:
+                continue
+            if not isinstance(value, int) or isinstance(value, bool) or value < (1 if key == 'page' else 0):
+                return _malformed('%s must be a%s integer' % (key, ' positive' if key == 'page' else 'n'))
+            args[key] = value
+        payload = {key: value for key, value in payload.items() if key not in ('stream', 'page')}
+        return _Stream(bridge, handler, request, payload, count, **args)
+
+    streamed.blocking = getattr(handler, 'blocking', False)
+    return streamed
+
+
+def _stats():
+    return {name: func() for name, func in STATS.items()}
+
+
+def _do_list_stats(bridge, request, payload):
     # pylint: disable=unused-argument
-    """Note: Payload can be dictionary or dict or {'data': dict or bytes, 'mime': optional, 'time': optional}"""
-    if _get_arg(msg.topic, 8) == 'share':
-        lid = _get_arg(msg.topic, 6)
-        pid = _get_arg(msg.topic, 7)
-        mime = None
-        time = None
-        data = payload
+    return {'code': 200,
+            IoticAgentCore.Const.M_PAYLOAD: _stats(),
+            IoticAgentCore.Const.M_TYPE: IoticAgentCore.Const.E_COMPLETE}
+
+
+def _blocking(handler):
+    """Mark a handler which waits on IoticAgent itself (rather than returning a _Pending), so that the asyncio engine
+    runs it in its thread pool
+    """
+    handler.blocking = True
+    return handler
+
+
+def _held(held):
+    """Mark a handler whose requests refer to something only one shard holds, e.g. a pending control request.  When
+    sharded such requests are handled by the shard for which held(bridge, payload) is True, whichever shard owns the
+    device, and ignored by the others (see on_message())
+    """
+    def mark(handler):
+        handler.held = held
+        return handler
+    return mark
+
+
+def _is_linkerror(rsp):
+    return isinstance(rsp, dict) and rsp.get('error') == 'linkerror'
+
+
+def _cached(kind, handler):
+    """Wrap a query handler so its successful responses are cached in QUERIES (see QueryCache.set_ttl() for kind).
+    Responses are cached per topic args and payload limit/offset.
+    """
+    def cached(bridge, request, payload):
+        if not isinstance(payload, (dict, type(None))) or _get_payload_or_none(payload, 'stream'):
+            # Pages (see _streamed()) and payloads which are not objects are not cached
+            return handler(bridge, request, payload)
+        key = (kind, handler, request.lid, request.pid, request.foc, tuple(sorted(request.params.items())),
+               _get_payload_or_none(payload, 'limit'), _get_payload_or_none(payload, 'offset'))
+        rsp, token = QUERIES.get(key)
+        if rsp is not None:
+            return rsp
+        rsp = handler(bridge, request, payload)
+
+        def store(result):
+            if result['code'] == 200 and result.get(IoticAgentCore.Const.M_TYPE) == IoticAgentCore.Const.E_COMPLETE:
+                QUERIES.put(key, request.lid, result, token)
+            return result
+
+        if isinstance(rsp, _Pending):
+            return rsp.then(store)
+        if callable(rsp):
+            return lambda: store(rsp())
+        return store(rsp)
+
+    cached.blocking = getattr(handler, 'blocking', False)
+    return cached
+
+
+def _invalidates(handler, *payload_keys):
+    """Wrap a write handler so that cached queries for its lid (and payload_keys lids) are invalidated before and
+    after it runs.
+    """
+    def invalidating(bridge, request, payload):
+        lids = set([request.lid])
+        if isinstance(payload, dict):
+            lids.update(payload.get(key) for key in payload_keys)
+
+        def invalidate():
+            for lid in lids:
+                QUERIES.invalidate(lid)
+
+        invalidate()
+        rsp = handler(bridge, request, payload)
+
+        def invalidated(result):
+            invalidate()
+            return result
+
+        if isinstance(rsp, _Pending):
+            return rsp.then(invalidated)
+        if callable(rsp):
+            return lambda: invalidated(rsp())
+        return rsp
+
+    invalidating.blocking = getattr(handler, 'blocking', False)
+    return invalidating
+
+
+def _share_result(request, ticket):
+    """Response payload for a share put in the bridge's shares (see sharepipe.Ticket)"""
+    if ticket.error == DROPPED:
+        return {'code': 503,
+                'error': 'dropped',
+                'message': 'share dropped as newer shares filled the buffer'}
+    elif isinstance(ticket.error, LinkException):
+        return {'code': 500, 'error': 'linkerror', 'message': str(ticket.error)}
+    elif ticket.evt is None:
+        return {'code': 500, 'error': 'internal error', 'message': str(ticket.error)}
+    return _qapi_result(request, ticket.evt)
+
+
+def _pipelined(handler):
+    """Mark a handler which (if the bridge has shares) never waits, so that on_message runs it itself rather than
+    handing it to the dispatcher.  Its _Pending is completed from the ticket's completion callback.
+    """
+    handler.pipelined = True
+    return handler
+
+
+@_pipelined
+def _do_update_point(bridge, request, payload):
+    """Note: Payload can be dictionary or dict or {'data': dict or bytes, 'mime': optional, 'time': optional,
+    'wait': optional}
+
+    If the bridge has shares (share_policy is set) the share is queued for its point.  With wait false (default
+    share_wait) the response is 202 as soon as it is queued rather than once IoticAgent has completed it.
+    """
+    mime = None
+    time = None
+    data = payload
+    wait = bridge.share_wait
+    if isinstance(payload, dict):
         if 'data' in payload:
             data = payload['data']
         if 'mime' in payload:
             mime = payload['mime']
         if 'time' in payload:
             time = payload['time']
-        return _qapi_call(device_id, request_id, mqttclient, client._request_point_share,
-                          lid, pid, data, mime, time)
+        if 'wait' in payload:
+            wait = bool(payload['wait'])
+    if bridge.shares is None:
+        return _qapi_call(request, bridge.client._request_point_share, request.lid, request.pid, data, mime, time)
+    ticket = bridge.shares.put(request.lid, request.pid, data, mime, time)
+    if ticket is None:
+        return {'code': 503,
+                'error': 'busy',
+                'message': 'share buffer full'}
+    if not wait:
+        return {'code': 202,
+                IoticAgentCore.Const.M_PAYLOAD: None,
+                IoticAgentCore.Const.M_TYPE: 'queued'}
+    return _Pending(request, ticket, get_result=_share_result)
 
 
-def _do_delete_entity(client, mqttclient, userdata, msg, device_id, request_id, payload):
-    # pylint: disable=unused-argument
-    lang = _get_payload_or_none(payload, 'lang')
-    lid = _get_arg(msg.topic, 6)
-    if lid is not None:
-        if _get_arg(msg.topic, 8) is None and _get_arg(msg.topic, 7) == 'tag':
-            if 'tags' in payload:
-                return _qapi_call(device_id, request_id, mqttclient, client._request_entity_tag_delete,
-                                  lid, payload['tags'], lang)
-            else:
-                return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                                 {'code': 400,
-                                  'error': 'malformed',
-                                  'message': 'tags list required in payload'})
+@_held(lambda bridge, payload: bridge.controls.holds(_get_payload_or_none(payload, 'requestId')))
+def _do_confirm_control(bridge, request, payload):
+    """Payload {'requestId': from the controlreq message, 'success': optional (default true)}
+
+    Confirms a tell to its caller (as IOT.Client.confirm_tell) if the control request is still pending in the
+    bridge's controls.  If the confirmation cannot be sent the control request stays pending, so the device can retry.
+
+    When sharded the request is answered by the shard whose agent received the control request, and if no shard has
+    it pending (e.g. it expired) by none of them.
+    """
+    request_id = _get_payload_or_none(payload, 'requestId')
+    if request_id is None:
+        return _malformed('requestId required in payload')
+    pending = bridge.controls.take(request_id)
+    if pending is None:
+        return {'code': 410,
+                'error': 'gone',
+                'message': 'control request unknown, expired or already confirmed'}
+    data, seconds = pending
+
+    def confirmed(rsp):
+        if 200 <= rsp['code'] < 300:
+            M_CONFIRM_SECONDS.observe(seconds)
         else:
-            return _qapi_call(device_id, request_id, mqttclient, client._request_entity_delete, lid)
+            bridge.controls.restore(data, seconds)
+        return rsp
+
+    rsp = _qapi_call(request, bridge.client._request_point_confirm_tell, R_CONTROL, data['entityLid'], data['lid'],
+                     bool(payload.get('success', True)), request_id)
+    if isinstance(rsp, _Pending):
+        return rsp.then(confirmed)
+    return confirmed(rsp)
+
+
+def _do_sub_ask(bridge, request, payload):
+    """Payload {'data': dict or bytes, 'mime': optional}"""
+    if not isinstance(payload, dict) or 'data' not in payload:
+        return _malformed('data required in payload')
+    return _qapi_call(request, bridge.client._request_sub_ask, request.params['subid'], payload['data'],
+                      payload.get('mime'))
+
+
+def _do_sub_tell(bridge, request, payload):
+    """Payload {'data': dict or bytes, 'mime': optional, 'timeout': optional}
+
+    timeout is the seconds to wait for the control's owner to confirm the tell, default and at most TIMEOUT (as the
+    response is not waited for longer)
+    """
+    if not isinstance(payload, dict) or 'data' not in payload:
+        return _malformed('data required in payload')
+    timeout = payload.get('timeout', TIMEOUT)
+    if not isinstance(timeout, (int, float)) or timeout <= 0:
+        return _malformed('timeout must be a positive number')
+    return _qapi_call(request, bridge.client._request_sub_tell, request.params['subid'], payload['data'],
+                      min(timeout, TIMEOUT), payload.get('mime'))
+
+
+def _do_batch(bridge, request, payload):
+    """Payload {'requests': [{'path': 'create/entity', 'payload': {'lid': 'fish'}}, ...], 'window': optional}
+
+    Up to window (default and maximum the bridge's batch_window) sub-requests are in flight with IoticAgent at once.
+    Responds with {'code': 200, 'results': [...]} where each result is the response payload the sub-request would get
+    on its own, in the same order as requests.
+    """
+    subs = _get_payload_or_none(payload, 'requests')
+    if not isinstance(subs, list):
+        return _malformed('requests list required in payload')
+    if len(subs) > bridge.batch_max:
+        return _malformed('at most %d requests per batch' % bridge.batch_max)
+    window = _get_payload_or_none(payload, 'window')
+    if window is None:
+        window = bridge.batch_window
+    elif isinstance(window, int):
+        window = max(1, min(window, bridge.batch_window))
     else:
-        return _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                         {'code': 400,
-                          'error': 'malformed',
-                          'message': 'lid required on topic'})
+        return _malformed('window must be an integer')
+
+    results = [None] * len(subs)
+    inflight = deque()
+    for i, sub in enumerate(subs):
+        path = _get_payload_or_none(sub, 'path') if isinstance(sub, dict) else None
+        handler = sub_request = None
+        if path is not None:
+            handler, sub_request = ROUTER.route('ioticlabs/req/%s/%s.%d/%s' % (request.device_id,
+                                                                               request.request_id, i, path))
+        if handler is None or handler is _do_batch:
+            results[i] = _malformed('unknown path')
+            continue
+        if len(inflight) >= window:
+            j, rsp = inflight.popleft()
+            results[j] = _resolve(rsp)
+        inflight.append((i, handler(bridge, sub_request, sub.get('payload'))))
+    while inflight:
+        j, rsp = inflight.popleft()
+        results[j] = _resolve(rsp)
+    return {'code': 200, 'results': results}
+
+
+def _cost(bridge, handler, payload, codec):
+    """`Returns` how many IoticAgent requests a request makes, for rate limits and fair queuing: one per sub-request
+    of a batch (at most the bridge's batch_max), otherwise one
+    """
+    if handler is not _do_batch:
+        return 1
+    subs = _get_payload_or_none(_get_payload(payload, codec), 'requests')
+    return max(1, min(len(subs), bridge.batch_max)) if isinstance(subs, list) else 1
+
+
+# (verb, path, handler) for every request in wiki/Home.md.  See Router.add() for path and _qapi_handler() for args
+ROUTES = (
+    ('create', 'entity', _invalidates(_qapi_handler('_request_entity_create', 'lid'), 'lid')),
+    ('update', 'entity/<lid>/rename', _invalidates(_qapi_handler('_request_entity_rename', '<lid>', 'newlid'),
+                                                   'newlid')),
+    ('update', 'entity/<lid>/reassign', _invalidates(_qapi_handler('_request_entity_reassign', '<lid>', 'epId'))),
+    ('delete', 'entity/<lid>', _invalidates(_qapi_handler('_request_entity_delete', '<lid>'))),
+    ('list', 'entity', _cached('list', _streamed(_blocking(_do_list_entity), _count_entities, 500))),
+    ('list', 'entity/all', _cached('list', _streamed(_blocking(_do_list_entity_all), _count_entities, 500))),
+    ('list', 'entity/<lid>/<fmt>/meta', _cached('meta', _qapi_handler('_request_entity_meta_get', '<lid>', '<fmt>'))),
+    ('update', 'entity/<lid>/<fmt>/meta', _invalidates(_qapi_handler('_request_entity_meta_set', '<lid>', 'meta',
+                                                                     '<fmt>'))),
+    ('update', 'entity/<lid>/setpublic', _invalidates(_qapi_handler('_request_entity_meta_setpublic', '<lid>',
+                                                                    public='public'))),
+    ('create', 'entity/<lid>/tag', _invalidates(_qapi_handler('_request_entity_tag_create', '<lid>', 'tags',
+                                                              lang='lang?'))),
+    ('list', 'entity/<lid>/tag', _cached('tag', _streamed(_qapi_handler('_request_entity_tag_list', '<lid>', 'limit?',
+                                                                        'offset?'), _count_tags, 100))),
+    ('delete', 'entity/<lid>/tag', _invalidates(_qapi_handler('_request_entity_tag_delete', '<lid>', 'tags',
+                                                              'lang?'))),
+    ('create', 'point/<foc>', _invalidates(_qapi_handler('_request_point_create', '<foc>', 'lid', 'pid'), 'lid')),
+    ('create', 'point/<lid>/<pid>/share', _do_update_point),
+    ('update', 'point/<lid>/<pid>/share', _do_update_point),
+    ('create', 'point/<foc>/<lid>/<pid>/tag', _invalidates(_qapi_handler('_request_point_tag_create', '<foc>',
+                                                                         '<lid>', '<pid>', 'tags', 'lang?'))),
+    ('list', 'point/<foc>/<lid>/<pid>/tag', _cached('tag', _streamed(_qapi_handler('_request_point_tag_list', '<foc>',
+                                                                                   '<lid>', '<pid>', 'limit?',
+                                                                                   'offset?'), _count_tags, 100))),
+    ('delete', 'point/<foc>/<lid>/<pid>/tag', _invalidates(_qapi_handler('_request_point_tag_delete', '<foc>',
+                                                                         '<lid>', '<pid>', 'tags', 'lang?'))),
+    ('create', 'value/<foc>/<lid>/<pid>', _qapi_handler('_request_point_value_create', '<lid>', '<pid>', '<foc>',
+                                                        'label', 'vtype', 'lang?', 'comment?', 'unit?')),
+    ('list', 'value/<foc>/<lid>/<pid>', _qapi_handler('_request_point_value_list', '<lid>', '<pid>', '<foc>',
+                                                      'limit?', 'offset?')),
+    ('delete', 'value/<foc>/<lid>/<pid>/<label>/<lang>', _qapi_handler('_request_point_value_delete', '<lid>',
+                                                                       '<pid>', '<foc>', '<label>', '<lang>')),
+    ('create', 'sub/<foc>/<lid>', _qapi_handler('_request_sub_create', '<lid>', '<foc>', 'gpid')),
+    ('create', 'sub/<foc>/<lid>/<pid>', _qapi_handler('_request_sub_create_local', 'slid', '<foc>', '<lid>', '<pid>')),
+    ('list', 'sub/<lid>', _qapi_handler('_request_sub_list', '<lid>', 'limit?', 'offset?')),
+    ('delete', 'sub/<subid>', _qapi_handler('_request_sub_delete', '<subid>')),
+    ('create', 'sub/ask/<subid>', _do_sub_ask),
+    ('create', 'sub/tell/<subid>', _do_sub_tell),
+    ('create', 'search', _qapi_handler('_request_search', text='text?', lang='lang?', location='location?',
+                                       unit='unit?', limit='limit?', offset='offset?')),
+    ('create', 'describe', _qapi_handler('_request_describe', 'guid')),
+    ('batch', '', _blocking(_do_batch)),
+    ('list', 'stats', _do_list_stats),
+    ('confirm', 'control', _do_confirm_control),
+)
+
+# (verb, path) of requests which are journaled (see journal.Journal) rather than failed while the agent link is down
+JOURNALED = frozenset((('create', 'entity'), ('create', 'entity/<lid>/tag'), ('create', 'point/<foc>'),
+                       ('create', 'point/<lid>/<pid>/share'), ('update', 'point/<lid>/<pid>/share'),
+                       ('create', 'point/<foc>/<lid>/<pid>/tag'), ('create', 'value/<foc>/<lid>/<pid>'),
+                       ('create', 'sub/<foc>/<lid>'), ('create', 'sub/<foc>/<lid>/<pid>')))
+
+ROUTER = Router()
+for _verb, _path, _handler in ROUTES:
+    ROUTER.add(_verb, _path, _handler)
+    if (_verb, _path) in JOURNALED:
+        _handler.journaled = True
+
+
+class _Job(object):
+
+    def __init__(self, bridge, mqttclient, handler, request, payload, codec, received, topic):
+        """A request handed to the dispatcher.  Call to handle it.  Or (see aioengine) call start() and then
+        complete() with the resolved response payload, or fail() if that raises.  topic and (undecoded) payload are
+        as received, for the bridge's journal
+        """
+        self.__bridge = bridge
+        self.__mqttclient = mqttclient
+        self.__handler = handler
+        self.request = request
+        self.__payload = payload
+        self.__codec = codec
+        self.__received = received
+        self.__topic = topic
+
+    @property
+    def blocking(self):
+        """True if the handler itself waits on IoticAgent (see _blocking())"""
+        return getattr(self.__handler, 'blocking', False)
+
+    @property
+    def journaled(self):
+        """True if the request should be journaled when the agent link is down (see JOURNALED)"""
+        return self.__bridge.journal is not None and getattr(self.__handler, 'journaled', False)
+
+    def start(self, journal=True):
+        """`Returns` the handler's response payload or callable (see _resolve()).  If the agent link is down the
+        request is journaled (unless journal is False)
+        """
+        rsp = self.__handler(self.__bridge, self.request, _get_payload(self.__payload, self.__codec))
+        if isinstance(rsp, _Stream):
+            rsp.bind(self.__mqttclient, self.__codec)
+        if journal:
+            rsp = self.__journal_linkerror(rsp)
+        return rsp
+
+    def __journal_linkerror(self, rsp):
+        """`Returns` journal() if rsp is a linkerror and the request should be journaled, otherwise rsp"""
+        if _is_linkerror(rsp) and self.journaled:
+            return self.journal()
+        return rsp
+
+    def journal(self):
+        """Put the request in the bridge's journal.  `Returns` the response payload"""
+        if self.__bridge.journal.append(self.__topic, self.__payload):
+            logger.info("Agent link down, journaled: %s", self.__topic)
+            return {'code': 202,
+                    IoticAgentCore.Const.M_PAYLOAD: None,
+                    IoticAgentCore.Const.M_TYPE: 'journaled'}
+        return {'code': 503,
+                'error': 'linkerror',
+                'message': 'agent link down and journal full'}
+
+    def complete(self, rsp, replayed=False):
+        """Respond with rsp, once for the request and once for each duplicate which arrived while it was in progress.
+        If replayed (from the journal) the request and its duplicates have already had the journaled response, so
+        rsp replaces that in the request cache and is sent once
+        """
+        request = self.request
+        # Server errors are not remembered so the request can be retried
+        key = request_key(request.device_id, request.request_id, self.__topic, self.__payload)
+        duplicates = self.__bridge.requests.complete(key, rsp, remember=rsp['code'] < 500)
+        if replayed:
+            duplicates = 0
+        for _ in range(1 + duplicates):
+            _respond(self.__mqttclient, request, rsp, self.__codec)
+        M_REQUEST_SECONDS.observe(monotonic() - self.__received, (request.verb, request.noun))
+
+    def fail(self):
+        """Call (from an except block) if the handler raised.  Responds 500 and forgets the request, so that it can be
+        retried rather than being ignored as a duplicate in progress
+        """
+        logger.exception("Request failed: %s", self.__topic)
+        self.complete({'code': 500, 'error': 'internal error', 'message': 'request failed'})
+
+    def __complete_with(self, func):
+        """complete() with the response payload func returns, or fail() if it raises"""
+        try:
+            rsp = func()
+        except:  # pylint: disable=bare-except
+            self.fail()
+            return
+        self.complete(rsp)
+
+    def __call__(self):
+        self.__complete_with(lambda: _resolve(self.start()))
+
+    def run_pipelined(self):
+        """Handle the request on this thread without waiting (see _pipelined())"""
+        try:
+            rsp = self.start()
+        except:  # pylint: disable=bare-except
+            self.fail()
+            return
+        if isinstance(rsp, _Pending):
+            # Note: a share which could not be started as the agent link is down is a linkerror here (see _share_result)
+            rsp.evt._run_on_completion(
+                lambda _evt: self.__complete_with(lambda: self.__journal_linkerror(rsp.result())))
+        else:
+            self.complete(rsp)
+
+
+def _split_codec(topic):
+    """`Returns` tuple of topic without any codec suffix and the codec name (or None)"""
+    head, sep, codec_name = topic.rpartition('/' + CODEC_SUFFIX)
+    if sep and '/' not in codec_name:
+        return head, codec_name
+    return topic, None
+
 
+def _replay(bridge, mqttclient, topic, payload):
+    """Handle a request from the bridge's journal.  `Returns` False if the agent link is down again"""
+    route_topic, codec_name = _split_codec(topic)
+    handler, request = ROUTER.route(route_topic)
+    if handler is None:
+        logger.warning("Unrecognised journaled topic: %s", topic)
+        return True
+    codec = get_codec(codec_name) if codec_name else CODECS.for_device(request.device_id)
+    job = _Job(bridge, mqttclient, handler, request, payload, codec, monotonic(), topic)
+    rsp = _resolve(job.start(journal=False))
+    if _is_linkerror(rsp):
+        return False
+    logger.info("Replayed journaled request: %s", topic)
+    job.complete(rsp, replayed=True)
+    return True
 
-def on_message(client, mqttclient, userdata, msg):  # pylint: disable=too-many-branches
+
+def on_message(bridge, dispatcher, shard, mqttclient, userdata, msg):
     """on_message: Topics follow the qapi proxy api
     ioticlabs/req/  prefix
     device id free text for device
@@ -283,7 +911,9 @@ def on_message(client, mqttclient, userdata, msg):  # pylint: disable=too-many-b
     EG ioticlabs/req/bbq/11/create/entity {'lid': 'fish'}
     EG ioticlabs/req/bbq/12/update/entity/<lid>/rename {'newlid': 'chips'}
 
-    The request id must be unique (or atleast not currently in use)
+    The request id must be unique (or atleast not currently in use).  A repeated request (same request id, topic and
+    payload, e.g. QoS 1 redelivery) gets the response of the original request without it being sent to IoticAgent
+    again, once it has completed.
 
     Responses get the prefix ioticlabs/rsp/ <device id> / <request id> {payload}
 
@@ -297,108 +927,349 @@ def on_message(client, mqttclient, userdata, msg):  # pylint: disable=too-many-b
     All response payloads contain {'code': same as qapiproxy
     if 2** then 'p' and 't' will be set
     if not 2** then 'error' and 'message' will be set
+
+    Payloads are JSON unless another codec is set for the device (or unsolicited topic) in the config, or the topic
+    ends with /@<codec> (e.g. ioticlabs/req/bbq/13/list/entity/@msgpack) for this request and its response.
+
+    Requests are handed to the dispatcher so this (paho network loop) thread never waits on IoticAgent.  If too
+    many requests are pending a 503 response is sent straight away, and a 429 response if the device is over its
+    request rate limit (see quota.Quotas).
+
+    If sharded, requests from devices belonging to other shards are ignored (see shard.Shard), except those of
+    handlers marked _held(), which are handled by the shard holding what they refer to
     """
-    logger.info("on_message: %s / %s", msg.topic, msg.payload)
-    if msg.topic.startswith("ioticlabs/req/"):
-        device_id = _get_arg(msg.topic, 2)
-        request_id = _get_arg(msg.topic, 3)
-        if device_id is not None and request_id is not None:
-            payload = _get_payload(msg.payload)
-            if _get_arg(msg.topic, 4) == "create":
-                if _get_arg(msg.topic, 5) == "entity":
-                    return _do_create_entity(client, mqttclient, userdata, msg, device_id, request_id, payload)
-                elif _get_arg(msg.topic, 5) == "point":
-                    return _do_create_point(client, mqttclient, userdata, msg, device_id, request_id, payload)
-            elif _get_arg(msg.topic, 4) == "list":
-                if _get_arg(msg.topic, 5) == "entity":
-                    return _do_list_entity(client, mqttclient, userdata, msg, device_id, request_id, payload)
-            elif _get_arg(msg.topic, 4) == "update":
-                if _get_arg(msg.topic, 5) == "entity":
-                    return _do_update_entity(client, mqttclient, userdata, msg, device_id, request_id, payload)
-                elif _get_arg(msg.topic, 5) == 'point':
-                    return _do_update_point(client, mqttclient, userdata, msg, device_id, request_id, payload)
-            elif _get_arg(msg.topic, 4) == "delete":
-                if _get_arg(msg.topic, 5) == "entity":
-                    return _do_delete_entity(client, mqttclient, userdata, msg, device_id, request_id, payload)
-            else:
-                logger.warning("Unrecognised topic: %s", msg.topic)
-                _mqtt_pub(mqttclient, 'rsp/%s/%s' % (device_id, request_id),
-                          {'code': 400,
-                           'error': 'malformed',
-                           'message': 'unknown topic'})
-        else:
-            logger.warning("Unrecognised topic: %s", msg.topic)
+    # pylint: disable=unused-argument
+    received = monotonic()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("on_message: %s / %s", msg.topic, msg.payload)
+    else:
+        logger.info("on_message: %s", msg.topic, extra=SAMPLE)
+    topic, codec_name = _split_codec(msg.topic)
+    handler, request = ROUTER.route(topic)
+    if request is None:
+        logger.warning("Unrecognised topic: %s", msg.topic)
+        return
+    codec = CODECS.for_device(request.device_id)
+    codec_error = None
+    if codec_name:
+        try:
+            codec = get_codec(codec_name)
+        except ValueError as exc:
+            codec_error = str(exc)
+    if shard.sharded and getattr(handler, 'held', None) is not None and codec_error is None:
+        if not handler.held(bridge, _get_payload(msg.payload, codec)):
+            return
+    elif not shard.owns(request.device_id):
+        return
+    if codec_error is not None:
+        _respond(mqttclient, request, _malformed(codec_error), codec)
+        return
+    if handler is None:
+        logger.warning("Unrecognised topic: %s", msg.topic)
+        _respond(mqttclient, request, _malformed('unknown topic'), codec)
+        return
+    key = request_key(request.device_id, request.request_id, msg.topic, msg.payload)
+    state, rsp = bridge.requests.begin(key)
+    if state == DONE:
+        logger.info("Duplicate request, sending cached response: %s", msg.topic)
+        _respond(mqttclient, request, rsp, codec)
+        return
+    if state == PENDING:
+        logger.info("Duplicate request in progress: %s", msg.topic)
+        return
+    cost = _cost(bridge, handler, msg.payload, codec)
+    if not bridge.quotas.allow(request.device_id, cost):
+        bridge.requests.discard(key)
+        logger.info("Device over rate limit, rejecting: %s", msg.topic, extra=SAMPLE)
+        _respond(mqttclient, request, {'code': 429,
+                                       'error': 'too many requests',
+                                       'message': 'device request rate limit exceeded'}, codec)
+        return
+    job = _Job(bridge, mqttclient, handler, request, msg.payload, codec, received, msg.topic)
+    if job.journaled and bridge.journal.engaged():
+        job.complete(job.journal())
+    elif bridge.shares is not None and getattr(handler, 'pipelined', False):
+        job.run_pipelined()
+    elif not dispatcher.submit(request.device_id, job, cost):
+        bridge.requests.discard(key)
+        logger.warning("Too many pending requests, rejecting: %s", msg.topic)
+        _respond(mqttclient, request, {'code': 503,
+                                       'error': 'busy',
+                                       'message': 'too many requests pending'}, codec)
 
 
-def catchall_feeddata(mqttclient, data):
+def catchall_feeddata(outbox, shard, data):
+    M_UNSOLICITED.inc(('feeddata',))
     try:
-        # print(data)
-        _mqtt_pub(mqttclient, "feeddata/" + data['pid'], data)
+        if shard.emit_feed(data['pid']):
+            outbox.put("feeddata/" + data['pid'], data)
     except:
         logger.exception("catchall_feeddata caught exception")
 
 
-def catchall_controlreq(mqttclient, data):
+def catchall_controlreq(controls, outbox, data):
+    M_UNSOLICITED.inc(('controlreq',))
     try:
-        _mqtt_pub(mqttclient, "controlreq/%s/%s" % (data['entityLid'], data['lid']), data)
+        if data.get('confirm'):
+            controls.add(data)
+        outbox.put("controlreq/%s/%s" % (data['entityLid'], data['lid']), data)
     except:
         logger.exception("catchall_controlreq caught exception")
 
 
-def catchall_subscription(mqttclient, data):
+def catchall_subscription(outbox, data):
     # pylint: disable=unused-argument
     pass
 
 
-def main():
-    # Get command args
-    parser = argparse.ArgumentParser()
-    parser.add_argument("cfg", nargs="?")
-    args = parser.parse_args()
-    cfg = args.cfg
-    if cfg is not None and not exists(cfg):
-        print("Config file not found: %s" % cfg)
-        return 1
-    elif exists(join(getcwd(), "mqtt.ini")):
-        cfg = join(getcwd(), "mqtt.ini")
-    if cfg is None:
-        print("Usage: mqtt.py config.ini (else ./mqtt.ini will be used)")
-        return 1
+def _publish_stats(mqttclient, stop, interval):
+    while not stop.wait(interval):
+        try:
+            _mqtt_pub(mqttclient, 'stats', _stats())
+        except:
+            logger.exception("Failed to publish stats")
 
-    # Load config from file
-    host = DEFAULT_HOST
-    port = DEFAULT_PORT
 
-    config = IOT.Config.Config(fn=cfg)
-    if config.get('mqtt', 'host') is not None:
-        host = config.get('mqtt', 'host')
-    if config.get('mqtt', 'port') is not None:
+def _add_gauges(dispatcher, outbox, bridge, mqttclient):
+    """Metrics read from the bridge's components when scraped"""
+    METRICS.gauge('requests_pending', 'Requests submitted to the dispatcher and not yet completed',
+                  func=lambda: dispatcher.pending)
+    METRICS.gauge('outbox_depth', 'feeddata/controlreq messages waiting in the outbox',
+                  func=lambda: outbox.stats()['depth'])
+    for name, doc in (('sent', 'published'), ('dropped', 'dropped as the outbox was full'),
+                      ('coalesced', 'replaced by a later message'), ('limited', 'dropped by a rate limit')):
+        METRICS.counter('outbox_%s_total' % name, 'feeddata/controlreq messages %s' % doc,
+                        func=partial(lambda name: outbox.stats()[name], name))
+    METRICS.counter('rate_limited_requests_total', 'Requests rejected (429) as the device was over its rate limit',
+                    func=lambda: bridge.quotas.limited)
+    METRICS.gauge('controls_pending', 'Control requests (tells) waiting for their device to confirm',
+                  func=lambda: bridge.controls.pending)
+    for name, doc in (('confirmed', 'confirmed by their device'), ('expired', 'not confirmed in time'),
+                      ('unknown', 'confirmations of control requests not pending')):
+        METRICS.counter('controls_%s_total' % name, 'Control requests %s' % doc,
+                        func=partial(lambda name: bridge.controls.stats()[name], name))
+    METRICS.counter('duplicate_requests_total', 'Repeated request ids answered without calling IoticAgent',
+                    func=lambda: sum(bridge.requests.stats()[name] for name in ('hits', 'attached')))
+    # Note: paho private attributes, 0 if not present
+    METRICS.gauge('mqtt_out_packets', 'Packets queued by paho for sending',
+                  func=lambda: len(getattr(mqttclient, '_out_packet', ())))
+    METRICS.gauge('mqtt_out_messages', 'QoS 1/2 messages paho has not had acknowledged',
+                  func=lambda: len(getattr(mqttclient, '_out_messages', ())))
+
+
+def _add_share_gauges(shares):
+    METRICS.gauge('share_depth', 'Shares waiting in per point buffers', func=lambda: shares.stats()['depth'])
+    METRICS.gauge('share_inflight', 'Points with a share in flight', func=lambda: shares.stats()['inflight'])
+    for name, doc in (('queued', 'put in per point buffers'), ('shared', 'completed by IoticAgent'),
+                      ('superseded', 'replaced by a later share (last-value)'),
+                      ('dropped', 'dropped from a full buffer (drop-oldest)'),
+                      ('rejected', 'rejected as the buffer stayed full (block)'), ('timeouts', 'timed out'),
+                      ('failed', 'which IoticAgent failed to start')):
+        METRICS.counter('shares_%s_total' % name, 'Shares %s' % doc,
+                        func=partial(lambda name: shares.stats()[name], name))
+
+
+def _add_journal_gauges(journal):
+    METRICS.gauge('journal_depth', 'Requests journaled while the agent link is down, not yet replayed',
+                  func=lambda: journal.stats()['depth'])
+    METRICS.gauge('journal_bytes', 'Payload bytes journaled', func=lambda: journal.stats()['bytes'])
+    METRICS.gauge('journal_drain_rate', 'Journaled requests replayed per second',
+                  func=lambda: journal.stats()['drain_rate'])
+    for name, doc in (('appended', 'journaled'), ('replayed', 'replayed'),
+                      ('rejected', 'rejected as the journal was full')):
+        METRICS.counter('journal_%s_total' % name, 'Requests %s' % doc,
+                        func=partial(lambda name: journal.stats()[name], name))
+
+
+def _to_bool(value):
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    elif value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(value)
+
+
+def _get_config(config, val, default, conv=int):
+    if config.get('mqtt', val) is not None:
         try:
-            port = int(config.get('mqtt', 'port'))
+            return conv(config.get('mqtt', val))
         except:
-            logger.error("Unable to parse config [mqtt] port, using default.")
+            logger.error("Unable to parse config [mqtt] %s, using default.", val)
+    return default
+
+
+def _run(cfg, config):
+    host = DEFAULT_HOST
+    if config.get('mqtt', 'host') is not None:
+        host = config.get('mqtt', 'host')
+    port = _get_config(config, 'port', DEFAULT_PORT)
+    batch_window = max(1, _get_config(config, 'batch_window', DEFAULT_BATCH_WINDOW))
+    batch_max = _get_config(config, 'batch_max', DEFAULT_BATCH_MAX)
+    share_policy = config.get('mqtt', 'share_policy') or 'off'
+    share_wait = _get_config(config, 'share_wait', True, conv=_to_bool)
+
+    try:
+        CODECS.set_default(config.get('mqtt', 'codec') or 'json')
+        for kind in ('feeddata', 'controlreq'):
+            if config.get('mqtt', kind + '_codec') is not None:
+                CODECS.set_prefix(kind + '/', config.get('mqtt', kind + '_codec'))
+        for device_codec in (config.get('mqtt', 'device_codecs') or '').replace(',', ' ').split():
+            device_id, _, name = device_codec.partition(':')
+            CODECS.set_device(device_id, name)
+    except ValueError as exc:
+        print("Config [mqtt] codec: %s" % exc)
+        return 1
+
+    try:
+        quotas = Quotas(rate=_get_config(config, 'device_rate', 0, conv=float),
+                        burst=_get_config(config, 'device_burst', None, conv=float),
+                        limits=parse_limits(config.get('mqtt', 'device_limits')))
+        weights = parse_weights(config.get('mqtt', 'device_weights'))
+    except ValueError as exc:
+        print("Config [mqtt] device limits: %s" % exc)
+        return 1
+
+    controls = PendingControls(ttl=_get_config(config, 'control_confirm_ttl', DEFAULT_CONTROL_TTL, conv=float))
+
+    engine = config.get('mqtt', 'engine') or 'threads'
+    if engine == 'asyncio' and share_policy == BLOCK:
+        # on_message runs on the event loop, which a blocked put() would stall
+        print("Config [mqtt] share_policy: %s cannot be used with engine asyncio" % BLOCK)
+        return 1
+    if engine == 'asyncio':
+        from aioengine import AsyncEngine  # pylint: disable=import-error
+        dispatcher = AsyncEngine(workers=_get_config(config, 'workers', DEFAULT_WORKERS),
+                                 device_concurrency=_get_config(config, 'device_concurrency',
+                                                                DEFAULT_DEVICE_CONCURRENCY),
+                                 max_pending=_get_config(config, 'max_pending', DEFAULT_MAX_PENDING),
+                                 timeout=TIMEOUT)
+    elif engine == 'threads':
+        dispatcher = Dispatcher(workers=_get_config(config, 'workers', DEFAULT_WORKERS),
+                                device_concurrency=_get_config(config, 'device_concurrency',
+                                                               DEFAULT_DEVICE_CONCURRENCY),
+                                max_pending=_get_config(config, 'max_pending', DEFAULT_MAX_PENDING),
+                                weights=weights)
+    else:
+        print("Config [mqtt] engine: must be threads or asyncio")
+        return 1
+
+    requests = RequestCache(max_size=_get_config(config, 'request_cache_size', DEFAULT_REQUEST_CACHE_SIZE),
+                            ttl=_get_config(config, 'request_cache_ttl', DEFAULT_TTL, conv=float))
+
+    for kind in ('list', 'meta', 'tag'):
+        QUERIES.set_ttl(kind, _get_config(config, 'cache_ttl_' + kind, 0, conv=float))
+    stats_interval = _get_config(config, 'stats_interval', 0, conv=float)
+    metrics_host = config.get('mqtt', 'metrics_host') or DEFAULT_HOST
+    metrics_port = _get_config(config, 'metrics_port', 0)
+
+    try:
+        shard = Shard(index=_get_config(config, 'shard_index', 0),
+                      count=_get_config(config, 'shard_count', 1),
+                      group=config.get('mqtt', 'shard_group') or 'bridge',
+                      share=config.get('mqtt', 'shard_share'))
+    except ValueError as exc:
+        print("Config [mqtt] shard: %s" % exc)
+        return 1
+
+    supervisor = Supervisor(initial=_get_config(config, 'retry_initial', DEFAULT_RETRY_INITIAL, conv=float),
+                            maximum=_get_config(config, 'retry_max', DEFAULT_RETRY_MAX, conv=float),
+                            restart_after=_get_config(config, 'agent_restart_after', DEFAULT_RESTART_AFTER, conv=float),
+                            retry_timeout=_get_config(config, 'retry_timeout', 0, conv=float),
+                            on_recover=lambda link, seconds: M_RECOVER_SECONDS.observe(seconds, (link,)))
 
     # Connect agent and mqtt and loop forever
     try:
         client = IOT.Client(config=cfg)
+        bridge = _Bridge(client, requests, quotas, controls, share_wait=share_wait, batch_window=batch_window,
+                         batch_max=batch_max)
+        if share_policy != 'off':
+            try:
+                bridge.shares = SharePipeline(client._request_point_share,
+                                              size=_get_config(config, 'share_buffer', DEFAULT_SHARE_BUFFER),
+                                              policy=share_policy, window=_get_config(config, 'share_window', 1),
+                                              timeout=TIMEOUT)
+            except ValueError as exc:
+                print("Config [mqtt] share_policy: %s" % exc)
+                return 1
+            STATS['shares'] = bridge.shares.stats
+            _add_share_gauges(bridge.shares)
         mqttclient = mqtt.Client()
-        mqttclient.on_connect = on_connect
-        mqttclient.on_message = partial(on_message, client)
-        client.register_catchall_feeddata(partial(catchall_feeddata, mqttclient))
-        client.register_catchall_controlreq(partial(catchall_controlreq, mqttclient))
-        client.register_callback_subscription(partial(catchall_subscription, mqttclient))
-        with client:
+        if config.get('mqtt', 'journal_path'):
+            bridge.journal = Journal(config.get('mqtt', 'journal_path'), client.is_connected,
+                                     partial(_replay, bridge, mqttclient),
+                                     max_rows=_get_config(config, 'journal_max_rows', DEFAULT_JOURNAL_ROWS),
+                                     max_bytes=_get_config(config, 'journal_max_bytes', DEFAULT_JOURNAL_BYTES),
+                                     rate=_get_config(config, 'journal_rate', DEFAULT_JOURNAL_RATE, conv=float))
+            STATS['journal'] = bridge.journal.stats
+            _add_journal_gauges(bridge.journal)
+        mqttclient.on_connect = partial(on_connect, shard, supervisor)
+        mqttclient.on_disconnect = partial(on_disconnect, supervisor)
+        mqttclient.on_message = partial(on_message, bridge, dispatcher, shard)
+        shard.attach(mqttclient)
+        outbox = Outbox(partial(_mqtt_pub, mqttclient), max_size=_get_config(config, 'outbox_size', DEFAULT_MAX_SIZE))
+        for kind in ('feeddata', 'controlreq'):
+            outbox.add_rule(kind + '/',
+                            qos=_get_config(config, kind + '_qos', 0),
+                            rate=_get_config(config, kind + '_rate', 0, conv=float),
+                            coalesce=_get_config(config, kind + '_coalesce', False, conv=_to_bool))
+        STATS['dispatcher'] = dispatcher.stats
+        STATS['quotas'] = quotas.stats
+        STATS['controls'] = controls.stats
+        STATS['outbox'] = outbox.stats
+        STATS['requests'] = requests.stats
+        STATS['queries'] = QUERIES.stats
+        STATS['metrics'] = METRICS.snapshot
+        STATS['links'] = supervisor.stats
+        if shard.sharded:
+            STATS['shard'] = shard.stats
+        _add_gauges(dispatcher, outbox, bridge, mqttclient)
+        client.register_catchall_feeddata(partial(catchall_feeddata, outbox, shard))
+        client.register_catchall_controlreq(partial(catchall_controlreq, controls, outbox))
+        client.register_callback_subscription(partial(catchall_subscription, outbox))
+        if not supervisor.start_agent(client):
+            return 1
+        try:
             logger.info("Agent connected: %s", client.agent_id)
+            dispatcher.start()
+            outbox.start()
+            if bridge.shares is not None:
+                bridge.shares.start()
+            if bridge.journal is not None:
+                bridge.journal.start()
+            stats_stop = Event()
+            if stats_interval > 0:
+                stats_thread = Thread(target=_publish_stats, name='stats',
+                                      args=(mqttclient, stats_stop, stats_interval))
+                stats_thread.daemon = True
+                stats_thread.start()
+            metrics_server = None
+            if metrics_port > 0:
+                metrics_server = serve(METRICS, metrics_host, metrics_port)
+                logger.info("Metrics on http://%s:%d/metrics", metrics_host, metrics_port)
             try:
-                mqttclient.connect(host, port)
-                logger.info("MQTT connected.  Press ctrl+c to quit.")
-                mqttclient.loop_forever()
-            except ConnectionRefusedError:
-                logger.error("MQTT Connection Refused.  Give up.")
+                if engine == 'asyncio':
+                    dispatcher.run(mqttclient, host, port, supervisor.backoff())
+                else:
+                    logger.info("MQTT connecting to %s:%d.  Press ctrl+c to quit.", host, port)
+                    supervisor.run_mqtt(mqttclient, host, port)
             except KeyboardInterrupt:
                 pass
             except:
-                logger.exception("todo: unhandled mqtt exception?")
+                logger.exception("Unhandled MQTT exception")
+            finally:
+                shard.disconnect(mqttclient)
+                stats_stop.set()
+                if metrics_server is not None:
+                    metrics_server.shutdown()
+                outbox.stop(timeout=TIMEOUT)
+                if bridge.shares is not None:
+                    bridge.shares.stop(timeout=TIMEOUT)
+                if bridge.journal is not None:
+                    bridge.journal.stop(timeout=TIMEOUT)
+                dispatcher.stop(timeout=TIMEOUT)
+        finally:
+            supervisor.stop()
+            client.stop()
     except LinkException:
         print("Failed to connect")
         return 1
@@ -407,5 +1278,37 @@ def main():
     return 0
 
 
+def main():
+    # Get command args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cfg", nargs="?")
+    args = parser.parse_args()
+    cfg = args.cfg
+    if cfg is not None and not exists(cfg):
+        print("Config file not found: %s" % cfg)
+        return 1
+    elif exists(join(getcwd(), "mqtt.ini")):
+        cfg = join(getcwd(), "mqtt.ini")
+    if cfg is None:
+        print("Usage: mqtt.py config.ini (else ./mqtt.ini will be used)")
+        return 1
+
+    # Load config from file
+    config = IOT.Config.Config(fn=cfg)
+    level = logging.getLevelName((config.get('mqtt', 'log_level') or 'info').upper())
+    if not isinstance(level, int):
+        print("Config [mqtt] log_level unknown: %s" % config.get('mqtt', 'log_level'))
+        return 1
+    listener = setup_logging(level=level,
+                             structured=config.get('mqtt', 'log_format') == 'json',
+                             queued=_get_config(config, 'log_queue', True, conv=_to_bool),
+                             sample_rate=_get_config(config, 'log_sample', 1))
+    try:
+        return _run(cfg, config)
+    finally:
+        if listener is not None:
+            listener.stop()
+
+
 if __name__ == '__main__':
     exit(main())
@@ -0,0 +1,167 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""outbound: Queue of unsolicited messages from IoticAgent callbacks to MQTT
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from heapq import heappush, heappop
+from threading import Thread, Condition
+
+from IoticAgent.Core.compat import monotonic
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_SIZE = 10000
+
+
+class Outbox(object):
+
+    def __init__(self, publish, max_size=DEFAULT_MAX_SIZE):
+        """Bounded queue between IoticAgent callback threads and MQTT.  put() never blocks, messages are published
+        from the outbox thread in the order they were put (subject to rate limits).
+
+        `publish` (mandatory) function(topic, payload, qos) to publish one message
+
+        `max_size` (optional) (int) maximum number of queued messages.  Messages put when full are dropped.
+        """
+        self.__publish = publish
+        self.__max_size = max(1, max_size)
+        # (prefix, qos, interval, coalesce)
+        self.__rules = []
+        self.__cond = Condition()
+        # key -> (topic, payload, qos).  key is topic for coalescing topics, otherwise a sequence number
+        self.__ready = OrderedDict()
+        self.__seq = 0
+        # topic -> (payload, qos, interval) for coalescing topics waiting on their rate limit
+        self.__delayed = {}
+        # heap of (time, topic) when delayed topics may be sent
+        self.__due = []
+        # topic -> time before which the topic may not be sent again
+        self.__next = {}
+        self.__counts = {'dropped': 0, 'coalesced': 0, 'limited': 0, 'sent': 0}
+        self.__thread = None
+        self.__stop = False
+
+    def add_rule(self, prefix, qos=0, rate=0, coalesce=False):
+        """Set options for topics starting with prefix.  The first matching rule is used.
+
+        `qos` (optional) (int) MQTT QoS to publish with
+
+        `rate` (optional) (float) maximum messages per second on each topic, 0 for no limit.  Extra messages are
+        dropped, or for coalescing topics the latest is sent once allowed.
+
+        `coalesce` (optional) (bool) replace a queued message for the same topic rather than queueing another
+        """
+        self.__rules.append((prefix, qos, 1.0 / rate if rate > 0 else 0, coalesce))
+
+    def stats(self):
+        """`Returns` dict of depth (messages queued) and counts of messages dropped (queue full), coalesced, limited
+        (dropped by rate limit) and sent
+        """
+        with self.__cond:
+            stats = dict(self.__counts)
+            stats['depth'] = len(self.__ready) + len(self.__delayed)
+        return stats
+
+    def start(self):
+        self.__stop = False
+        self.__thread = Thread(target=self.__run, name='outbox')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        with self.__cond:
+            self.__stop = True
+            self.__cond.notify()
+        if self.__thread is not None:
+            self.__thread.join(timeout=timeout)
+            self.__thread = None
+
+    def __rule(self, topic):
+        for prefix, qos, interval, coalesce in self.__rules:
+            if topic.startswith(prefix):
+                return qos, interval, coalesce
+        return 0, 0, False
+
+    def put(self, topic, payload):
+        """Queue payload to be published on topic.  Never blocks.
+
+        `Returns` False if the message was dropped
+        """
+        qos, interval, coalesce = self.__rule(topic)
+        with self.__cond:
+            if coalesce:
+                if topic in self.__ready:
+                    self.__ready[topic] = (topic, payload, qos)
+                    self.__counts['coalesced'] += 1
+                    return True
+                if topic in self.__delayed:
+                    self.__delayed[topic] = (payload, qos, interval)
+                    self.__counts['coalesced'] += 1
+                    return True
+            if len(self.__ready) + len(self.__delayed) >= self.__max_size:
+                self.__counts['dropped'] += 1
+                return False
+            now = monotonic()
+            if interval:
+                due = self.__next.get(topic, 0)
+                if now < due:
+                    if not coalesce:
+                        self.__counts['limited'] += 1
+                        return False
+                    self.__delayed[topic] = (payload, qos, interval)
+                    heappush(self.__due, (due, topic))
+                    self.__cond.notify()
+                    return True
+                self.__next[topic] = now + interval
+            if coalesce:
+                key = topic
+            else:
+                key = self.__seq
+                self.__seq += 1
+            self.__ready[key] = (topic, payload, qos)
+            self.__cond.notify()
+        return True
+
+    def __take(self):
+        """Wait for the next message to send.  Returns None when stopped"""
+        with self.__cond:
+            while not self.__stop:
+                now = monotonic()
+                while self.__due and self.__due[0][0] <= now:
+                    _, topic = heappop(self.__due)
+                    payload, qos, interval = self.__delayed.pop(topic)
+                    self.__next[topic] = now + interval
+                    self.__ready[topic] = (topic, payload, qos)
+                if self.__ready:
+                    return self.__ready.popitem(last=False)[1]
+                self.__cond.wait(self.__due[0][0] - now if self.__due else None)
+        return None
+
+    def __run(self):
+        while True:
+            item = self.__take()
+            if item is None:
+                break
+            try:
+                self.__publish(*item)
+            except:  # pylint: disable=bare-except
+                logger.exception("Outbox failed to publish to %s", item[0])
+            else:
+                with self.__cond:
+                    self.__counts['sent'] += 1
@@ -0,0 +1,115 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""quota: Per device token bucket request rate limits
+"""
+
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from threading import Lock
+
+from IoticAgent.Core.compat import monotonic
+
+
+# Devices whose buckets and usage counts are remembered, least recently seen are forgotten first
+DEFAULT_MAX_DEVICES = 10000
+# Devices listed in stats(), busiest first
+STATS_TOP = 20
+
+
+def parse_limits(value):
+    """`Returns` dict of device_id -> (rate, burst or None) from e.g. 'bbq:50/100, fridge:5'.  Raises ValueError"""
+    limits = {}
+    for item in (value or '').replace(',', ' ').split():
+        device_id, _, limit = item.rpartition(':')
+        rate, _, burst = limit.partition('/')
+        if not device_id:
+            raise ValueError('expected <device>:<rate>[/<burst>], got %s' % item)
+        limits[device_id] = (float(rate), float(burst) if burst else None)
+    return limits
+
+
+class Quotas(object):
+
+    def __init__(self, rate=0, burst=None, limits=None, max_devices=DEFAULT_MAX_DEVICES):
+        """Token bucket per device_id, refilled at rate requests per second up to burst.
+
+        `rate` (optional) (float) default requests per second per device, 0 for no limit
+
+        `burst` (optional) (float) default bucket size, i.e. requests a device can make at once after being idle.
+        Defaults to rate (at least 1)
+
+        `limits` (optional) dict of device_id -> (rate, burst or None) overriding the defaults, see parse_limits()
+
+        `max_devices` (optional) (int) maximum devices remembered
+        """
+        self.__default = self.__limit(rate, burst)
+        self.__limits = {device_id: self.__limit(*limit) for device_id, limit in (limits or {}).items()}
+        self.__max_devices = max(1, max_devices)
+        self.__lock = Lock()
+        # device_id -> [tokens, last refill time, accepted, limited]
+        self.__devices = OrderedDict()
+        self.__limited = 0
+
+    @staticmethod
+    def __limit(rate, burst):
+        if rate <= 0:
+            return None
+        return rate, max(1.0, burst if burst is not None else rate)
+
+    @property
+    def limited(self):
+        """Number of requests rejected in total"""
+        with self.__lock:
+            return self.__limited
+
+    def allow(self, device_id, cost=1):
+        """Take cost tokens for a request from device_id, e.g. a batch costs one per sub-request.  A request costing
+        more than the bucket holds is allowed once the bucket is full and leaves it in debt, so the device waits for
+        the whole cost to be refilled before its next request.
+
+        `Returns` True if the request is within device_id's limit
+        """
+        limit = self.__limits.get(device_id, self.__default)
+        now = monotonic()
+        with self.__lock:
+            state = self.__devices.get(device_id)
+            if state is None:
+                state = self.__devices[device_id] = [limit[1] if limit else 0, now, 0, 0]
+                if len(self.__devices) > self.__max_devices:
+                    self.__devices.popitem(last=False)
+            else:
+                self.__devices.move_to_end(device_id)
+            if limit is not None:
+                rate, burst = limit
+                state[0] = min(burst, state[0] + (now - state[1]) * rate)
+                state[1] = now
+                if state[0] < min(cost, burst):
+                    state[3] += 1
+                    self.__limited += 1
+                    return False
+                state[0] -= cost
+            state[2] += 1
+        return True
+
+    def stats(self):
+        """`Returns` dict of devices (remembered), limited (requests rejected in total) and usage: the busiest devices'
+        accepted and limited counts and tokens left
+        """
+        with self.__lock:
+            busiest = sorted(self.__devices.items(), key=lambda item: item[1][2] + item[1][3], reverse=True)[:STATS_TOP]
+            return {'devices': len(self.__devices),
+                    'limited': self.__limited,
+                    'usage': {device_id: {'accepted': state[2], 'limited': state[3], 'tokens': int(state[0])}
+                              for device_id, state in busiest}}
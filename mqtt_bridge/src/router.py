@@ -0,0 +1,93 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""router: Topic router for MQTT bridge requests
+
+Request topics have the layout ioticlabs/req/<device>/<reqid>/<verb>/<noun>/<args...> (see wiki/Home.md).  Routes
+are compiled once and stored by (verb, noun, number of args) so a topic is split once and only checked against the
+few routes sharing its shape.
+"""
+
+from __future__ import unicode_literals
+
+from collections import namedtuple
+
+
+# Number of topic segments before the args: ioticlabs/req/<device>/<reqid>/<verb>/<noun>
+ARGS_START = 6
+
+# A routed request.  Segments not present on the topic are None.  params is a dict of any other named segments, e.g.
+# 'fmt' for entity/<lid>/<fmt>/meta
+Request = namedtuple('Request', ('device_id', 'request_id', 'verb', 'noun', 'lid', 'pid', 'foc', 'params'))
+
+
+class Router(object):
+
+    def __init__(self):
+        """Maps request topics to handlers.  See add()
+        """
+        # (verb, noun, arity) -> list of (literals, captures, handler).  literals is a tuple of (index, text) args
+        # which must match, captures a tuple of (index, name) args to capture.
+        self.__routes = {}
+
+    def add(self, verb, path, handler):
+        """Register handler for requests of verb on path
+
+        `verb` (mandatory) (string) e.g. create, list, update, delete, confirm
+
+        `path` (mandatory) (string) resource and arguments separated by '/', e.g. `"entity/<lid>/<fmt>/meta"`.  Args
+        in angle brackets are captured into the Request, others must match exactly.  Routes with more exact args
+        are tried first so `"entity/all"` wins over `"entity/<lid>"`.  Empty for requests with only a verb, e.g.
+        batch.
+
+        `handler` (mandatory) anything, returned by route()
+        """
+        segments = path.split('/') if path else [None]
+        noun = segments[0]
+        if noun is not None and (not noun or noun.startswith('<')):
+            raise ValueError("path must start with a resource: %s" % path)
+        literals = []
+        captures = []
+        for i, seg in enumerate(segments[1:]):
+            if seg.startswith('<') and seg.endswith('>'):
+                captures.append((i, seg[1:-1]))
+            else:
+                literals.append((i, seg))
+        routes = self.__routes.setdefault((verb, noun, len(segments) - 1), [])
+        routes.append((tuple(literals), tuple(captures), handler))
+        routes.sort(key=lambda route: -len(route[0]))
+
+    def route(self, topic):
+        """Find the handler for a request topic
+
+        `Returns` tuple of (handler, Request).  handler is None if no route matches.  Request is None if the topic is
+        not a request or has no device or request id.
+        """
+        parts = topic.split('/')
+        if len(parts) < 4 or parts[0] != 'ioticlabs' or parts[1] != 'req' or not parts[2] or not parts[3]:
+            return None, None
+        if len(parts) > 4:
+            args = parts[ARGS_START:]
+            noun = parts[5] if len(parts) > 5 else None
+            for literals, captures, handler in self.__routes.get((parts[4], noun, len(args)), ()):
+                for i, text in literals:
+                    if args[i] != text:
+                        break
+                else:
+                    params = {name: args[i] for i, name in captures}
+                    if '' in params.values():
+                        continue
+                    return handler, Request(parts[2], parts[3], parts[4], noun, params.pop('lid', None),
+                                            params.pop('pid', None), params.pop('foc', None), params)
+        return None, Request(parts[2], parts[3], parts[4] if len(parts) > 4 else None,
+                             parts[5] if len(parts) > 5 else None, None, None, None, {})
@@ -0,0 +1,171 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""shard: Splitting MQTT bridge requests and feeddata between several bridge processes
+
+Each shard is a bridge process with its own agent.  Requests are partitioned by a hash of device_id so all of a
+device's requests (and so its entities) go to the same shard.  Followed feeds are claimed by the first shard to
+receive data for them, using retained messages under ioticlabs/shard/<group>/, so each feed's data is republished by
+one shard only:
+
+    ioticlabs/shard/<group>/up/<index>      retained "1" while the shard is connected, "0" (will) when not
+    ioticlabs/shard/<group>/feed/<pid>      retained index of the shard republishing the feed
+"""
+
+from __future__ import unicode_literals
+
+from threading import Lock
+from zlib import crc32
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+REQUEST_TOPIC = 'ioticlabs/req/#'
+SHARD_PREFIX = 'ioticlabs/shard/'
+
+
+def partition(key, count):
+    """`Returns` the shard index (0 to count - 1) for key.  The same in every process (unlike hash())"""
+    return (crc32(key.encode('utf8')) & 0xffffffff) % count
+
+
+class Shard(object):
+
+    def __init__(self, index=0, count=1, group='bridge', share=None):
+        """One of count bridge processes.  count 1 (the default) is not sharded.
+
+        `index` (optional) (int) this shard, 0 to count - 1
+
+        `group` (optional) (str) name shared by all shards of one deployment
+
+        `share` (optional) (str) if set requests are received through the MQTT shared subscription
+        $share/<share>-<index>/ioticlabs/req/# so that several processes with the same index (and agent) share its
+        requests.  Otherwise each shard receives every request and ignores those of other shards.
+        """
+        if count < 1 or not 0 <= index < count:
+            raise ValueError('shard index must be from 0 to count - 1')
+        self.index = index
+        self.count = count
+        self.__group = group
+        self.__share = share
+        self.__lock = Lock()
+        # pid -> claiming shard index
+        self.__claims = {}
+        # indexes of shards which are connected
+        self.__up = set([index])
+        self.__publish = None
+        self.__counts = {'ignored': 0, 'claimed': 0, 'skipped': 0}
+
+    @property
+    def sharded(self):
+        return self.count > 1
+
+    def stats(self):
+        """`Returns` dict of index, count, shards up, feeds claimed (by any shard) and counts of requests ignored
+        (other shards' devices), feeds claimed by this shard and feeddata skipped (claimed by another shard)
+        """
+        with self.__lock:
+            stats = dict(self.__counts)
+            stats.update(index=self.index, count=self.count, up=len(self.__up), feeds=len(self.__claims))
+        return stats
+
+    def owns(self, device_id):
+        """`Returns` True if requests from device_id are handled by this shard"""
+        if self.count == 1 or partition(device_id, self.count) == self.index:
+            return True
+        with self.__lock:
+            self.__counts['ignored'] += 1
+        return False
+
+    @property
+    def request_topic(self):
+        if self.__share:
+            return '$share/%s-%d/%s' % (self.__share, self.index, REQUEST_TOPIC)
+        return REQUEST_TOPIC
+
+    def __topic(self, *parts):
+        return SHARD_PREFIX + '/'.join((self.__group,) + parts)
+
+    def attach(self, mqttclient):
+        """Set the will and callbacks on mqttclient (before connecting).  Call connected() from on_connect"""
+        if not self.sharded:
+            return
+        self.__publish = mqttclient.publish
+        mqttclient.will_set(self.__topic('up', str(self.index)), '0', qos=1, retain=True)
+        mqttclient.message_callback_add(self.__topic('up', '+'), self.__on_up)
+        mqttclient.message_callback_add(self.__topic('feed', '#'), self.__on_feed)
+
+    def connected(self, mqttclient):
+        if not self.sharded:
+            return
+        mqttclient.subscribe(self.__topic('#'), qos=1)
+        mqttclient.publish(self.__topic('up', str(self.index)), '1', qos=1, retain=True)
+
+    def disconnect(self, mqttclient):
+        """Mark this shard down so its feeds are claimed by others and disconnect (the will only covers unclean
+        disconnects).  Call once the network loop has stopped.
+        """
+        if not self.sharded:
+            return
+        try:
+            mqttclient.publish(self.__topic('up', str(self.index)), '0', qos=1, retain=True)
+            mqttclient.loop(timeout=1.0)
+            mqttclient.disconnect()
+        except:
+            logger.exception("Failed to mark shard down")
+
+    def emit_feed(self, pid):
+        """`Returns` True if this shard should republish data for feed pid.  Claims the feed if no connected shard
+        has.  If two shards claim a feed at once both republish until the broker's last claim reaches them.
+        """
+        if not self.sharded:
+            return True
+        with self.__lock:
+            claimant = self.__claims.get(pid)
+            if claimant in self.__up:
+                if claimant == self.index:
+                    return True
+                self.__counts['skipped'] += 1
+                return False
+            self.__claims[pid] = self.index
+            self.__counts['claimed'] += 1
+        logger.info("Claiming feed %s", pid)
+        self.__publish(self.__topic('feed', pid), str(self.index), qos=1, retain=True)
+        return True
+
+    def __on_up(self, mqttclient, userdata, msg):
+        # pylint: disable=unused-argument
+        try:
+            index = int(msg.topic.rpartition('/')[2])
+        except ValueError:
+            return
+        with self.__lock:
+            if msg.payload in (b'1', '1'):
+                self.__up.add(index)
+            elif index != self.index:
+                self.__up.discard(index)
+        logger.info("Shard %d %s", index, 'up' if index in self.__up else 'down')
+
+    def __on_feed(self, mqttclient, userdata, msg):
+        # pylint: disable=unused-argument
+        pid = msg.topic.rpartition('/')[2]
+        try:
+            index = int(msg.payload)
+        except ValueError:
+            index = None
+        with self.__lock:
+            if index is None:
+                self.__claims.pop(pid, None)
+            else:
+                self.__claims[pid] = index
@@ -0,0 +1,276 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""sharepipe: Per point pipelines of share requests with bounded buffers
+
+Each (lid, pid) has up to window shares in flight with IoticAgent (started in the order they were put) and a buffer
+of shares waiting behind them.  Nothing waits on a thread for a share to complete: the next share is started from the
+completion callback of one in flight.
+"""
+
+from __future__ import unicode_literals
+
+from collections import deque
+from threading import Thread, Condition, Event, Lock
+
+from IoticAgent.Core.compat import monotonic
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Buffer full policies, see SharePipeline
+DROP_OLDEST = 'drop-oldest'
+LAST_VALUE = 'last-value'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, LAST_VALUE, BLOCK)
+
+DEFAULT_SIZE = 100
+
+# Ticket errors
+DROPPED = 'dropped'
+TIMEOUT = 'timeout'
+
+
+class Ticket(object):
+
+    def __init__(self):
+        """Set once the share it was put() for has completed, timed out or been dropped (for LAST_VALUE, the share
+        which superseded it).  Waited on like an IoticAgent RequestEvent.
+
+        `evt` is the share's RequestEvent (None if the share was not started) and `error` None, DROPPED, TIMEOUT or
+        the exception raised starting the share (e.g. LinkException)
+        """
+        self.evt = None
+        self.error = None
+        self.__event = Event()
+        self.__lock = Lock()
+        self.__on_completion = []
+
+    def wait(self, timeout=None):
+        return self.__event.wait(timeout)
+
+    def is_set(self):
+        return self.__event.is_set()
+
+    def _run_on_completion(self, func, *args, **kwargs):
+        """As IoticAgent's RequestEvent: call func(self, *args, **kwargs) once set (straight away if already set)"""
+        with self.__lock:
+            if not self.__event.is_set():
+                self.__on_completion.append((func, args, kwargs))
+                return
+        func(self, *args, **kwargs)
+
+    def _set(self, evt, error=None):
+        self.evt = evt
+        self.error = error
+        with self.__lock:
+            self.__event.set()
+            on_completion, self.__on_completion = self.__on_completion, []
+        for func, args, kwargs in on_completion:
+            try:
+                func(self, *args, **kwargs)
+            except:  # pylint: disable=bare-except
+                logger.exception("Ticket completion callback failed")
+
+
+class _Pipe(object):
+    __slots__ = ('waiting', 'inflight', 'starting', 'gen')
+
+    def __init__(self):
+        # [share args, tickets]
+        self.waiting = deque()
+        # gen -> [tickets, RequestEvent, started]
+        self.inflight = {}
+        # True while a thread is starting shares (so they are started in order)
+        self.starting = False
+        self.gen = 0
+
+
+class SharePipeline(object):
+
+    def __init__(self, share, size=DEFAULT_SIZE, policy=DROP_OLDEST, window=1, timeout=10):
+        """Buffers shares per (lid, pid) in front of IoticAgent.
+
+        `share` (mandatory) function(lid, pid, data, mime, time) starting a share, returns its RequestEvent.  E.g.
+        IOT.Client._request_point_share
+
+        `size` (optional) (int) maximum shares waiting per (lid, pid)
+
+        `policy` (optional) what put() does when a buffer is full: DROP_OLDEST drops the oldest waiting share (its
+        ticket is set with error DROPPED), BLOCK waits up to timeout for space (so a caller on the MQTT network thread
+        stops reading from the broker) and LAST_VALUE replaces the waiting share with the new one instead of
+        buffering it.  The tickets of the replaced shares are set (acknowledged in bulk) when the new one completes.
+
+        `window` (optional) (int) maximum shares in flight per (lid, pid)
+
+        `timeout` (optional) (float) seconds before a share in flight is given up on (its tickets are set with error
+        TIMEOUT and the next share started) and maximum seconds put() blocks for
+        """
+        if policy not in POLICIES:
+            raise ValueError('share policy must be one of %s' % ', '.join(POLICIES))
+        self.__share = share
+        self.__size = max(1, size)
+        self.__policy = policy
+        self.__window = max(1, window)
+        self.__timeout = timeout
+        self.__cond = Condition()
+        # (lid, pid) -> _Pipe
+        self.__pipes = {}
+        self.__counts = {'queued': 0, 'shared': 0, 'superseded': 0, 'dropped': 0, 'rejected': 0, 'timeouts': 0,
+                         'failed': 0}
+        self.__thread = None
+        self.__stop = Event()
+
+    def stats(self):
+        """`Returns` dict of depth (shares waiting), inflight and counts of shares queued, shared (completed by
+        IoticAgent), superseded (by LAST_VALUE), dropped (by DROP_OLDEST), rejected (BLOCK timed out), timeouts and
+        failed (to start)
+        """
+        with self.__cond:
+            stats = dict(self.__counts)
+            stats['depth'] = sum(len(pipe.waiting) for pipe in self.__pipes.values())
+            stats['inflight'] = sum(len(pipe.inflight) for pipe in self.__pipes.values())
+        return stats
+
+    def start(self):
+        self.__stop.clear()
+        self.__thread = Thread(target=self.__expire, name='sharepipe')
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self, timeout=None):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=timeout)
+            self.__thread = None
+
+    def put(self, lid, pid, data, mime=None, time=None):
+        """Queue a share of data to feed pid of entity lid.
+
+        `Returns` a Ticket, or None if the buffer stayed full for timeout seconds (BLOCK)
+        """
+        key = (lid, pid)
+        args = (lid, pid, data, mime, time)
+        ticket = Ticket()
+        dropped = None
+        with self.__cond:
+            pipe = self.__pipes.get(key)
+            if pipe is None:
+                pipe = self.__pipes[key] = _Pipe()
+            if self.__policy == LAST_VALUE and pipe.waiting:
+                entry = pipe.waiting[-1]
+                entry[0] = args
+                entry[1].append(ticket)
+                self.__counts['superseded'] += 1
+            else:
+                if len(pipe.waiting) >= self.__size:
+                    if self.__policy == DROP_OLDEST:
+                        dropped = pipe.waiting.popleft()[1]
+                        self.__counts['dropped'] += len(dropped)
+                    else:
+                        end = monotonic() + self.__timeout
+                        while len(pipe.waiting) >= self.__size:
+                            remaining = end - monotonic()
+                            if remaining <= 0:
+                                self.__counts['rejected'] += 1
+                                return None
+                            self.__cond.wait(remaining)
+                            # Note: the pipe is removed if it empties while waiting
+                            pipe = self.__pipes.setdefault(key, pipe)
+                pipe.waiting.append([args, [ticket]])
+            self.__counts['queued'] += 1
+        if dropped:
+            for dropped_ticket in dropped:
+                dropped_ticket._set(None, DROPPED)
+        self.__drain(key)
+        return ticket
+
+    def __drain(self, key):
+        """Start waiting shares for key while the window allows"""
+        while True:
+            with self.__cond:
+                pipe = self.__pipes.get(key)
+                if pipe is None or pipe.starting or len(pipe.inflight) >= self.__window:
+                    pipe = None
+                elif not pipe.waiting:
+                    if not pipe.inflight:
+                        del self.__pipes[key]
+                    pipe = None
+                else:
+                    args, tickets = pipe.waiting.popleft()
+                    pipe.gen += 1
+                    gen = pipe.gen
+                    inflight = pipe.inflight[gen] = [tickets, None, monotonic()]
+                    pipe.starting = True
+                    self.__cond.notify_all()
+            if pipe is None:
+                return
+            # Note: shares completing while starting are drained by this loop rather than from __finish
+            try:
+                try:
+                    evt = self.__share(*args)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.warning("Share to %s/%s failed: %s", args[0], args[1], exc)
+                    self.__finish(key, gen, None, exc)
+                    continue
+                inflight[1] = evt
+                if hasattr(evt, '_run_on_completion'):
+                    # Note: IoticAgent passes the event first
+                    evt._run_on_completion(self.__completed, key, gen)
+                else:
+                    thread = Thread(target=self.__wait, name='sharepipe-wait', args=(key, gen, evt))
+                    thread.daemon = True
+                    thread.start()
+            finally:
+                with self.__cond:
+                    pipe.starting = False
+
+    def __completed(self, evt, key, gen):
+        self.__finish(key, gen, evt)
+
+    def __wait(self, key, gen, evt):
+        evt.wait(self.__timeout)
+        if evt.is_set():
+            self.__finish(key, gen, evt)
+
+    def __finish(self, key, gen, evt, error=None):
+        with self.__cond:
+            pipe = self.__pipes.get(key)
+            inflight = None if pipe is None else pipe.inflight.pop(gen, None)
+            if inflight is None:
+                # Already timed out
+                return
+            tickets = inflight[0]
+            drain = not pipe.starting
+            if error is None:
+                self.__counts['shared'] += 1
+            elif error == TIMEOUT:
+                self.__counts['timeouts'] += 1
+            else:
+                self.__counts['failed'] += 1
+        for ticket in tickets:
+            ticket._set(evt, error)
+        if drain:
+            self.__drain(key)
+
+    def __expire(self):
+        """Give up on shares in flight for longer than timeout"""
+        while not self.__stop.wait(min(1.0, self.__timeout)):
+            expired = monotonic() - self.__timeout
+            with self.__cond:
+                late = [(key, gen, inflight[1]) for key, pipe in self.__pipes.items()
+                        for gen, inflight in pipe.inflight.items() if inflight[2] < expired]
+            for key, gen, evt in late:
+                logger.warning("Share to %s/%s timed out", *key)
+                self.__finish(key, gen, evt, TIMEOUT)
@@ -0,0 +1,243 @@
+# Copyright (c) 2016 Iotic Labs Ltd. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://github.com/Iotic-Labs/py-IoticAgent/blob/master/LICENSE
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""supervisor: Keeps the MQTT bridge's agent and MQTT links up, reconnecting each with jittered exponential backoff
+
+Like IoticAgent's RetryingThingRunner the agent is started with retries.  Once running, the agent and MQTT links are
+reconnected independently of each other, in the same process, so the dispatcher, request cache and outbox (and so
+requests in flight) carry on across reconnects.
+"""
+
+from __future__ import unicode_literals
+
+from random import uniform
+from socket import error as SocketError
+from threading import Thread, Event, Lock
+
+from IoticAgent.Core.compat import monotonic
+from IoticAgent.IOT.Exceptions import LinkException
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Links
+AGENT = 'agent'
+MQTT = 'mqtt'
+
+# Seconds
+DEFAULT_INITIAL = 1.0
+DEFAULT_MAXIMUM = 60.0
+DEFAULT_RESTART_AFTER = 60.0
+CHECK_INTERVAL = 1.0
+# Network loop timeout, also how often stop() is noticed
+LOOP_TIMEOUT = 1.0
+
+# paho MQTT_ERR_SUCCESS and mqtt_cs_disconnecting
+_ERR_SUCCESS = 0
+_CS_DISCONNECTING = 2
+
+
+class Backoff(object):
+
+    def __init__(self, initial=DEFAULT_INITIAL, maximum=DEFAULT_MAXIMUM, factor=2.0):
+        """Delays growing by factor from initial up to maximum seconds.  Each is jittered (between half and all of
+        it) so that many bridges do not reconnect in step.
+        """
+        self.__initial = initial
+        self.__maximum = maximum
+        self.__factor = factor
+        self.__attempts = 0
+
+    def next(self):
+        """`Returns` seconds to wait before the next attempt"""
+        delay = min(self.__maximum, self.__initial * self.__factor ** min(self.__attempts, 32))
+        self.__attempts += 1
+        return uniform(delay / 2, delay)
+
+    def reset(self):
+        self.__attempts = 0
+
+
+class _Link(object):
+    __slots__ = ('up', 'down_since', 'downs', 'last_recover')
+
+    def __init__(self):
+        self.up = False
+        # monotonic time the link went down, None if it has not been up yet
+        self.down_since = None
+        self.downs = 0
+        # seconds the last outage lasted
+        self.last_recover = None
+
+
+class Supervisor(object):
+
+    def __init__(self, initial=DEFAULT_INITIAL, maximum=DEFAULT_MAXIMUM, restart_after=DEFAULT_RESTART_AFTER,
+                 retry_timeout=0, on_recover=None):
+        """Reconnects the agent and MQTT links.
+
+        `initial`, `maximum` (optional) (float) seconds of the first and longest backoff delay
+
+        `restart_after` (optional) (float) seconds the agent link may be down (reconnecting by itself) before the
+        client is restarted, 0 for never
+
+        `retry_timeout` (optional) (float) seconds start_agent() retries for, 0 for no limit
+
+        `on_recover` (optional) function(link, seconds) called when link (AGENT or MQTT) comes back up after being down
+        for seconds, e.g. for metrics
+        """
+        self.__initial = initial
+        self.__maximum = maximum
+        self.__restart_after = restart_after
+        self.__retry_timeout = retry_timeout
+        self.__on_recover = on_recover
+        self.__lock = Lock()
+        self.__links = {AGENT: _Link(), MQTT: _Link()}
+        self.__stop = Event()
+        self.__thread = None
+
+    def backoff(self):
+        """`Returns` a new Backoff with this supervisor's settings"""
+        return Backoff(self.__initial, self.__maximum)
+
+    def stats(self):
+        """`Returns` dict of link -> dict of up, downs (times it has gone down), down_s (seconds down so far, if down)
+        and last_recover_s (seconds the last outage lasted)
+        """
+        now = monotonic()
+        with self.__lock:
+            return {name: {'up': link.up,
+                           'downs': link.downs,
+                           'down_s': None if link.up or link.down_since is None else round(now - link.down_since, 3),
+                           'last_recover_s': link.last_recover}
+                    for name, link in self.__links.items()}
+
+    def up(self, name):
+        """Call when link name is (re)connected"""
+        with self.__lock:
+            link = self.__links[name]
+            if link.up:
+                return
+            link.up = True
+            recovered = None
+            if link.down_since is not None:
+                recovered = link.last_recover = round(monotonic() - link.down_since, 3)
+        if recovered is not None:
+            logger.info("%s link recovered after %.1fs", name, recovered)
+            if self.__on_recover is not None:
+                self.__on_recover(name, recovered)
+
+    def down(self, name):
+        """Call when link name is lost"""
+        with self.__lock:
+            link = self.__links[name]
+            if not link.up:
+                return
+            link.up = False
+            link.down_since = monotonic()
+            link.downs += 1
+        logger.warning("%s link down", name)
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=CHECK_INTERVAL * 2)
+            self.__thread = None
+
+    def start_agent(self, client):
+        """Start client, retrying with backoff while it raises LinkException.  Then (in a thread) keep checking the
+        link, restarting the client if it stays down for restart_after.
+
+        `Returns` False if stop() was called first.  Raises LinkException if retry_timeout passes
+        """
+        backoff = self.backoff()
+        end = monotonic() + self.__retry_timeout if self.__retry_timeout > 0 else None
+        while True:
+            try:
+                client.start()
+                break
+            except LinkException as exc:
+                delay = backoff.next()
+                if end is not None and monotonic() + delay > end:
+                    raise
+                logger.warning("Agent failed to start (%s), retrying in %.1fs", exc, delay)
+                if self.__stop.wait(delay):
+                    return False
+        self.up(AGENT)
+        self.__thread = Thread(target=self.__watch_agent, name='supervisor', args=(client,))
+        self.__thread.daemon = True
+        self.__thread.start()
+        return True
+
+    def __watch_agent(self, client):
+        backoff = self.backoff()
+        next_restart = 0
+        while not self.__stop.wait(CHECK_INTERVAL):
+            if client.is_connected():
+                self.up(AGENT)
+                backoff.reset()
+                continue
+            self.down(AGENT)
+            with self.__lock:
+                down_for = monotonic() - self.__links[AGENT].down_since
+            if not self.__restart_after or down_for < self.__restart_after or monotonic() < next_restart:
+                continue
+            logger.warning("Agent link down for %.1fs, restarting client", down_for)
+            try:
+                client.stop()
+            except:  # pylint: disable=bare-except
+                logger.exception("Agent client stop failed")
+            try:
+                client.start()
+            except:  # pylint: disable=bare-except
+                delay = backoff.next()
+                logger.exception("Agent client restart failed, retrying in %.1fs", delay)
+                next_restart = monotonic() + delay
+
+    def run_mqtt(self, mqttclient, host, port):
+        """Connect mqttclient and run its network loop (replaces connect() and loop_forever()), reconnecting with
+        backoff whenever the connection fails or is lost.  Call up(MQTT) and down(MQTT) from on_connect and
+        on_disconnect.  Returns after mqttclient.disconnect() or stop()
+        """
+        backoff = self.backoff()
+        connected = False
+        while not self.__stop.is_set():
+            try:
+                if connected:
+                    mqttclient.reconnect()
+                else:
+                    mqttclient.connect(host, port)
+                    connected = True
+            except (SocketError, OSError) as exc:
+                self.down(MQTT)
+                delay = backoff.next()
+                logger.warning("MQTT connect to %s:%s failed (%s), retrying in %.1fs", host, port, exc, delay)
+                self.__stop.wait(delay)
+                continue
+            backoff.reset()
+            rcode = _ERR_SUCCESS
+            while rcode == _ERR_SUCCESS and not self.__stop.is_set():
+                try:
+                    rcode = mqttclient.loop(timeout=LOOP_TIMEOUT)
+                except (SocketError, OSError):
+                    logger.exception("MQTT network loop failed")
+                    rcode = None
+            # Note: paho private attribute, as in Client.loop_forever()
+            if getattr(mqttclient, '_state', None) == _CS_DISCONNECTING:
+                return
+            self.down(MQTT)
+            if not self.__stop.is_set():
+                delay = backoff.next()
+                logger.warning("MQTT connection lost, reconnecting in %.1fs", delay)
+                self.__stop.wait(delay)